@@ -12,14 +12,15 @@ config = context.config
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 if config.config_file_name is not None:
-    fileConfig(config.config_file_name)
+    # 保留 uvicorn / gunicorn 已建立的 logger（在 app 內執行 migrations 時）
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from app.db.session import Base
-from app.db.models import User, UserSetting, ChatHistory  # noqa
+from app.db.models import User, UserSetting, ChatHistory, LLMUsageDaily, SharedStateEntry  # noqa
 target_metadata = Base.metadata
 
 # other values from the config, defined by the needs of env.py,
@@ -70,8 +71,11 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
+        # SQLite 不支援大部分 ALTER TABLE，之後的 migrations 以 batch 模式（重建資料表）執行
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=connection.dialect.name == "sqlite",
         )
 
         with context.begin_transaction():
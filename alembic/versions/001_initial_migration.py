@@ -32,7 +32,7 @@ def upgrade() -> None:
     op.create_table(
         'user_settings',
         sa.Column('line_user_id', sa.String(length=100), nullable=False),
-        sa.Column('llm_enabled', sa.Boolean(), nullable=False, server_default='true'),
+        sa.Column('llm_enabled', sa.Boolean(), nullable=False, server_default=sa.true()),
         sa.Column('created_at', sa.DateTime(), nullable=False),
         sa.Column('updated_at', sa.DateTime(), nullable=False),
         sa.ForeignKeyConstraint(['line_user_id'], ['users.line_user_id'], ),
@@ -0,0 +1,40 @@
+"""Add llm_usage_daily table for per-user daily token accounting
+
+Revision ID: 002
+Revises: 001
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '002'
+down_revision: Union[str, None] = '001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'llm_usage_daily',
+        sa.Column('line_user_id', sa.String(length=100), nullable=False),
+        sa.Column('usage_date', sa.Date(), nullable=False),
+        sa.Column('request_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('completion_tokens', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('reasoning_tokens', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('cached_tokens', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['line_user_id'], ['users.line_user_id'], ),
+        sa.PrimaryKeyConstraint('line_user_id', 'usage_date')
+    )
+    op.create_index(op.f('ix_llm_usage_daily_usage_date'), 'llm_usage_daily', ['usage_date'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_llm_usage_daily_usage_date'), table_name='llm_usage_daily')
+    op.drop_table('llm_usage_daily')
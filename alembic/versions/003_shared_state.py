@@ -0,0 +1,38 @@
+"""Add shared_state table for cross-worker caches, dedup and rate limits
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '003'
+down_revision: Union[str, None] = '002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # PostgreSQL 上建為 UNLOGGED table：不寫 WAL，寫入較快，當機後內容會被清空（狀態都可重建）
+    prefixes = ['UNLOGGED'] if op.get_bind().dialect.name == 'postgresql' else []
+    op.create_table(
+        'shared_state',
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('value', sa.Text(), nullable=True),
+        sa.Column('counter', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('expires_at', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('key'),
+        prefixes=prefixes
+    )
+    op.create_index(op.f('ix_shared_state_expires_at'), 'shared_state', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_shared_state_expires_at'), table_name='shared_state')
+    op.drop_table('shared_state')
@@ -0,0 +1,37 @@
+"""Add push_jobs table for resumable announcement multicasts
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '004'
+down_revision: Union[str, None] = '003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'push_jobs',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('message', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='running'),
+        sa.Column('cursor', sa.String(length=100), nullable=True),
+        sa.Column('recipients_sent', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('recipients_failed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('push_jobs')
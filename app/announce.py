@@ -0,0 +1,64 @@
+"""
+公告推播獨立執行入口（推播給一個頻道的所有使用者）
+
+    python -m app.announce --message "新主題上線：布林通道"
+    python -m app.announce --message-file announcement.txt
+    # 以 LINE_CHANNELS 中的其他頻道送出
+    python -m app.announce --channel brand_a --message "..."
+    # 中斷或當機後，以印出的工作 ID 從上次的進度繼續（--channel 需與原本相同）
+    python -m app.announce --resume <job_id>
+"""
+import argparse
+import sys
+from pathlib import Path
+from loguru import logger
+
+from app.line.channels import DEFAULT_CHANNEL, get_channels
+from app.line.client import get_line_client
+from app.line.push import AnnouncementPusher, create_push_job
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="以 LINE multicast 推播公告給所有使用者")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--message", help="公告內容")
+    source.add_argument("--message-file", type=Path, help="從檔案讀取公告內容（UTF-8）")
+    source.add_argument("--resume", metavar="JOB_ID", help="繼續先前中斷的推播工作")
+    parser.add_argument("--channel", default=DEFAULT_CHANNEL, help="送出公告的 LINE 頻道，只送給這個頻道的使用者（預設 default）")
+    parser.add_argument("--batch-size", type=int, help="每個 multicast 的收件人數（預設 LINE_PUSH_BATCH_SIZE，最多 500）")
+    parser.add_argument("--concurrency", type=int, help="同時送出的請求數（預設 LINE_PUSH_CONCURRENCY）")
+    parser.add_argument("--rate", type=float, help="每秒最多幾個請求（預設 LINE_PUSH_RATE）")
+    args = parser.parse_args()
+
+    if args.channel not in get_channels():
+        logger.error("沒有設定頻道 {}（見 LINE_CHANNELS）", args.channel)
+        return 2
+
+    if args.resume:
+        job_id = args.resume
+    else:
+        message = args.message if args.message is not None else args.message_file.read_text(encoding="utf-8").strip()
+        try:
+            job_id = create_push_job(message)
+        except ValueError as e:
+            logger.error(str(e))
+            return 2
+        logger.info("已建立推播工作 {}（中斷後可用 --resume {} 繼續）", job_id, job_id)
+
+    pusher = AnnouncementPusher(
+        line_client=get_line_client(args.channel),
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        channel=args.channel,
+    )
+    try:
+        report = pusher.run(job_id)
+    except ValueError as e:
+        logger.error(str(e))
+        return 2
+    return 1 if report.recipients_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
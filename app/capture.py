@@ -0,0 +1,160 @@
+"""
+Webhook 流量擷取
+
+設定 WEBHOOK_CAPTURE_DIR 後，POST /webhook/line（以及各頻道的 /webhook/line/{channel}）收到的每個請求都會
+（在背景執行緒）寫入 gzip 壓縮的 JSONL 檔，供 scripts/replay_webhooks.py 重播：
+
+    {"ts": 1767500000.123, "channel": "default", "signature": "...", "status": 200, "latency_ms": 812.4, "body": "..."}
+
+body 中的使用者 / 群組 / 聊天室 ID 會以 HMAC 匿名化（同一個 salt 下同一個使用者對應到同一個假 ID，
+仍可保留「同一個人連續操作」的流量形狀）。檔案達到 WEBHOOK_CAPTURE_ROTATE_RECORDS 筆時輪替，
+每個行程只保留自己最新的 WEBHOOK_CAPTURE_KEEP_FILES 個檔案（檔名帶有 pid；多個 worker 共用目錄時
+不會刪到其他 worker 仍在寫入的檔案，已結束行程留下的檔案需要自行清理）。
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+from loguru import logger
+from app.config import settings
+
+# source 中需要匿名化的欄位與假 ID 前綴（維持 LINE ID 的格式：前綴 + 32 個 hex）
+ANONYMIZED_SOURCE_FIELDS = {"userId": "U", "groupId": "C", "roomId": "R"}
+
+_STOP = object()
+
+
+def anonymize_id(value: str, salt: bytes, prefix: str) -> str:
+    """把 LINE ID 轉成穩定的假 ID"""
+    digest = hmac.new(salt, value.encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"{prefix}{digest[:32]}"
+
+
+def anonymize_body(body: str, salt: bytes) -> str:
+    """匿名化 webhook body 中的 destination 與每個事件的 source"""
+    data = json.loads(body)
+    if data.get("destination"):
+        data["destination"] = anonymize_id(data["destination"], salt, "U")
+    for event in data.get("events", []):
+        source = event.get("source", {})
+        for field, prefix in ANONYMIZED_SOURCE_FIELDS.items():
+            if source.get(field):
+                source[field] = anonymize_id(source[field], salt, prefix)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class WebhookCapture:
+    """在背景執行緒寫入輪替的 gzip JSONL 檔"""
+
+    def __init__(self, directory: str, salt: bytes, rotate_records: int, keep_files: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.salt = salt
+        self.rotate_records = rotate_records
+        self.keep_files = keep_files
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._file = None
+        self._records_in_file = 0
+        self._thread = threading.Thread(target=self._run, name="webhook-capture", daemon=True)
+        self._thread.start()
+
+    def record(self, body: bytes, signature: str, status: int, latency_ms: float, received_at: float, channel: str):
+        """記錄一個請求（只放進 queue，不在請求路徑上做 I/O）"""
+        self._queue.put((received_at, body, signature, status, latency_ms, channel))
+
+    def close(self):
+        """寫完 queue 中剩下的紀錄並關閉檔案"""
+        self._queue.put(_STOP)
+        self._thread.join(timeout=10)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            self._write(item)
+            # 一次寫完目前累積的紀錄後再 flush
+            try:
+                while True:
+                    item = self._queue.get_nowait()
+                    if item is _STOP:
+                        self._close_file()
+                        return
+                    self._write(item)
+            except queue.Empty:
+                pass
+            if self._file is not None:
+                self._file.flush()
+        self._close_file()
+
+    def _write(self, item):
+        received_at, body, signature, status, latency_ms, channel = item
+        try:
+            record = {
+                "ts": round(received_at, 3),
+                "channel": channel,
+                "signature": signature,
+                "status": status,
+                "latency_ms": round(latency_ms, 1),
+                "body": anonymize_body(body.decode("utf-8"), self.salt),
+            }
+        except Exception as e:
+            logger.warning(f"擷取 webhook 失敗（無法解析 body）: {e}")
+            return
+        try:
+            if self._file is None or self._records_in_file >= self.rotate_records:
+                self._rotate()
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._records_in_file += 1
+        except Exception as e:
+            logger.warning(f"寫入 webhook 擷取檔失敗: {e}")
+
+    def _rotate(self):
+        self._close_file()
+        name = f"webhook-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{secrets.token_hex(2)}.jsonl.gz"
+        self._file = gzip.open(self.directory / name, "at", encoding="utf-8")
+        self._records_in_file = 0
+        self._cleanup_old_files()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _cleanup_old_files(self):
+        # 只清理這個行程的檔案，其他 worker 的檔案可能仍在寫入
+        pattern = f"webhook-*-{os.getpid()}-*.jsonl.gz"
+        files = sorted(self.directory.glob(pattern), key=lambda path: path.stat().st_mtime)
+        for path in files[:-self.keep_files]:
+            path.unlink(missing_ok=True)
+
+
+@lru_cache(maxsize=None)
+def get_webhook_capture() -> Optional[WebhookCapture]:
+    """取得 webhook 擷取器（未設定 WEBHOOK_CAPTURE_DIR 時為 None）"""
+    if not settings.webhook_capture_dir:
+        return None
+    salt = settings.webhook_capture_salt.encode("utf-8") or secrets.token_bytes(16)
+    logger.info(f"已啟用 webhook 擷取：{settings.webhook_capture_dir}")
+    return WebhookCapture(
+        settings.webhook_capture_dir,
+        salt,
+        settings.webhook_capture_rotate_records,
+        settings.webhook_capture_keep_files,
+    )
+
+
+def close_webhook_capture():
+    """關閉擷取器（只有曾經建立過時才需要）"""
+    if get_webhook_capture.cache_info().currsize:
+        capture = get_webhook_capture()
+        if capture is not None:
+            capture.close()
@@ -10,10 +10,56 @@ class Settings:
     
     # Database
     database_url: str = os.getenv("DATABASE_URL", "")
+    # 唯讀查詢（對話歷史、使用者設定）改送到 read replica；未設定時全部使用 DATABASE_URL
+    database_read_url: str = os.getenv("DATABASE_READ_URL", "")
+    db_read_sticky_seconds: float = float(os.getenv("DB_READ_STICKY_SECONDS", "5"))  # 使用者寫入後這段時間內的讀取仍送到 primary
+    # 啟動時是否自動執行 migrations（正式環境建議關閉，改用 `python -m app.migrate`）
+    run_migrations_on_startup: bool = os.getenv("RUN_MIGRATIONS_ON_STARTUP", "true").lower() == "true"
+    
+    # Database connection pool（依資料庫 max_connections 與 worker 數量調整）
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "5"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # 秒，-1 表示不回收
+    db_pool_timeout: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # 秒
+    db_pool_pre_ping: str = os.getenv("DB_POOL_PRE_PING", "idle")  # always / idle / never
+    db_pool_pre_ping_idle_seconds: float = float(os.getenv("DB_POOL_PRE_PING_IDLE_SECONDS", "30"))
+    
+    # SQLite 模式（DATABASE_URL=sqlite:///...，單機部署與本機測試）
+    sqlite_journal_mode: str = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+    sqlite_synchronous: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # WAL 下 NORMAL 不會損毀資料庫，只可能遺失最後幾筆交易
+    sqlite_cache_size_kb: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))  # 每條連線的 page cache
+    sqlite_busy_timeout_ms: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))  # 等待其他行程寫入鎖的時間
+    sqlite_serialize_writes: bool = os.getenv("SQLITE_SERIALIZE_WRITES", "true").lower() == "true"  # 行程內的寫入交易排隊
+    
+    # 對話歷史 write-behind（每 N 毫秒或累積 M 筆時批次寫入）
+    chat_history_flush_interval_ms: int = int(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL_MS", "200"))
+    chat_history_flush_max_rows: int = int(os.getenv("CHAT_HISTORY_FLUSH_MAX_ROWS", "200"))
+    chat_history_flush_max_retries: int = int(os.getenv("CHAT_HISTORY_FLUSH_MAX_RETRIES", "5"))  # 一批失敗幾次後拆成兩半（單筆時丟棄）
+    chat_history_buffer_max_rows: int = int(os.getenv("CHAT_HISTORY_BUFFER_MAX_ROWS", "10000"))  # 尚未寫入的訊息上限，超過時丟棄最舊的
+    # 秒，活躍使用者最近對話的快取，0 表示停用；未設定（-1）時單一行程才啟用（600 秒），python -m app.server 多個 worker 時停用
+    chat_context_cache_ttl: float = float(os.getenv("CHAT_CONTEXT_CACHE_TTL", "-1"))
+    chat_context_cache_max_chars: int = int(os.getenv("CHAT_CONTEXT_CACHE_MAX_CHARS", "5000000"))  # 快取對話的總字數上限
+    
+    # 對話歷史保留（背景 retention sweeper 批次刪除舊對話；間隔為 0 時改回每次寫入後清理）
+    chat_history_sweep_interval: float = float(os.getenv("CHAT_HISTORY_SWEEP_INTERVAL", "300"))  # 秒
+    chat_history_keep_last: int = int(os.getenv("CHAT_HISTORY_KEEP_LAST", "4"))  # 每位使用者保留的則數（至少 4 則）
+    chat_history_retention_days: float = float(os.getenv("CHAT_HISTORY_RETENTION_DAYS", "0"))  # 超過天數的對話一律刪除，0 表示不限
+    chat_history_sweep_batch_size: int = int(os.getenv("CHAT_HISTORY_SWEEP_BATCH_SIZE", "1000"))  # 每個 DELETE 最多幾筆
+    chat_history_sweep_pause_ms: int = int(os.getenv("CHAT_HISTORY_SWEEP_PAUSE_MS", "50"))  # 批次之間的間隔
+    chat_history_archive_dir: str = os.getenv("CHAT_HISTORY_ARCHIVE_DIR", "")  # 刪除前先寫入此目錄的 gzip JSONL 檔
+    
+    # 跨 worker 共享狀態（memory：單一 worker；database：存在 DATABASE_URL 的 shared_state 表）
+    # 未設定時 python -m app.server 啟動多個 worker 為 database，其他情況為 memory
+    shared_state_backend: str = os.getenv("SHARED_STATE_BACKEND", "")
+    event_dedup_ttl: float = float(os.getenv("EVENT_DEDUP_TTL", "600"))  # 秒，LINE 重送的事件在此時間內只處理一次；0 表示不去重
     
     # LINE Bot
     line_channel_access_token: str = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "")
     line_channel_secret: str = os.getenv("LINE_CHANNEL_SECRET", "")
+    line_api_base: str = os.getenv("LINE_API_BASE", "https://api.line.me")  # 壓力測試時可指向本機的假 LINE API
+    questions_file: str = os.getenv("QUESTIONS_FILE", "")  # 題庫 YAML，未設定時使用 app/content/questions.yaml
+    line_channels: str = os.getenv("LINE_CHANNELS", "")  # 其他頻道名稱（逗號分隔），各頻道的金鑰見 app/line/channels.py
+    rich_menu_sync_enabled: bool = os.getenv("RICH_MENU_SYNC", "true").lower() == "true"
     
     # LLM
     llm_api_key: str = os.getenv("LLM_API_KEY", "")
@@ -22,10 +68,74 @@ class Settings:
     llm_http_referer: str = os.getenv("LLM_HTTP_REFERER", "")  # OpenRouter 可選：HTTP-Referer header
     llm_x_title: str = os.getenv("LLM_X_TITLE", "Investment Q&A Bot")  # OpenRouter 可選：X-Title header (必須為 ASCII)
     max_tokens: int = int(os.getenv("MAX_TOKENS", "5000"))
+    llm_http2: bool = os.getenv("LLM_HTTP2", "false").lower() == "true"  # 需要安裝 httpx[http2]
+    
+    # LLM tier：簡單的定義型問題改走 fast tier（較快的模型、關閉 reasoning、較小的 max_tokens）
+    llm_tiering_enabled: bool = os.getenv("LLM_TIERING", "true").lower() == "true"
+    llm_fast_model: str = os.getenv("LLM_FAST_MODEL", "")  # 未設定時不分 tier，一律使用 LLM_MODEL
+    llm_fast_max_tokens: int = int(os.getenv("LLM_FAST_MAX_TOKENS", "800"))
+    llm_fast_reasoning: bool = os.getenv("LLM_FAST_REASONING", "false").lower() == "true"
+    
+    # 預先產生回答：SHOW_TOPIC 時在背景先產生該主題問題的回答，ASK_QUESTION 直接使用
+    llm_prefetch_enabled: bool = os.getenv("LLM_PREFETCH", "false").lower() == "true"
+    llm_prefetch_max_inflight: int = int(os.getenv("LLM_PREFETCH_MAX_INFLIGHT", "20"))  # 同時進行的預先產生上限（每個 worker）
+    llm_prefetch_ttl: float = float(os.getenv("LLM_PREFETCH_TTL", "120"))  # 秒，未被使用的回答保留多久
+    
+    # LLM lane：限制同時進行的 LLM 查詢，排隊過久時回覆忙碌訊息（選單等便宜的事件不受影響）
+    llm_lane_concurrency: int = int(os.getenv("LLM_LANE_CONCURRENCY", "32"))  # 每個 worker 同時進行的 LLM 查詢上限，0 表示不限制
+    llm_shed_queue_wait: float = float(os.getenv("LLM_SHED_QUEUE_WAIT", "5"))  # 秒，排隊超過此時間時新的 LLM 查詢直接回覆忙碌，0 表示不回覆
+    
+    # LLM token 用量（記憶體彙總後定期批次寫入 llm_usage_daily）
+    llm_daily_token_budget: int = int(os.getenv("LLM_DAILY_TOKEN_BUDGET", "0"))  # 每位使用者每日 token 上限，0 表示不限制
+    llm_usage_flush_interval: float = float(os.getenv("LLM_USAGE_FLUSH_INTERVAL", "10"))  # 秒
+    usage_timezone: str = os.getenv("USAGE_TIMEZONE", "Asia/Taipei")  # 每日額度的換日時區
+    
+    # 上游連線（LLM / LINE API）預熱：啟動時先建立 keep-alive 連線，之後定期 ping 保持連線
+    upstream_warm_connections: int = int(os.getenv("UPSTREAM_WARM_CONNECTIONS", "2"))  # 每個上游預先建立的連線數，0 表示不預熱
+    upstream_keepwarm_interval: float = float(os.getenv("UPSTREAM_KEEPWARM_INTERVAL", "30"))  # 秒，0 表示不定期 ping
+    upstream_keepalive_expiry: float = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))  # 秒，閒置連線保留的時間
+    upstream_warm_timeout: float = float(os.getenv("UPSTREAM_WARM_TIMEOUT", "3"))  # 秒，每次預熱請求的逾時
+    
+    # 公告推播（python -m app.announce；LINE multicast 每批最多 500 人）
+    line_push_batch_size: int = int(os.getenv("LINE_PUSH_BATCH_SIZE", "500"))
+    line_push_concurrency: int = int(os.getenv("LINE_PUSH_CONCURRENCY", "8"))  # 同時送出的 multicast 請求數
+    line_push_rate: float = float(os.getenv("LINE_PUSH_RATE", "150"))  # 每秒最多幾個 multicast 請求（LINE 上限為 200）
+    line_push_max_retries: int = int(os.getenv("LINE_PUSH_MAX_RETRIES", "5"))  # 429 / 5xx / 連線錯誤的重試次數
+    
+    # Logging
+    log_level: str = os.getenv("LOG_LEVEL", "INFO")
+    log_sample_rates: str = os.getenv("LOG_SAMPLE_RATES", "")  # 例如 DEBUG=0,INFO=0.1（只影響高頻率的 log）
+    log_enqueue: bool = os.getenv("LOG_ENQUEUE", "true").lower() == "true"
+    
+    # Tracing
+    trace_export_path: str = os.getenv("TRACE_EXPORT_PATH", "")  # 設定時以 OTLP JSON lines 寫入此檔案
+    trace_service_name: str = os.getenv("TRACE_SERVICE_NAME", "metabear-linebot")
+    
+    # Webhook 流量擷取（設定目錄後啟用，檔案供 scripts/replay_webhooks.py 重播）
+    webhook_capture_dir: str = os.getenv("WEBHOOK_CAPTURE_DIR", "")
+    webhook_capture_salt: str = os.getenv("WEBHOOK_CAPTURE_SALT", "")  # 未設定時每個行程隨機產生
+    webhook_capture_rotate_records: int = int(os.getenv("WEBHOOK_CAPTURE_ROTATE_RECORDS", "10000"))
+    webhook_capture_keep_files: int = int(os.getenv("WEBHOOK_CAPTURE_KEEP_FILES", "20"))
+    
+    # Admin（/debug/* 端點使用 Authorization: Bearer <ADMIN_TOKEN>；未設定時停用）
+    admin_token: str = os.getenv("ADMIN_TOKEN", "")
     
     # Server
     host: str = os.getenv("HOST", "0.0.0.0")
     port: int = int(os.getenv("PORT", "8000"))
+    
+    # 正式環境啟動設定（python -m app.server）
+    web_workers: int = int(os.getenv("WEB_WORKERS", "2"))
+    # 實際執行的 worker 行程數（不是環境變數：由 app.server 在 fork 之前設定，worker 繼承；其他啟動方式為 1）
+    worker_processes: int = 1
+    web_loop: str = os.getenv("WEB_LOOP", "uvloop")  # uvloop / asyncio / auto
+    web_http: str = os.getenv("WEB_HTTP", "httptools")  # httptools / h11 / auto
+    web_preload: bool = os.getenv("WEB_PRELOAD", "true").lower() == "true"
+    web_graceful_timeout: int = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))  # SIGTERM 後等待處理中請求的秒數
+    web_worker_timeout: int = int(os.getenv("WEB_WORKER_TIMEOUT", "120"))  # worker 無回應多久後重啟
+    web_keepalive: int = int(os.getenv("WEB_KEEPALIVE", "5"))
+    web_max_requests: int = int(os.getenv("WEB_MAX_REQUESTS", "0"))  # 每個 worker 處理幾個請求後重啟，0 表示不重啟
+    web_max_requests_jitter: int = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "0"))
 
 
 settings = Settings()
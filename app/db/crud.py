@@ -1,83 +1,291 @@
-from typing import Optional, List
+from datetime import date, datetime
+from functools import wraps
+from typing import Optional, List, Dict, Iterator
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from app.db.models import User, UserSetting, ChatHistory
+from sqlalchemy import delete, desc, func, select
+from app.db.models import User, UserSetting, ChatHistory, LLMUsageDaily, PushJob
+from app.db.replica import mark_written, read_replica
+from app.line.channels import DEFAULT_CHANNEL, USER_KEY_SEPARATOR
+from app.metrics import DB_QUERY_SECONDS, event_labels, timed
+from app.tracing import span
 
 
+def _timed_crud(func):
+    """記錄每個 crud 呼叫的耗時（metrics label 為函式名稱與目前事件，並記錄 trace span）"""
+    span_name = f"db.{func.__name__}"
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed(DB_QUERY_SECONDS, func.__name__, *event_labels()), span(span_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _first_for_user(db: Session, line_user_id: str, query):
+    """先從 read replica 查詢；replica 上沒有（可能尚未複寫）時再到 primary 查詢"""
+    with read_replica(db, line_user_id) as from_replica:
+        row = query.first()
+    if row is None and from_replica:
+        row = query.first()
+    return row
+
+
+@_timed_crud
 def get_or_create_user(db: Session, line_user_id: str) -> User:
     """取得或建立使用者"""
-    user = db.query(User).filter(User.line_user_id == line_user_id).first()
+    user = _first_for_user(db, line_user_id, db.query(User).filter(User.line_user_id == line_user_id))
     if not user:
         user = User(line_user_id=line_user_id)
         db.add(user)
         db.commit()
+        mark_written([line_user_id])
         db.refresh(user)
     return user
 
 
+@_timed_crud
 def get_or_create_user_setting(db: Session, line_user_id: str) -> UserSetting:
     """取得或建立使用者設定"""
     # 先確保使用者存在
     get_or_create_user(db, line_user_id)
     
-    setting = db.query(UserSetting).filter(UserSetting.line_user_id == line_user_id).first()
+    setting = _first_for_user(db, line_user_id, db.query(UserSetting).filter(UserSetting.line_user_id == line_user_id))
     if not setting:
         setting = UserSetting(line_user_id=line_user_id, llm_enabled=True)
         db.add(setting)
         db.commit()
+        mark_written([line_user_id])
         db.refresh(setting)
     return setting
 
 
+@_timed_crud
 def update_llm_enabled(db: Session, line_user_id: str, enabled: bool) -> UserSetting:
     """更新 LLM 啟用狀態"""
-    setting = get_or_create_user_setting(db, line_user_id)
+    # 寫入路徑直接讀 primary（replica 上的設定可能還是舊的）
+    get_or_create_user(db, line_user_id)
+    setting = db.query(UserSetting).filter(UserSetting.line_user_id == line_user_id).first()
+    if not setting:
+        setting = UserSetting(line_user_id=line_user_id)
+        db.add(setting)
     setting.llm_enabled = enabled
     db.commit()
+    mark_written([line_user_id])
     db.refresh(setting)
     return setting
 
 
-def add_chat_history(db: Session, line_user_id: str, role: str, text: str) -> ChatHistory:
-    """新增對話歷史"""
-    # 先確保使用者存在
-    get_or_create_user(db, line_user_id)
-    
-    history = ChatHistory(
-        line_user_id=line_user_id,
-        role=role,
-        text=text
-    )
-    db.add(history)
+@_timed_crud
+def get_recent_chat_history(db: Session, line_user_id: str, limit: int = 4) -> List[ChatHistory]:
+    """取得最近的對話歷史（最多 4 則，維持 2 輪對話）"""
+    with read_replica(db, line_user_id):
+        rows = (
+            db.query(ChatHistory)
+            .filter(ChatHistory.line_user_id == line_user_id)
+            .order_by(desc(ChatHistory.created_at))
+            .limit(limit)
+            .all()
+        )
+    return rows[::-1]  # 反轉順序，從舊到新
+
+
+@_timed_crud
+def bulk_add_chat_history(db: Session, rows: List[dict]):
+    """批次新增對話歷史（單一 multi-row INSERT，每筆 row 需包含 line_user_id、role、text、created_at）"""
+    if not rows:
+        return
+    db.execute(ChatHistory.__table__.insert().values(rows))
     db.commit()
-    db.refresh(history)
-    return history
+    mark_written({row["line_user_id"] for row in rows})
 
 
-def get_recent_chat_history(db: Session, line_user_id: str, limit: int = 4) -> List[ChatHistory]:
-    """取得最近的對話歷史（最多 4 則，維持 2 輪對話）"""
+def _ranked_chat_history(line_user_ids: List[str], *columns):
+    """這些使用者的對話，rank 為由新到舊的名次（1 為最新）"""
     return (
-        db.query(ChatHistory)
-        .filter(ChatHistory.line_user_id == line_user_id)
-        .order_by(desc(ChatHistory.created_at))
+        select(
+            *columns,
+            func.row_number().over(
+                partition_by=ChatHistory.line_user_id,
+                order_by=(desc(ChatHistory.created_at), desc(ChatHistory.id)),
+            ).label("rank"),
+        )
+        .where(ChatHistory.line_user_id.in_(line_user_ids))
+        .subquery()
+    )
+
+
+@_timed_crud
+def trim_chat_history(db: Session, line_user_ids: List[str], keep_last: int = 4):
+    """批次清理多位使用者的舊對話歷史，每人保留最近 N 則（單一 DELETE）"""
+    if not line_user_ids:
+        return
+    ranked = _ranked_chat_history(line_user_ids, ChatHistory.id)
+    db.execute(
+        delete(ChatHistory)
+        .where(ChatHistory.id.in_(select(ranked.c.id).where(ranked.c.rank > keep_last)))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    mark_written(line_user_ids)
+
+
+def _chat_history_columns(with_text: bool) -> list:
+    columns = [ChatHistory.id, ChatHistory.line_user_id, ChatHistory.created_at]
+    if with_text:
+        columns += [ChatHistory.role, ChatHistory.text]
+    return columns
+
+
+@_timed_crud
+def get_chat_history_user_ids(
+    db: Session,
+    limit: int,
+    after: Optional[str] = None,
+    since: Optional[datetime] = None
+) -> List[str]:
+    """依 line_user_id 排序取出有對話歷史的使用者（after 之後，不含 after；since 表示只要這之後有新對話的）"""
+    stmt = select(ChatHistory.line_user_id).distinct().order_by(ChatHistory.line_user_id).limit(limit)
+    if after is not None:
+        stmt = stmt.where(ChatHistory.line_user_id > after)
+    if since is not None:
+        stmt = stmt.where(ChatHistory.created_at >= since)
+    return list(db.execute(stmt).scalars())
+
+
+@_timed_crud
+def get_excess_chat_history(
+    db: Session,
+    line_user_ids: List[str],
+    keep_last: int,
+    limit: int,
+    with_text: bool = False
+) -> list:
+    """這些使用者最近 keep_last 則以外的舊對話（最多 limit 筆；with_text 時包含 role、text 供封存）"""
+    ranked = _ranked_chat_history(line_user_ids, *_chat_history_columns(with_text))
+    columns = [column for column in ranked.c if column.name != "rank"]
+    return db.execute(select(*columns).where(ranked.c.rank > keep_last).limit(limit)).all()
+
+
+@_timed_crud
+def get_expired_chat_history(db: Session, before: datetime, limit: int, with_text: bool = False) -> list:
+    """早於 before 的對話，由舊到新（最多 limit 筆；with_text 時包含 role、text 供封存）"""
+    stmt = (
+        select(*_chat_history_columns(with_text))
+        .where(ChatHistory.created_at < before)
+        .order_by(ChatHistory.created_at)
         .limit(limit)
-        .all()
-    )[::-1]  # 反轉順序，從舊到新
+    )
+    return db.execute(stmt).all()
+
 
+@_timed_crud
+def delete_chat_history(db: Session, ids: List[int]) -> int:
+    """依 id 刪除對話歷史（單一 DELETE），回傳刪除的筆數"""
+    if not ids:
+        return 0
+    result = db.execute(
+        delete(ChatHistory).where(ChatHistory.id.in_(ids)).execution_options(synchronize_session=False)
+    )
+    db.commit()
+    # 刪除的都是舊對話，replica 晚一點才刪除也不影響回答，不需要 mark_written
+    return result.rowcount
 
-def clear_old_chat_history(db: Session, line_user_id: str, keep_last: int = 4):
-    """清理舊的對話歷史，保留最近 N 則"""
-    # 取得所有對話，從新到舊排序
-    all_chats = (
-        db.query(ChatHistory)
-        .filter(ChatHistory.line_user_id == line_user_id)
-        .order_by(desc(ChatHistory.created_at))
+
+LLM_USAGE_COUNTERS = ("request_count", "prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens")
+
+
+def _insert_for(db: Session):
+    """依資料庫方言取得支援 ON CONFLICT 的 insert()"""
+    if db.get_bind().dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert
+
+
+@_timed_crud
+def get_llm_usage_totals(db: Session, usage_date: date) -> Dict[str, int]:
+    """取得指定日期每位使用者已用的 token 總數（prompt + completion）"""
+    rows = (
+        db.query(LLMUsageDaily.line_user_id, LLMUsageDaily.prompt_tokens, LLMUsageDaily.completion_tokens)
+        .filter(LLMUsageDaily.usage_date == usage_date)
         .all()
     )
+    return {user_id: prompt + completion for user_id, prompt, completion in rows}
+
+
+@_timed_crud
+def upsert_llm_usage(db: Session, rows: List[dict]):
+    """
+    批次累加 token 用量（單一 INSERT ... ON CONFLICT DO UPDATE）
     
-    # 刪除超過保留數量的對話
-    if len(all_chats) > keep_last:
-        for chat in all_chats[keep_last:]:
-            db.delete(chat)
-        db.commit()
+    每筆 row 需包含 line_user_id、usage_date 與 LLM_USAGE_COUNTERS 的各欄位（為增量）
+    """
+    if not rows:
+        return
+    now = datetime.utcnow()
+    # 使用者在呼叫 LLM 前已由 get_or_create_user_setting 建立，外鍵一定存在
+    # 依主鍵排序，多個 worker 同時寫入時以相同順序取得 row lock，避免 deadlock
+    rows = sorted(rows, key=lambda row: (row["line_user_id"], row["usage_date"]))
+    insert = _insert_for(db)
+    stmt = insert(LLMUsageDaily).values([{**row, "updated_at": now} for row in rows])
+    table = LLMUsageDaily.__table__
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["line_user_id", "usage_date"],
+        set_={
+            **{name: table.c[name] + stmt.excluded[name] for name in LLM_USAGE_COUNTERS},
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    db.execute(stmt)
+    db.commit()
+
+
+def iter_user_id_batches(
+    db: Session, batch_size: int, after: Optional[str] = None, channel: str = DEFAULT_CHANNEL
+) -> Iterator[List[str]]:
+    """
+    依 line_user_id 排序逐批取出 channel 頻道的使用者 key（after 之後，不含 after）
+    
+    以 server-side cursor 串流（PostgreSQL 為 named cursor），不會一次載入所有使用者；
+    串流期間 db 的交易保持開啟，不要在同一個 session 上 commit。
+    """
+    stmt = select(User.line_user_id).order_by(User.line_user_id)
+    if channel == DEFAULT_CHANNEL:
+        stmt = stmt.where(User.line_user_id.notlike(f"%{USER_KEY_SEPARATOR}%"))
+    else:
+        # 以 LIKE 前綴比對（不用字串範圍：非 C collation 下「;」不一定排在「:」之後）；
+        # 頻道名稱中的底線需跳脫；ORDER BY 與 after 都使用同一個 collation，cursor 仍然一致
+        stmt = stmt.where(User.line_user_id.startswith(f"{channel}{USER_KEY_SEPARATOR}", autoescape=True))
+    if after is not None:
+        stmt = stmt.where(User.line_user_id > after)
+    result = db.execute(stmt.execution_options(yield_per=batch_size))
+    for partition in result.scalars().partitions(batch_size):
+        yield list(partition)
+
 
+@_timed_crud
+def create_push_job(db: Session, job_id: str, message: str) -> PushJob:
+    """建立公告推播工作"""
+    job = PushJob(id=job_id, message=message)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+@_timed_crud
+def get_push_job(db: Session, job_id: str) -> Optional[PushJob]:
+    """取得公告推播工作"""
+    return db.get(PushJob, job_id)
+
+
+@_timed_crud
+def update_push_job(db: Session, job_id: str, **values):
+    """更新推播進度（cursor、recipients_sent、recipients_failed、status）"""
+    db.execute(
+        PushJob.__table__.update()
+        .where(PushJob.id == job_id)
+        .values(**values, updated_at=datetime.utcnow())
+    )
+    db.commit()
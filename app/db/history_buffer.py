@@ -0,0 +1,328 @@
+"""
+對話歷史 write-behind buffer
+
+回覆使用者前不再同步寫入 chat_history：新訊息先放進記憶體，由背景 task 每
+CHAT_HISTORY_FLUSH_INTERVAL_MS 毫秒（或累積 CHAT_HISTORY_FLUSH_MAX_ROWS 筆時提早）以一個
+multi-row INSERT 寫入。舊對話預設由背景的 retention sweeper（app/db/retention.py）批次清理；
+停用 sweeper（CHAT_HISTORY_SWEEP_INTERVAL=0）時改為每次寫入後以一個 DELETE 清理這批使用者的舊對話。
+
+尚未寫入的訊息會併入同一位使用者的下一次歷史查詢，對話不會因為延遲寫入而斷掉。
+應用程式關閉時（lifespan）會寫入剩餘的訊息；行程異常終止時最多遺失一個 flush 間隔內的對話。
+
+寫入失敗的批次以指數退避重試（最多 CHAT_HISTORY_FLUSH_MAX_RETRIES 次，退避期間暫停寫入新的批次）；
+仍然失敗時拆成兩半各自重試，單獨一筆也失敗時丟棄，一筆有問題的資料不會讓所有對話都寫不進去。
+尚未寫入的訊息超過 CHAT_HISTORY_BUFFER_MAX_ROWS 筆時，從最舊的失敗批次開始丟棄（資料庫長時間無法寫入時限制記憶體用量）。
+丟棄的則數見 linebot_chat_history_dropped_total。
+
+另外以 LRU 保留活躍使用者最近的 KEEP_LAST 則對話（第一次查詢時從資料庫載入，之後每一輪由 add() 更新），
+進行中的對話不需要任何 SELECT。閒置超過 CHAT_CONTEXT_CACHE_TTL 秒的使用者會被移除，
+所有快取對話的總字數超過 CHAT_CONTEXT_CACHE_MAX_CHARS 時移除最久未使用的使用者。
+快取只在行程內有效：多個 worker 時同一位使用者的訊息可能交給不同 worker，TTL 內可能看不到
+其他 worker 處理的那幾輪對話，因此沒有設定 CHAT_CONTEXT_CACHE_TTL 時只在單一行程時啟用
+（app.server 在 fork 之前設定 settings.worker_processes）。
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+from loguru import logger
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.db import crud
+from app.db.session import create_session
+from app.metrics import CHAT_HISTORY_DROPPED_TOTAL, child, record_cache, record_error
+
+# 每位使用者保留的對話則數（2 輪對話）
+KEEP_LAST = 4
+
+# 單一 worker 時最近對話快取的預設 TTL（秒）
+DEFAULT_CACHE_TTL = 600.0
+
+# 寫入失敗後重試的最長退避時間（秒）
+RETRY_BACKOFF_MAX = 30.0
+
+
+class ChatMessage(NamedTuple):
+    """尚未寫入資料庫的對話（欄位與 ChatHistory 相同，可直接交給 build_user_message）"""
+    line_user_id: str
+    role: str
+    text: str
+    created_at: datetime
+
+
+class _Context:
+    """一位使用者快取中的最近對話"""
+    __slots__ = ("messages", "chars", "last_used")
+
+    def __init__(self, messages: List[ChatMessage], now: float):
+        self.messages = messages
+        self.chars = sum(len(message.text) for message in messages)
+        self.last_used = now
+
+
+class ChatHistoryBuffer:
+    """對話歷史的 write-behind buffer（含活躍使用者的最近對話快取）"""
+
+    def __init__(
+        self,
+        flush_interval_ms: int,
+        flush_max_rows: int,
+        keep_last: int = KEEP_LAST,
+        cache_ttl: float = 0.0,
+        cache_max_chars: int = 0,
+        trim_keep_last: Optional[int] = None,
+        max_retries: int = 5,
+        max_pending_rows: int = 10000,
+    ):
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_rows = max(1, flush_max_rows)
+        self.max_retries = max(1, max_retries)
+        self.max_pending_rows = max(self.flush_max_rows, max_pending_rows)
+        self.keep_last = keep_last
+        self.cache_ttl = cache_ttl
+        self.cache_max_chars = cache_max_chars
+        # 寫入後每人保留幾則（None 表示不在寫入路徑清理，交給 retention sweeper）
+        self.trim_keep_last = trim_keep_last
+        # line_user_id -> 最近 keep_last 則對話，依最近使用排序（最舊的在前）
+        self._contexts: OrderedDict[str, _Context] = OrderedDict()
+        self._cached_chars = 0
+        # 依加入順序排列、尚未寫入的訊息
+        self._queue: List[ChatMessage] = []
+        # 寫入失敗、等待重試的批次與已失敗次數（最舊的在前）
+        self._failed: Deque[Tuple[List[ChatMessage], int]] = deque()
+        self._retry_at = 0.0
+        # 每位使用者尚未確認寫入的訊息（包含正在寫入中與等待重試的批次），供查詢時合併
+        self._unflushed: Dict[str, List[ChatMessage]] = {}
+        self._pending_rows = 0
+        self._last_created_at = datetime.min
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def add(self, line_user_id: str, role: str, text: str) -> ChatMessage:
+        """加入一則對話（不碰資料庫）"""
+        # created_at 嚴格遞增，同一批寫入的 user / assistant 訊息排序才不會相同
+        created_at = max(datetime.utcnow(), self._last_created_at + timedelta(microseconds=1))
+        self._last_created_at = created_at
+        message = ChatMessage(line_user_id, role, text, created_at)
+        self._queue.append(message)
+        self._unflushed.setdefault(line_user_id, []).append(message)
+        self._pending_rows += 1
+        if self._pending_rows > self.max_pending_rows:
+            self._drop_oldest()
+        if len(self._queue) >= self.flush_max_rows and self._wake is not None:
+            self._wake.set()
+        context = self._contexts.get(line_user_id)
+        if context is not None:
+            # 已快取的使用者直接更新（write-through）；未快取的在下次查詢時載入
+            self._store(line_user_id, (context.messages + [message])[-self.keep_last:])
+        return message
+
+    @property
+    def cache_enabled(self) -> bool:
+        return self.cache_ttl > 0 and self.cache_max_chars > 0
+
+    def _cached(self, line_user_id: str, now: float) -> Optional[_Context]:
+        context = self._contexts.get(line_user_id)
+        if context is None:
+            return None
+        if now - context.last_used > self.cache_ttl:
+            self._drop(line_user_id)
+            return None
+        context.last_used = now
+        self._contexts.move_to_end(line_user_id)
+        return context
+
+    def _drop(self, line_user_id: str):
+        context = self._contexts.pop(line_user_id)
+        self._cached_chars -= context.chars
+
+    def _store(self, line_user_id: str, messages: List[ChatMessage]):
+        """快取這位使用者的最近對話，並移除閒置或超出字數上限的使用者"""
+        now = time.monotonic()
+        if line_user_id in self._contexts:
+            self._drop(line_user_id)
+        context = _Context(messages, now)
+        self._contexts[line_user_id] = context
+        self._cached_chars += context.chars
+        # 依最近使用排序，閒置最久的使用者在最前面
+        while self._contexts:
+            oldest_id, oldest = next(iter(self._contexts.items()))
+            if oldest_id == line_user_id:
+                break
+            if now - oldest.last_used <= self.cache_ttl and self._cached_chars <= self.cache_max_chars:
+                break
+            self._drop(oldest_id)
+
+    def get_recent(self, db: Session, line_user_id: str, limit: int = KEEP_LAST) -> list:
+        """取得最近的對話歷史（從舊到新），尚未寫入的訊息會一併列入"""
+        use_cache = self.cache_enabled and limit <= self.keep_last
+        if use_cache:
+            context = self._cached(line_user_id, time.monotonic())
+            record_cache("chat_history", context is not None)
+            if context is not None:
+                return context.messages[-limit:]
+        merged = self._load(db, line_user_id, self.keep_last if use_cache else limit)
+        if use_cache:
+            self._store(line_user_id, merged)
+        return merged[-limit:]
+
+    def _load(self, db: Session, line_user_id: str, limit: int) -> List[ChatMessage]:
+        """從資料庫讀取最近的對話，併入尚未寫入的訊息"""
+        pending = self._unflushed.get(line_user_id)
+        if pending and len(pending) >= limit:
+            # 最新的 N 則都還在 buffer 中，不需要查資料庫
+            return pending[-limit:]
+        rows = crud.get_recent_chat_history(db, line_user_id, limit=limit)
+        # 轉成 ChatMessage，快取的內容不會綁定到這次的 session
+        merged = [ChatMessage(row.line_user_id, row.role, row.text, row.created_at) for row in rows]
+        if pending:
+            # 寫入中的批次可能已經 commit，依 (created_at, role) 去除重複
+            seen = {(message.created_at, message.role) for message in merged}
+            merged += [m for m in pending if (m.created_at, m.role) not in seen]
+            merged.sort(key=lambda m: m.created_at)
+        return merged[-limit:]
+
+    def _write(self, batch: List[ChatMessage]):
+        """寫入一個批次（未使用 retention sweeper 時一併清理舊對話；在執行緒中執行）"""
+        db = create_session()
+        try:
+            crud.bulk_add_chat_history(db, [message._asdict() for message in batch])
+            if self.trim_keep_last is None:
+                return
+            try:
+                crud.trim_chat_history(db, sorted({m.line_user_id for m in batch}), keep_last=self.trim_keep_last)
+            except Exception as e:
+                # 訊息已寫入，清理失敗不重送（下一批寫入同一位使用者時會再清理）
+                db.rollback()
+                logger.warning("清理舊對話歷史失敗: {}", e)
+                record_error("chat_history_trim", type(e).__name__)
+        finally:
+            db.close()
+
+    def _forget(self, batch: List[ChatMessage]):
+        """已寫入（或丟棄）的訊息不再併入查詢"""
+        for message in batch:
+            pending = self._unflushed.get(message.line_user_id)
+            if pending:
+                pending.remove(message)
+                if not pending:
+                    del self._unflushed[message.line_user_id]
+        self._pending_rows -= len(batch)
+
+    def _discard(self, batch: List[ChatMessage], reason: str):
+        self._forget(batch)
+        child(CHAT_HISTORY_DROPPED_TOTAL, reason).inc(len(batch))
+
+    def _drop_oldest(self):
+        """尚未寫入的訊息超過上限：丟棄最舊的失敗批次（沒有時丟棄佇列中最舊的訊息）"""
+        # 寫入中的批次不在佇列中，不能丟棄
+        while self._pending_rows > self.max_pending_rows and (self._failed or self._queue):
+            if self._failed:
+                batch, _ = self._failed.popleft()
+            else:
+                batch, self._queue = self._queue[:1], self._queue[1:]
+            logger.error("尚未寫入的對話超過 {} 則，丟棄最舊的 {} 則", self.max_pending_rows, len(batch))
+            self._discard(batch, "overflow")
+
+    async def _write_batch(self, batch: List[ChatMessage], attempts: int) -> bool:
+        """寫入一個批次，回傳是否成功（失敗時排入重試、拆成兩半或丟棄）"""
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            attempts += 1
+            record_error("chat_history_flush", type(e).__name__)
+            if attempts < self.max_retries:
+                logger.warning("寫入對話歷史失敗（{} 筆，第 {} 次，稍後重試）: {}", len(batch), attempts, e)
+                self._failed.append((batch, attempts))
+            elif len(batch) > 1:
+                half = len(batch) // 2
+                logger.error("寫入對話歷史失敗 {} 次（{} 筆），拆成兩批重試: {}", attempts, len(batch), e)
+                self._failed.extend([(batch[:half], 0), (batch[half:], 0)])
+            else:
+                logger.error("寫入對話歷史失敗 {} 次，丟棄這則對話（{}）: {}", attempts, batch[0].line_user_id, e)
+                self._discard(batch, "write_failed")
+                return False
+            self._retry_at = time.monotonic() + min(self.flush_interval * 2 ** attempts, RETRY_BACKOFF_MAX)
+            return False
+        self._forget(batch)
+        return True
+
+    async def flush(self, final: bool = False):
+        """
+        寫入目前累積的訊息（每批最多 flush_max_rows 筆）
+
+        有失敗的批次時，退避時間到了才先重試最舊的一批，成功後才繼續寫入新的批次；
+        final（應用程式關閉）時不等待退避，每一批都再試一次，仍失敗的丟棄。
+        """
+        if self._failed and not final:
+            if time.monotonic() < self._retry_at:
+                return
+            batch, attempts = self._failed.popleft()
+            if not await self._write_batch(batch, attempts):
+                return
+        if final:
+            failed, self._failed = self._failed, deque()
+            for batch, attempts in failed:
+                await self._write_batch(batch, attempts)
+        while self._queue and (final or not self._failed):
+            batch, self._queue = self._queue[:self.flush_max_rows], self._queue[self.flush_max_rows:]
+            await self._write_batch(batch, 0)
+        if final and self._failed:
+            lost = sum(len(batch) for batch, _ in self._failed)
+            logger.error("應用程式關閉時仍有 {} 則對話無法寫入，已丟棄", lost)
+            for batch, _ in self._failed:
+                self._discard(batch, "shutdown")
+            self._failed.clear()
+
+    async def _run(self):
+        """背景定期 flush（累積到 flush_max_rows 筆時提早）"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stopping:
+                break
+            await self.flush()
+
+    def start(self):
+        """啟動背景 flush task（在 lifespan 中呼叫）"""
+        if self._task is None:
+            self._stopping = False
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止背景 task 並寫入剩餘的訊息（等待寫入中的批次完成，不取消，批次才不會遺失）"""
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+            self._wake = None
+        await self.flush(final=True)
+
+
+def _context_cache_ttl() -> float:
+    """最近對話快取的 TTL（沒有設定時多個 worker 停用，避免讀到其他 worker 更新前的對話）"""
+    if settings.chat_context_cache_ttl >= 0:
+        return settings.chat_context_cache_ttl
+    return DEFAULT_CACHE_TTL if settings.worker_processes <= 1 else 0.0
+
+
+@lru_cache(maxsize=None)
+def get_history_buffer() -> ChatHistoryBuffer:
+    """取得全域對話歷史 buffer"""
+    return ChatHistoryBuffer(
+        settings.chat_history_flush_interval_ms,
+        settings.chat_history_flush_max_rows,
+        cache_ttl=_context_cache_ttl(),
+        cache_max_chars=settings.chat_context_cache_max_chars,
+        trim_keep_last=None if settings.chat_history_sweep_interval > 0 else max(settings.chat_history_keep_last, KEEP_LAST),
+        max_retries=settings.chat_history_flush_max_retries,
+        max_pending_rows=settings.chat_history_buffer_max_rows,
+    )
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, Text, Integer
+from sqlalchemy import Column, String, Boolean, Date, DateTime, ForeignKey, Text, Integer, BigInteger, Float
 from sqlalchemy.orm import relationship
 from app.db.session import Base
 
@@ -42,3 +42,40 @@ class ChatHistory(Base):
     # Relationships
     user = relationship("User", back_populates="chat_history")
 
+
+class LLMUsageDaily(Base):
+    """每位使用者每日的 LLM token 用量（由記憶體彙總後批次寫入）"""
+    __tablename__ = "llm_usage_daily"
+    
+    line_user_id = Column(String(100), ForeignKey("users.line_user_id"), primary_key=True)
+    usage_date = Column(Date, primary_key=True)
+    request_count = Column(Integer, default=0, nullable=False)
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    completion_tokens = Column(Integer, default=0, nullable=False)
+    reasoning_tokens = Column(Integer, default=0, nullable=False)
+    cached_tokens = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class SharedStateEntry(Base):
+    """跨 worker 共享狀態（app.state.DatabaseState；PostgreSQL 上由 migration 建為 UNLOGGED table）"""
+    __tablename__ = "shared_state"
+    
+    key = Column(String(255), primary_key=True)
+    value = Column(Text, nullable=True)
+    counter = Column(BigInteger, default=0, nullable=False)
+    expires_at = Column(Float, nullable=True, index=True)  # epoch 秒，NULL 表示不過期
+
+
+class PushJob(Base):
+    """公告推播工作（app/line/push.py；cursor 為已完成的最後一位使用者，當機後從這裡繼續）"""
+    __tablename__ = "push_jobs"
+    
+    id = Column(String(36), primary_key=True)  # UUID，也用來產生每批的 X-Line-Retry-Key
+    message = Column(Text, nullable=False)
+    status = Column(String(20), default="running", nullable=False)  # 'running' or 'completed'
+    cursor = Column(String(100), nullable=True)  # 依 line_user_id 排序，這個 ID（含）以前都已送出
+    recipients_sent = Column(Integer, default=0, nullable=False)
+    recipients_failed = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
@@ -0,0 +1,177 @@
+"""
+PostgreSQL 上以月份分割（RANGE partition）的 chat_history
+
+chat_history 只會新增與刪除，資料量大時逐筆 DELETE 舊對話要維護每一列的索引、產生大量 WAL 與 dead tuple。
+改為以 created_at 每月一個 partition（chat_history_p202610）後，超過 CHAT_HISTORY_RETENTION_DAYS 的整個月份
+直接 DROP，幾乎沒有成本。
+
+- convert_chat_history()：把既有的 chat_history 轉為 partitioned table（python -m app.sweep --convert-partitions）
+- ensure_partitions()：建立本月起 PARTITION_MONTHS_AHEAD 個月的 partition（retention sweeper 每次執行時呼叫）
+
+partition 的主鍵為 (id, created_at)（PostgreSQL 要求主鍵包含 partition key），id 仍由原本的 sequence 產生。
+沒有對應 partition 的月份無法寫入，轉換後請保持 retention sweeper 啟用（或定期執行 python -m app.sweep）。
+SQLite 不支援 partition，這裡的函式在非 PostgreSQL 上都不做任何事。
+"""
+import re
+from datetime import date, datetime
+from typing import List, NamedTuple, Optional
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+TABLE = "chat_history"
+
+# 預先建立的 partition 月數（含本月）
+PARTITION_MONTHS_AHEAD = 3
+
+PARTITION_NAME_PATTERN = re.compile(rf"^{TABLE}_p(\d{{4}})(\d{{2}})$")
+
+
+class Partition(NamedTuple):
+    """一個月份的 partition（start 含、end 不含）"""
+    name: str
+    start: date
+    end: date
+
+
+def _month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _next_month(value: date) -> date:
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def partition_for(month: date) -> Partition:
+    """取得 month 所在月份的 partition"""
+    start = _month_start(month)
+    return Partition(f"{TABLE}_p{start:%Y%m}", start, _next_month(start))
+
+
+def is_partitioned(conn: Connection) -> bool:
+    """chat_history 是否已是 partitioned table（非 PostgreSQL 一律為 False）"""
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"),
+        {"table": TABLE},
+    ).scalar()
+
+
+def list_partitions(conn: Connection) -> List[Partition]:
+    """目前的月份 partition，由舊到新（名稱不符合 chat_history_pYYYYMM 的略過）"""
+    names = conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:table AS regclass)"
+        ),
+        {"table": TABLE},
+    ).scalars()
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME_PATTERN.match(name)
+        if match:
+            partitions.append(partition_for(date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def _create_partition(conn: Connection, partition: Partition):
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {partition.name} PARTITION OF {TABLE} "
+            f"FOR VALUES FROM ('{partition.start.isoformat()}') TO ('{partition.end.isoformat()}')"
+        )
+    )
+
+
+def ensure_partitions(engine: Engine, months_ahead: int = PARTITION_MONTHS_AHEAD, today: Optional[date] = None) -> List[str]:
+    """建立本月起 months_ahead 個月還不存在的 partition，回傳新建立的名稱（未分割時不做任何事）"""
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return []
+        existing = {partition.name for partition in list_partitions(conn)}
+        month = _month_start(today or datetime.utcnow().date())
+        created = []
+        for _ in range(months_ahead):
+            partition = partition_for(month)
+            if partition.name not in existing:
+                _create_partition(conn, partition)
+                created.append(partition.name)
+            month = partition.end
+    if created:
+        logger.info("已建立 chat_history partition: {}", ", ".join(created))
+    return created
+
+
+def expired_partitions(engine: Engine, before: datetime) -> List[Partition]:
+    """整個月份都早於 before 的 partition（未分割時為空）"""
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            return []
+        return [partition for partition in list_partitions(conn) if partition.end <= before.date()]
+
+
+def drop_partition(engine: Engine, partition: Partition):
+    """先 DETACH 再 DROP 一個 partition（DETACH 後的資料不會再被查詢到）"""
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {partition.name}"))
+        conn.execute(text(f"DROP TABLE {partition.name}"))
+    logger.info("已刪除 chat_history partition {}（{} 之前）", partition.name, partition.end)
+
+
+def convert_chat_history(engine: Engine, months_ahead: int = PARTITION_MONTHS_AHEAD) -> bool:
+    """
+    把 chat_history 轉為以月份分割的 partitioned table，回傳是否有轉換（已轉換過時為 False）
+
+    在單一交易中完成：鎖定原本的表、建立新表與 partition、複製資料後刪除原本的表。
+    複製期間 chat_history 無法寫入（write-behind buffer 會在失敗後重試），資料量大時請在離峰時間執行。
+    """
+    with engine.begin() as conn:
+        if conn.dialect.name != "postgresql":
+            raise ValueError("只有 PostgreSQL 支援 partitioned chat_history")
+        if is_partitioned(conn):
+            return False
+        conn.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+        first = conn.execute(text(f"SELECT min(created_at) FROM {TABLE}")).scalar()
+
+        # 主鍵與索引的名稱在 schema 內不可重複，先把原本的表與索引改名
+        conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned"))
+        conn.execute(text(f"ALTER INDEX {TABLE}_pkey RENAME TO {TABLE}_unpartitioned_pkey"))
+        for column in ("line_user_id", "created_at"):
+            conn.execute(text(f"ALTER INDEX IF EXISTS ix_{TABLE}_{column} RENAME TO ix_{TABLE}_unpartitioned_{column}"))
+
+        conn.execute(
+            text(
+                f"CREATE TABLE {TABLE} ("
+                f"id INTEGER NOT NULL DEFAULT nextval('{TABLE}_id_seq'), "
+                "line_user_id VARCHAR(100) NOT NULL REFERENCES users (line_user_id), "
+                "role VARCHAR(20) NOT NULL, "
+                "text TEXT NOT NULL, "
+                "created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+                "PRIMARY KEY (id, created_at)"
+                ") PARTITION BY RANGE (created_at)"
+            )
+        )
+        # sequence 改由新表擁有，刪除原本的表時才不會一起被刪除
+        conn.execute(text(f"ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id"))
+        conn.execute(text(f"CREATE INDEX ix_{TABLE}_line_user_id ON {TABLE} (line_user_id)"))
+        conn.execute(text(f"CREATE INDEX ix_{TABLE}_created_at ON {TABLE} (created_at)"))
+
+        month = _month_start(first.date() if first else datetime.utcnow().date())
+        last = partition_for(datetime.utcnow().date())
+        for _ in range(months_ahead - 1):
+            last = partition_for(last.end)
+        while month < last.end:
+            partition = partition_for(month)
+            _create_partition(conn, partition)
+            month = partition.end
+
+        copied = conn.execute(
+            text(
+                f"INSERT INTO {TABLE} (id, line_user_id, role, text, created_at) "
+                f"SELECT id, line_user_id, role, text, created_at FROM {TABLE}_unpartitioned"
+            )
+        ).rowcount
+        conn.execute(text(f"DROP TABLE {TABLE}_unpartitioned"))
+    logger.info("chat_history 已轉為以月份分割（複製 {} 筆，partition 至 {}）", copied, last.name)
+    return True
@@ -0,0 +1,98 @@
+"""
+資料庫連線池設定與監控
+
+- InstrumentedQueuePool：記錄取得連線的等待時間
+- DBPoolCollector：在 /metrics 被讀取時回報各連線池的使用中 / overflow 數量（多個 worker 時為回應該次請求的 worker）
+- pre-ping 策略：always（每次 checkout 都 ping）、idle（閒置超過門檻才 ping）、never
+"""
+import time
+import weakref
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool
+from app.metrics import DB_POOL_CHECKOUT_WAIT, DB_STATEMENTS_TOTAL, child, register_process_collector
+
+PRE_PING_STRATEGIES = ("always", "idle", "never")
+
+# 所有仍存在的連線池（dispose/recreate 後舊的會自動消失）
+_pools = weakref.WeakSet()
+
+
+def pool_name(pool) -> str:
+    """連線池名稱（create_engine 的 pool_logging_name）"""
+    return getattr(pool, "logging_name", None) or "default"
+
+
+class InstrumentedQueuePool(QueuePool):
+    """會記錄 checkout 等待時間的 QueuePool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            child(DB_POOL_CHECKOUT_WAIT, pool_name(self)).observe(time.perf_counter() - start)
+
+
+def install_idle_pre_ping(engine: Engine, idle_seconds: float):
+    """只在連線閒置超過 idle_seconds 時才 ping，避免每次 checkout 都多一次 round-trip"""
+
+    @event.listens_for(engine, "checkin")
+    def _record_checkin(dbapi_connection, connection_record):
+        connection_record.info["last_checkin"] = time.monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def _ping_if_idle(dbapi_connection, connection_record, connection_proxy):
+        last_checkin = connection_record.info.get("last_checkin")
+        if last_checkin is None or time.monotonic() - last_checkin < idle_seconds:
+            return
+
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except Exception as e:
+            # 讓連線池丟棄這條連線並重新建立
+            raise DisconnectionError(f"閒置連線已失效：{e}") from e
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
+def install_statement_counter(engine: Engine, name: str):
+    """計算執行的 SQL 數量（壓力測試用來比對每個事件的查詢數）"""
+    counter = child(DB_STATEMENTS_TOTAL, name)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count_statement(conn, cursor, statement, parameters, context, executemany):
+        counter.inc()
+
+
+class DBPoolCollector:
+    """在 scrape 時讀取連線池狀態"""
+
+    def collect(self):
+        size = GaugeMetricFamily("linebot_db_pool_size", "Configured pool size", labels=["pool"])
+        in_use = GaugeMetricFamily("linebot_db_pool_checked_out", "Connections currently in use", labels=["pool"])
+        idle = GaugeMetricFamily("linebot_db_pool_checked_in", "Idle connections in the pool", labels=["pool"])
+        overflow = GaugeMetricFamily(
+            "linebot_db_pool_overflow", "Connections opened beyond pool_size", labels=["pool"]
+        )
+        for pool in list(_pools):
+            name = pool_name(pool)
+            size.add_metric([name], pool.size())
+            in_use.add_metric([name], pool.checkedout())
+            idle.add_metric([name], pool.checkedin())
+            # overflow() 在尚未達到 pool_size 時為負數
+            overflow.add_metric([name], max(pool.overflow(), 0))
+        yield from (size, in_use, idle, overflow)
+
+
+register_process_collector(DBPoolCollector())
@@ -0,0 +1,66 @@
+"""
+Read replica 路由與 read-your-writes
+
+設定 DATABASE_READ_URL 後，crud 中的唯讀查詢（對話歷史、使用者與設定的查詢）改送到 read replica，
+primary 只處理寫入與其他查詢。replica 有複寫延遲，剛寫入的資料可能還讀不到，因此：
+
+- crud 的寫入函式完成後標記這些使用者（存在共享狀態，多 worker 時也有效）
+- 標記後 DB_READ_STICKY_SECONDS 秒內，這位使用者的讀取仍送到 primary（請設為大於 replica 的延遲）
+- get_or_create_* 在 replica 上找不到資料時，會先到 primary 再查一次才建立
+
+SHARED_STATE_BACKEND=database 時，標記與檢查本身會在 primary 上各多一次小查詢。
+"""
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.db.session import READ_FROM_REPLICA
+from app.metrics import DB_READ_ROUTING_TOTAL, child
+from app.state import get_shared_state
+
+
+def replica_enabled() -> bool:
+    """是否設定了 read replica"""
+    return bool(settings.database_read_url)
+
+
+def _sticky_key(line_user_id: str) -> str:
+    return f"rw:{line_user_id}"
+
+
+def mark_written(line_user_ids: Iterable[str]):
+    """標記這些使用者剛寫入，接下來 DB_READ_STICKY_SECONDS 秒內的讀取送到 primary"""
+    if not replica_enabled() or settings.db_read_sticky_seconds <= 0:
+        return
+    state = get_shared_state()
+    for line_user_id in line_user_ids:
+        state.set(_sticky_key(line_user_id), "1", ttl=settings.db_read_sticky_seconds)
+
+
+def recently_written(line_user_id: str) -> bool:
+    """這位使用者是否在 DB_READ_STICKY_SECONDS 秒內寫入過"""
+    if settings.db_read_sticky_seconds <= 0:
+        return False
+    return get_shared_state().get(_sticky_key(line_user_id)) is not None
+
+
+@contextmanager
+def read_replica(db: Session, line_user_id: str) -> Iterator[bool]:
+    """
+    區塊內的 SELECT 改送到 read replica，yield 是否使用 replica
+
+    未設定 replica，或這位使用者剛寫入時，維持使用 primary。
+    """
+    if not replica_enabled():
+        yield False
+        return
+    if recently_written(line_user_id):
+        child(DB_READ_ROUTING_TOTAL, "primary").inc()
+        yield False
+        return
+    child(DB_READ_ROUTING_TOTAL, "replica").inc()
+    db.info[READ_FROM_REPLICA] = True
+    try:
+        yield True
+    finally:
+        db.info.pop(READ_FROM_REPLICA, None)
@@ -0,0 +1,282 @@
+"""
+對話歷史保留（retention sweeper）
+
+每位使用者只需要最近幾則對話。原本每次 write-behind flush 都會以一個 DELETE 清理這批使用者的舊對話，
+寫入路徑因此一直帶著刪除的成本。啟用 sweeper（CHAT_HISTORY_SWEEP_INTERVAL > 0，預設）後 flush 只做 INSERT，
+改由背景每隔 CHAT_HISTORY_SWEEP_INTERVAL 秒清理一次：
+
+1. 上次清理後有新對話的使用者（行程第一次清理時為所有使用者），每人保留最近 CHAT_HISTORY_KEEP_LAST 則
+2. 設定 CHAT_HISTORY_RETENTION_DAYS 時，刪除超過天數的對話；PostgreSQL 上已分割的 chat_history
+   （見 app/db/partitions.py）先整個 DROP 過期的月份，再刪除剩下的零星資料
+
+每個 DELETE 最多 CHAT_HISTORY_SWEEP_BATCH_SIZE 筆，批次之間暫停 CHAT_HISTORY_SWEEP_PAUSE_MS 毫秒；
+LLM lane 有查詢在排隊（worker 忙碌）時再多等一下，最多 IDLE_WAIT_MAX 秒，避免在尖峰時段搶資料庫連線。
+多個 worker 透過共享狀態協調，每個間隔只有一個 worker 執行。
+
+設定 CHAT_HISTORY_ARCHIVE_DIR 時，刪除前先把對話寫入 gzip JSONL 檔。
+刪除失敗時同一批對話下次會再封存一次，封存檔可能有重複的 id。
+"""
+import asyncio
+import gzip
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, List, Optional
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.db import crud
+from app.db.history_buffer import KEEP_LAST
+from app.db.partitions import drop_partition, ensure_partitions, expired_partitions
+from app.db.session import get_session_factory
+from app.metrics import CHAT_HISTORY_SWEEP_SECONDS, CHAT_HISTORY_SWEPT_TOTAL, child, record_error
+from app.state import get_shared_state
+
+# 共享狀態的 key：這個間隔由哪個 worker 清理、上次清理的時間點
+CLAIM_KEY = "chat_history_sweep:claim"
+SINCE_KEY = "chat_history_sweep:since"
+
+# 對話的 created_at 在加入 buffer 時決定，寫入資料庫會晚一點，下次從清理開始前這麼多秒找起
+SINCE_MARGIN = 60.0
+
+# worker 忙碌時，每個批次最多再等幾秒
+IDLE_WAIT_MAX = 30.0
+
+
+class _SweepStopped(Exception):
+    """stop() 之後中止進行中的清理"""
+
+
+@dataclass
+class SweepReport:
+    """一次清理的結果（stopped 表示因為應用程式關閉而中途停止）"""
+    keep_last: int = 0
+    expired: int = 0
+    partitions: List[str] = field(default_factory=list)
+    archived: int = 0
+    elapsed: float = 0.0
+    stopped: bool = False
+
+    @property
+    def deleted(self) -> int:
+        return self.keep_last + self.expired
+
+
+class ChatHistoryArchive:
+    """把刪除前的對話寫入 gzip JSONL 檔（每次清理一個檔案，有資料時才建立）"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.rows = 0
+        self._file = None
+
+    def write(self, rows, reason: str):
+        if self._file is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            name = f"chat_history-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl.gz"
+            self._file = gzip.open(self.directory / name, "at", encoding="utf-8")
+        for row in rows:
+            record = {
+                "id": row.id,
+                "line_user_id": row.line_user_id,
+                "role": row.role,
+                "text": row.text,
+                "created_at": row.created_at.isoformat(),
+                "reason": reason,
+            }
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # 刪除之前先寫出（gzip sync flush）
+        self._file.flush()
+        self.rows += len(rows)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ChatHistorySweeper:
+    """背景批次清理 chat_history 的舊對話"""
+
+    def __init__(
+        self,
+        interval: float,
+        keep_last: int,
+        retention_days: float = 0.0,
+        batch_size: int = 1000,
+        pause_ms: int = 50,
+        archive_dir: str = "",
+        session_factory: Optional[Callable[[], Session]] = None,
+        busy: Optional[Callable[[], bool]] = None,
+    ):
+        self.interval = interval
+        # 少於 KEEP_LAST 則會讓回答失去對話脈絡
+        self.keep_last = max(keep_last, KEEP_LAST)
+        self.retention_days = retention_days
+        self.batch_size = max(1, batch_size)
+        self.pause = pause_ms / 1000
+        self.archive_dir = Path(archive_dir).expanduser() if archive_dir else None
+        self.session_factory = session_factory or get_session_factory()
+        self.busy = busy or (lambda: False)
+        self._stopping = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _wait(self):
+        """批次之間暫停，worker 忙碌時多等一下（stop() 之後中止這次清理）"""
+        self._stopping.wait(self.pause)
+        waited = 0.0
+        while waited < IDLE_WAIT_MAX and self.busy() and not self._stopping.is_set():
+            self._stopping.wait(0.5)
+            waited += 0.5
+        if self._stopping.is_set():
+            raise _SweepStopped()
+
+    def _delete(self, db: Session, rows, reason: str, archive: Optional[ChatHistoryArchive]) -> int:
+        if archive is not None:
+            archive.write(rows, reason)
+        deleted = crud.delete_chat_history(db, [row.id for row in rows])
+        child(CHAT_HISTORY_SWEPT_TOTAL, reason).inc(deleted)
+        self._wait()
+        return deleted
+
+    def _trim(self, db: Session, since: Optional[datetime], report: SweepReport, archive: Optional[ChatHistoryArchive]):
+        """每位使用者保留最近 keep_last 則（依 line_user_id 逐批處理）"""
+        after = None
+        while True:
+            line_user_ids = crud.get_chat_history_user_ids(db, self.batch_size, after=after, since=since)
+            if not line_user_ids:
+                break
+            after = line_user_ids[-1]
+            while True:
+                rows = crud.get_excess_chat_history(
+                    db, line_user_ids, self.keep_last, self.batch_size, with_text=archive is not None
+                )
+                if rows:
+                    report.keep_last += self._delete(db, rows, "keep_last", archive)
+                if len(rows) < self.batch_size:
+                    break
+            # 沒有刪除任何資料時也結束交易，不要讓唯讀交易一直開著
+            db.commit()
+
+    def _drop_partitions(self, engine: Engine, before: datetime, report: SweepReport, archive: Optional[ChatHistoryArchive]):
+        """整個月份都已過期的 partition 直接 DROP"""
+        for partition in expired_partitions(engine, before):
+            if archive is not None:
+                with engine.connect() as conn:
+                    result = conn.execution_options(yield_per=self.batch_size).execute(
+                        text(f"SELECT id, line_user_id, role, text, created_at FROM {partition.name} ORDER BY created_at")
+                    )
+                    for rows in result.partitions():
+                        archive.write(rows, "expired")
+            drop_partition(engine, partition)
+            report.partitions.append(partition.name)
+
+    def _delete_expired(self, db: Session, before: datetime, report: SweepReport, archive: Optional[ChatHistoryArchive]):
+        """刪除早於 before 的對話（由舊到新逐批）"""
+        while True:
+            rows = crud.get_expired_chat_history(db, before, self.batch_size, with_text=archive is not None)
+            if rows:
+                report.expired += self._delete(db, rows, "expired", archive)
+            if len(rows) < self.batch_size:
+                db.commit()
+                break
+
+    def sweep(self, since: Optional[datetime] = None) -> SweepReport:
+        """清理一次；since 表示只檢查這之後有新對話的使用者（None 為所有使用者）"""
+        start = time.perf_counter()
+        report = SweepReport()
+        archive = ChatHistoryArchive(self.archive_dir) if self.archive_dir else None
+        db = self.session_factory()
+        try:
+            engine = db.get_bind()
+            # 已分割的 chat_history 需要事先建立之後月份的 partition
+            ensure_partitions(engine)
+            self._trim(db, since, report, archive)
+            if self.retention_days > 0:
+                before = datetime.utcnow() - timedelta(days=self.retention_days)
+                self._drop_partitions(engine, before, report, archive)
+                self._delete_expired(db, before, report, archive)
+        except _SweepStopped:
+            report.stopped = True
+        finally:
+            db.close()
+            if archive is not None:
+                report.archived = archive.rows
+                archive.close()
+        report.elapsed = time.perf_counter() - start
+        CHAT_HISTORY_SWEEP_SECONDS.observe(report.elapsed)
+        return report
+
+    def run_once(self, full: bool = False) -> SweepReport:
+        """從上次清理的時間點清理一次並更新時間點（full 時檢查所有使用者）"""
+        state = get_shared_state()
+        started = datetime.utcnow()
+        since = None if full else state.get(SINCE_KEY)
+        report = self.sweep(datetime.fromisoformat(since) if since else None)
+        if report.stopped:
+            # 還沒檢查到的使用者下次要再檢查，不更新時間點
+            return report
+        state.set(SINCE_KEY, (started - timedelta(seconds=SINCE_MARGIN)).isoformat())
+        if report.deleted or report.partitions:
+            logger.info(
+                "已清理對話歷史：超出保留則數 {} 筆、過期 {} 筆、partition {}、封存 {} 筆（{:.1f} 秒）",
+                report.keep_last, report.expired, report.partitions or "無", report.archived, report.elapsed
+            )
+        return report
+
+    def _run_if_claimed(self):
+        # 每個間隔只有第一個搶到的 worker 清理
+        if get_shared_state().set_if_absent(CLAIM_KEY, str(os.getpid()), ttl=self.interval * 0.9):
+            self.run_once()
+
+    async def _run(self):
+        """背景定期清理"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self._run_if_claimed)
+            except Exception as e:
+                logger.error("清理對話歷史失敗: {}", e)
+                record_error("chat_history_sweep", type(e).__name__)
+
+    def start(self):
+        """啟動背景清理 task（在 lifespan 中呼叫）"""
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止背景 task（已刪除的批次各自已 commit，中止的清理下次從同一個時間點重新檢查）"""
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def _llm_lane_backed_up() -> bool:
+    from app.scheduler import get_scheduler
+    return get_scheduler().llm_queued > 0
+
+
+@lru_cache(maxsize=None)
+def get_chat_history_sweeper() -> ChatHistorySweeper:
+    """取得全域對話歷史 retention sweeper"""
+    return ChatHistorySweeper(
+        settings.chat_history_sweep_interval,
+        settings.chat_history_keep_last,
+        retention_days=settings.chat_history_retention_days,
+        batch_size=settings.chat_history_sweep_batch_size,
+        pause_ms=settings.chat_history_sweep_pause_ms,
+        archive_dir=settings.chat_history_archive_dir,
+        busy=_llm_lane_backed_up,
+    )
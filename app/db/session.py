@@ -1,28 +1,106 @@
+from contextlib import contextmanager
+from functools import lru_cache
 from loguru import logger
 from pathlib import Path
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
-from alembic import command
-from alembic.config import Config
+from typing import Optional
+from sqlalchemy import Select, create_engine, make_url, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 from app.config import settings
-
-# 建立資料庫引擎
-engine = create_engine(
-    settings.database_url,
-    pool_pre_ping=True,
-    echo=False
+from app.db.pool import (
+    PRE_PING_STRATEGIES,
+    InstrumentedQueuePool,
+    install_idle_pre_ping,
+    install_statement_counter,
 )
-
-# 建立 Session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+from app.db.sqlite import install_serialized_writer, install_sqlite_pragmas
 
 # 建立 Base class
 Base = declarative_base()
 
+# migrations 用的 PostgreSQL advisory lock key（任意固定值）
+MIGRATION_LOCK_KEY = 728_001
+
+
+@lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """取得資料庫引擎（第一次使用時才建立）"""
+    return build_engine(settings.database_url, pool_name="primary")
+
+
+def build_engine(database_url: str, pool_name: str) -> Engine:
+    """依 Settings 的連線池設定建立引擎"""
+    strategy = settings.db_pool_pre_ping
+    if strategy not in PRE_PING_STRATEGIES:
+        raise ValueError(f"DB_POOL_PRE_PING 必須是 {PRE_PING_STRATEGIES} 之一：{strategy}")
+    
+    if make_url(database_url).get_backend_name() == "sqlite":
+        # SQLite 不需要連線池大小設定；PRAGMA 與寫入排隊見 app/db/sqlite.py
+        engine = create_engine(database_url, echo=False)
+        install_sqlite_pragmas(
+            engine,
+            settings.sqlite_journal_mode,
+            settings.sqlite_synchronous,
+            settings.sqlite_cache_size_kb,
+            settings.sqlite_busy_timeout_ms,
+        )
+        if settings.sqlite_serialize_writes:
+            install_serialized_writer(engine, settings.sqlite_busy_timeout_ms / 1000)
+        install_statement_counter(engine, pool_name)
+        return engine
+    
+    engine = create_engine(
+        database_url,
+        poolclass=InstrumentedQueuePool,
+        pool_logging_name=pool_name,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_recycle=settings.db_pool_recycle,
+        pool_timeout=settings.db_pool_timeout,
+        pool_pre_ping=strategy == "always",
+        echo=False
+    )
+    if strategy == "idle":
+        install_idle_pre_ping(engine, settings.db_pool_pre_ping_idle_seconds)
+    install_statement_counter(engine, pool_name)
+    return engine
+
+
+@lru_cache(maxsize=None)
+def get_read_engine() -> Optional[Engine]:
+    """取得 read replica 引擎（未設定 DATABASE_READ_URL 時為 None）"""
+    if not settings.database_read_url:
+        return None
+    return build_engine(settings.database_read_url, pool_name="replica")
+
+
+# session.info 中的旗標：設定時 SELECT 送到 read replica（見 app/db/replica.py）
+READ_FROM_REPLICA = "read_from_replica"
+
+
+class RoutingSession(Session):
+    """session.info 標記可讀 replica 時，SELECT 送到 read replica，其餘（寫入、flush）一律送到 primary"""
+    
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.info.get(READ_FROM_REPLICA) and not self._flushing and isinstance(clause, Select):
+            return get_read_engine()
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+@lru_cache(maxsize=None)
+def get_session_factory() -> sessionmaker:
+    """取得 Session factory"""
+    return sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=get_engine())
+
+
+def create_session() -> Session:
+    """建立新的資料庫 session（呼叫端負責 close）"""
+    return get_session_factory()()
+
 
 def get_db():
     """取得資料庫 session（用於依賴注入）"""
-    db = SessionLocal()
+    db = create_session()
     try:
         yield db
     finally:
@@ -32,35 +110,81 @@ def get_db():
 def init_db():
     """初始化資料庫（建立所有 tables）- 已棄用，改用 run_migrations()"""
     from app.db import models  # noqa
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
+
+
+def get_alembic_config():
+    """載入 Alembic 設定（alembic.ini），並套用目前的資料庫 URL"""
+    from alembic.config import Config
+
+    # 取得專案根目錄（alembic.ini 所在位置）
+    # 從 app/db/session.py 往上兩層到專案根目錄
+    project_root = Path(__file__).parent.parent.parent
+    alembic_ini_path = project_root / "alembic.ini"
+    
+    if not alembic_ini_path.exists():
+        raise FileNotFoundError(f"找不到 alembic.ini：{alembic_ini_path}")
+    
+    alembic_cfg = Config(str(alembic_ini_path))
+    # 確保使用正確的資料庫 URL
+    alembic_cfg.set_main_option("sqlalchemy.url", settings.database_url)
+    return alembic_cfg
+
+
+def is_schema_up_to_date(alembic_cfg=None) -> bool:
+    """比對資料庫 alembic_version 與 migration scripts 的 head，不執行 env.py"""
+    from alembic.runtime.migration import MigrationContext
+    from alembic.script import ScriptDirectory
 
+    alembic_cfg = alembic_cfg or get_alembic_config()
+    script_heads = set(ScriptDirectory.from_config(alembic_cfg).get_heads())
+    with get_engine().connect() as connection:
+        db_heads = set(MigrationContext.configure(connection).get_current_heads())
+    return db_heads == script_heads
+
+
+def run_migrations(force: bool = False):
+    """執行 Alembic migrations（schema 已是最新版本時直接跳過）"""
+    # Alembic 只在執行 migrations 時才需要，延後 import 以縮短啟動時間
+    from alembic import command
 
-def run_migrations():
-    """自動執行 Alembic migrations"""
     try:
-        logger.info("正在執行資料庫 migrations...")
-        
-        # 取得專案根目錄（alembic.ini 所在位置）
-        # 從 app/db/session.py 往上兩層到專案根目錄
-        project_root = Path(__file__).parent.parent.parent
-        alembic_ini_path = project_root / "alembic.ini"
+        alembic_cfg = get_alembic_config()
         
-        if not alembic_ini_path.exists():
-            raise FileNotFoundError(f"找不到 alembic.ini：{alembic_ini_path}")
+        if not force and is_schema_up_to_date(alembic_cfg):
+            logger.info("資料庫 schema 已是最新版本，跳過 migrations")
+            return
         
-        # 載入 Alembic 設定
-        alembic_cfg = Config(str(alembic_ini_path))
-        
-        # 確保使用正確的資料庫 URL
-        alembic_cfg.set_main_option("sqlalchemy.url", settings.database_url)
+        logger.info("正在執行資料庫 migrations...")
         
-        # 執行 migrations（升級到最新版本）
-        command.upgrade(alembic_cfg, "head")
+        with migration_lock():
+            # 取得鎖之後再檢查一次，其他 worker 可能已經完成 migrations
+            if not force and is_schema_up_to_date(alembic_cfg):
+                logger.info("其他行程已完成 migrations，跳過")
+                return
+            
+            # 執行 migrations（升級到最新版本）
+            command.upgrade(alembic_cfg, "head")
         
         logger.info("✅ 資料庫 migrations 執行完成")
         
     except Exception as e:
-        logger.error(f"❌ 執行 migrations 失敗：{e}", exc_info=True)
+        logger.opt(exception=True).error("❌ 執行 migrations 失敗：{}", e)
         # 如果 migrations 失敗，應用程式無法啟動
         raise
 
+
+@contextmanager
+def migration_lock():
+    """避免多個 worker 同時執行 migrations（PostgreSQL 使用 advisory lock）"""
+    engine = get_engine()
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
@@ -0,0 +1,108 @@
+"""
+SQLite 模式（單機部署與本機測試）
+
+DATABASE_URL=sqlite:///path/to/linebot.db 時：
+
+- 每條連線建立時設定 PRAGMA：WAL journal（讀取不會擋住寫入）、synchronous、cache_size、
+  busy_timeout（等待其他行程的寫入鎖），以及與 PostgreSQL 一致的 foreign key 檢查
+- serialized writer：同一個行程內的寫入交易以一把鎖排隊。SQLite 同時只允許一個寫入者，
+  搶不到寫入鎖的連線只能靠 busy handler 輪詢等待，並行 webhook 多時會出現長時間等待或
+  database is locked；在行程內排隊可以讓寫入一個接一個立即交棒。不同行程（多個 worker）之間仍由 busy_timeout 等待。
+
+寫入鎖在交易的第一個 INSERT / UPDATE / DELETE 時取得，COMMIT / ROLLBACK（包含連線歸還連線池時的 reset）完成後釋放。
+"""
+import threading
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SQLITE_JOURNAL_MODES = ("WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF")
+SQLITE_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# 需要寫入鎖的語句
+_WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def install_sqlite_pragmas(
+    engine: Engine,
+    journal_mode: str,
+    synchronous: str,
+    cache_size_kb: int,
+    busy_timeout_ms: int,
+):
+    """每條新連線都套用 PRAGMA 設定"""
+    journal_mode, synchronous = journal_mode.upper(), synchronous.upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f"SQLITE_JOURNAL_MODE 必須是 {SQLITE_JOURNAL_MODES} 之一：{journal_mode}")
+    if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f"SQLITE_SYNCHRONOUS 必須是 {SQLITE_SYNCHRONOUS_MODES} 之一：{synchronous}")
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            # :memory: 資料庫會維持 memory，不影響其他設定
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            # 負數表示以 KiB 為單位
+            cursor.execute(f"PRAGMA cache_size=-{int(cache_size_kb)}")
+            cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+        finally:
+            cursor.close()
+
+
+def install_serialized_writer(engine: Engine, wait_timeout: float):
+    """
+    同一個行程內的寫入交易排隊執行
+
+    等待超過 wait_timeout 秒時不再等待，改由 SQLite 的 busy_timeout 處理（避免同一個執行緒
+    以兩條連線寫入時自己等自己）。
+    """
+    lock = threading.Lock()
+    # 目前持有寫入鎖的 DBAPI 連線（同時最多一條）
+    state = {"owner": None}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _acquire(conn, cursor, statement, parameters, context, executemany):
+        dbapi_connection = cursor.connection
+        if state["owner"] is dbapi_connection or not statement.lstrip()[:7].upper().startswith(_WRITE_PREFIXES):
+            return
+        if lock.acquire(timeout=wait_timeout):
+            state["owner"] = dbapi_connection
+        else:
+            logger.warning("等待 SQLite 寫入鎖超過 {} 秒，改由 busy_timeout 處理", wait_timeout)
+
+    def _release(dbapi_connection):
+        # 連線池 reset 時傳入的是 pool 的 connection proxy
+        dbapi_connection = getattr(dbapi_connection, "dbapi_connection", dbapi_connection)
+        if dbapi_connection is not None and state["owner"] is dbapi_connection:
+            state["owner"] = None
+            lock.release()
+
+    # COMMIT / ROLLBACK 完成後才釋放（engine 的 commit 事件在送出 COMMIT 之前觸發，
+    # 下一個寫入者會撞上尚未完成的 COMMIT 而進入 busy handler 的輪詢），
+    # 連線歸還連線池時的 reset 也會經過 do_rollback
+    dialect = engine.dialect
+    do_commit, do_rollback = dialect.do_commit, dialect.do_rollback
+
+    def _do_commit(dbapi_connection):
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            _release(dbapi_connection)
+
+    def _do_rollback(dbapi_connection):
+        try:
+            do_rollback(dbapi_connection)
+        finally:
+            _release(dbapi_connection)
+
+    dialect.do_commit = _do_commit
+    dialect.do_rollback = _do_rollback
+
+    # 失效（斷線）的連線不會再 commit / rollback
+    @event.listens_for(engine, "invalidate")
+    def _on_invalidate(dbapi_connection, connection_record, exception):
+        _release(dbapi_connection)
@@ -0,0 +1,114 @@
+"""
+多個 LINE 頻道（多個品牌的 bot）共用同一個部署
+
+- default 頻道：LINE_CHANNEL_SECRET / LINE_CHANNEL_ACCESS_TOKEN / QUESTIONS_FILE，webhook 為 /webhook/line
+- 其他頻道：LINE_CHANNELS=brand_a,brand_b，每個頻道以大寫名稱為後綴設定
+  LINE_CHANNEL_SECRET_BRAND_A、LINE_CHANNEL_ACCESS_TOKEN_BRAND_A、QUESTIONS_FILE_BRAND_A（可選），
+  webhook 為 /webhook/line/brand_a
+
+每個頻道有自己的 signature 驗證、LINE ApiClient（連線池）與題庫；LLM client、資料庫連線池與背景 worker 共用。
+處理 webhook 時把頻道名稱放在 contextvar，handler 內的 get_line_client() / get_question_manager() 會取得目前頻道的物件。
+
+資料表以 user_key() 區分頻道：default 頻道的使用者 key 就是 LINE user ID（既有資料不需遷移），
+其他頻道為「頻道名稱:LINE user ID」。對話歷史、LLM 開關、token 預算與公告的收件人因此各頻道分開；
+呼叫 LINE API 時再以 line_user_id_of() 取回 LINE user ID。
+"""
+import os
+import re
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional
+from app.config import settings
+
+DEFAULT_CHANNEL = "default"
+DEFAULT_QUESTIONS_FILE = Path(__file__).resolve().parent.parent / "content" / "questions.yaml"
+
+CHANNEL_NAME_PATTERN = re.compile(r"^[a-z0-9_]{1,32}$")
+
+# 使用者 key 中頻道名稱與 LINE user ID 的分隔字元（LINE user ID 不含冒號）
+USER_KEY_SEPARATOR = ":"
+
+_current_channel: ContextVar[str] = ContextVar("line_channel", default=DEFAULT_CHANNEL)
+
+
+class UnknownChannelError(KeyError):
+    """沒有設定的頻道名稱"""
+
+
+@dataclass(frozen=True)
+class ChannelConfig:
+    """一個 LINE 頻道的設定"""
+    name: str
+    channel_secret: str
+    access_token: str
+    questions_file: Path
+
+
+def _questions_file(value: str) -> Path:
+    return Path(value).expanduser().resolve() if value else DEFAULT_QUESTIONS_FILE
+
+
+def load_channels() -> Dict[str, ChannelConfig]:
+    """依環境變數建立所有頻道的設定（名稱不合法或缺少金鑰時拋出 ValueError）"""
+    channels = {
+        DEFAULT_CHANNEL: ChannelConfig(
+            DEFAULT_CHANNEL,
+            settings.line_channel_secret,
+            settings.line_channel_access_token,
+            _questions_file(settings.questions_file),
+        )
+    }
+    for name in filter(None, (part.strip() for part in settings.line_channels.split(","))):
+        if not CHANNEL_NAME_PATTERN.match(name) or name == DEFAULT_CHANNEL:
+            raise ValueError(f"LINE_CHANNELS 的頻道名稱只能使用小寫英數字與底線（且不可為 {DEFAULT_CHANNEL}）：{name}")
+        suffix = name.upper()
+        secret = os.getenv(f"LINE_CHANNEL_SECRET_{suffix}", "")
+        access_token = os.getenv(f"LINE_CHANNEL_ACCESS_TOKEN_{suffix}", "")
+        if not secret or not access_token:
+            raise ValueError(f"頻道 {name} 需要設定 LINE_CHANNEL_SECRET_{suffix} 與 LINE_CHANNEL_ACCESS_TOKEN_{suffix}")
+        channels[name] = ChannelConfig(name, secret, access_token, _questions_file(os.getenv(f"QUESTIONS_FILE_{suffix}", "")))
+    return channels
+
+
+@lru_cache(maxsize=None)
+def get_channels() -> Dict[str, ChannelConfig]:
+    """取得所有頻道的設定（第一次使用時讀取環境變數）"""
+    return load_channels()
+
+
+def get_channel(name: str) -> ChannelConfig:
+    """取得頻道設定（沒有設定時拋出 UnknownChannelError）"""
+    try:
+        return get_channels()[name]
+    except KeyError:
+        raise UnknownChannelError(name) from None
+
+
+def set_current_channel(name: str):
+    """設定目前處理中的頻道（每個 webhook 請求開始處理時呼叫）"""
+    _current_channel.set(name)
+
+
+def current_channel() -> str:
+    """取得目前處理中的頻道名稱"""
+    return _current_channel.get()
+
+
+def user_key(line_user_id: str, channel: Optional[str] = None) -> str:
+    """資料表中的使用者 key（channel 預設為目前處理中的頻道）"""
+    channel = channel or current_channel()
+    if channel == DEFAULT_CHANNEL:
+        return line_user_id
+    return f"{channel}{USER_KEY_SEPARATOR}{line_user_id}"
+
+
+def line_user_id_of(key: str) -> str:
+    """從使用者 key 取回 LINE user ID"""
+    return key.rpartition(USER_KEY_SEPARATOR)[2]
+
+
+def channel_of(key: str) -> str:
+    """使用者 key 所屬的頻道"""
+    return key.rpartition(USER_KEY_SEPARATOR)[0] or DEFAULT_CHANNEL
@@ -2,12 +2,15 @@ import yaml
 import os
 from loguru import logger
 import httpx
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 from linebot.v3.messaging import (
     Configuration,
     ApiClient,
     MessagingApi,
+    MulticastRequest,
     ReplyMessageRequest,
     TextMessage,
     QuickReply,
@@ -17,19 +20,63 @@ from linebot.v3.messaging import (
     ApiException
 )
 from app.config import settings
+from app.line.channels import DEFAULT_QUESTIONS_FILE, current_channel, get_channel, get_channels
 from app.line.schemas import TopicInfo
+from app.logging_config import sampled_logger
+from app.metrics import LINE_PUSH_BATCH_SECONDS, LINE_REPLY_SECONDS, event_labels, record_error, timed
+from app.tracing import span
 
-# LINE Bot API 配置
-configuration = Configuration(access_token=settings.line_channel_access_token)
+
+def get_configuration(channel: Optional[str] = None) -> Configuration:
+    """頻道的 LINE Bot API 配置（預設為目前處理中的頻道；第一次使用時才建立）"""
+    return _get_configuration(channel or current_channel())
+
+
+@lru_cache(maxsize=None)
+def _get_configuration(channel: str) -> Configuration:
+    return Configuration(host=settings.line_api_base, access_token=get_channel(channel).access_token)
+
+
+def get_api_client(channel: Optional[str] = None) -> ApiClient:
+    """頻道共用的 LINE ApiClient（LINEClient 與 Rich Menu 共用同一個連線池，每個頻道一個）"""
+    return _get_api_client(channel or current_channel())
+
+
+@lru_cache(maxsize=None)
+def _get_api_client(channel: str) -> ApiClient:
+    return ApiClient(get_configuration(channel))
+
+
+def reset_api_clients():
+    """關閉所有頻道 ApiClient 的連線並清除快取（gunicorn master 在 fork worker 前呼叫，子行程不能共用連線）"""
+    if _get_api_client.cache_info().currsize:
+        for channel in get_channels():
+            get_api_client(channel).rest_client.pool_manager.clear()
+    _get_line_client.cache_clear()
+    _get_api_client.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def get_loading_http_client() -> httpx.Client:
+    """載入動畫 API 共用的 httpx client（保留 keep-alive 連線，不必每次重新 TLS 握手）"""
+    return httpx.Client(
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=settings.upstream_keepalive_expiry)
+    )
+
+
+def close_loading_http_client():
+    """關閉載入動畫的 httpx client（只有曾經建立過時才需要關閉）"""
+    if get_loading_http_client.cache_info().currsize:
+        get_loading_http_client().close()
 
 
 class QuestionManager:
     """題庫管理器"""
     
-    def __init__(self):
-        # 自動抓取目前檔案 (client.py) 的上兩層目錄找到 app/content
-        current_dir = Path(__file__).resolve().parent.parent  # 指向 app/
-        self.yaml_path = current_dir / "content" / "questions.yaml"
+    def __init__(self, yaml_path: Optional[Path] = None):
+        # 預設為 app/content/questions.yaml
+        self.yaml_path = yaml_path or DEFAULT_QUESTIONS_FILE
         logger.debug(f"QuestionManager 初始化 - 當前檔案: {__file__}")
         logger.debug(f"QuestionManager 初始化 - 解析路徑: {self.yaml_path}")
         logger.debug(f"QuestionManager 初始化 - 路徑是否存在: {self.yaml_path.exists()}")
@@ -62,16 +109,32 @@ class QuestionManager:
         )
 
 
-# 全域題庫管理器
-question_manager = QuestionManager()
+def get_question_manager(channel: Optional[str] = None) -> QuestionManager:
+    """取得頻道的題庫管理器（預設為目前處理中的頻道；使用同一個 YAML 的頻道共用，第一次使用時才讀取）"""
+    return _get_question_manager(get_channel(channel or current_channel()).questions_file)
+
+
+@lru_cache(maxsize=None)
+def _get_question_manager(yaml_path: Path) -> QuestionManager:
+    return QuestionManager(yaml_path)
 
 
 class LINEClient:
     """LINE Bot 客戶端"""
     
-    def __init__(self):
-        self.api_client = ApiClient(configuration)
+    def __init__(
+        self,
+        api_client: Optional[ApiClient] = None,
+        question_manager: Optional[QuestionManager] = None
+    ):
+        self.api_client = api_client or get_api_client()
         self.messaging_api = MessagingApi(self.api_client)
+        self.question_manager = question_manager or get_question_manager()
+    
+    @property
+    def access_token(self) -> str:
+        """這個 client 所屬頻道的 channel access token"""
+        return self.api_client.configuration.access_token
     
     def reply_text(self, reply_token: str, text: str, quick_reply: QuickReply = None):
         """回覆文字訊息"""
@@ -81,37 +144,51 @@ class LINEClient:
                 replyToken=reply_token,
                 messages=[message]
             )
-            self.messaging_api.reply_message(request)
-            logger.info(f"已回覆文字訊息: {text[:50]}...")
-            if quick_reply:
-                logger.info(f"已附加 Quick Reply，包含 {len(quick_reply.items)} 個選項")
+            with timed(LINE_REPLY_SECONDS, *event_labels()), span("line.reply"):
+                self.messaging_api.reply_message(request)
+            sampled_logger.info(
+                "已回覆文字訊息: {}...（Quick Reply 選項: {}）",
+                text[:50],
+                len(quick_reply.items) if quick_reply else 0
+            )
         except ApiException as e:
             status = getattr(e, "status", None)
             reason = getattr(e, "reason", None)
             body = getattr(e, "body", None)
             headers = getattr(e, "headers", None)
+            record_error("line_reply", status)
 
-            logger.error(
-                f"LINE Messaging API 錯誤: status={status}, reason={reason}, body={body}, headers={headers}",
-                exc_info=True,
+            logger.opt(exception=True).error(
+                "LINE Messaging API 錯誤: status={}, reason={}, body={}, headers={}",
+                status, reason, body, headers
             )
             raise
         except Exception as e:
-            logger.error(f"回覆訊息失敗: {e}", exc_info=True)
+            logger.opt(exception=True).error("回覆訊息失敗: {}", e)
+            record_error("line_reply", type(e).__name__)
             raise
     
+    def multicast_text(self, user_ids: List[str], text: str, retry_key: Optional[str] = None):
+        """
+        推播文字訊息給多位使用者（LINE multicast，每次最多 500 人）
+        
+        retry_key 會送出為 X-Line-Retry-Key：以相同的 key 重送已被接受的請求時，LINE 回傳 409 而不會重複推播。
+        ApiException 由呼叫端處理（重試、計入失敗）。
+        """
+        request = MulticastRequest(to=user_ids, messages=[TextMessage(text=text)])
+        with timed(LINE_PUSH_BATCH_SECONDS), span("line.multicast"):
+            self.messaging_api.multicast(request, x_line_retry_key=retry_key)
+    
     def create_menu_quick_reply(self) -> QuickReply:
         """建立主選單 Quick Reply（五個主題）"""
         items = []
-        topics = question_manager.get_menu_topics()
+        topics = self.question_manager.get_menu_topics()
         
-        logger.info(f"建立選單 Quick Reply，主題數量: {len(topics)}")
-        logger.debug(f"主題列表: {topics}")
+        logger.opt(lazy=True).debug("主題列表: {}", lambda: topics)
         
         for topic in topics:
             label = topic.get('label', '')
             key = topic.get('key', '')
-            logger.debug(f"  添加主題: {label} (key: {key})")
             items.append(
                 QuickReplyItem(
                     action=PostbackAction(
@@ -123,16 +200,15 @@ class LINEClient:
         
         if not items:
             logger.warning("選單 Quick Reply 項目為空")
-            logger.warning(f"題庫資料: {question_manager.data}")
+            logger.opt(lazy=True).warning("題庫資料: {}", lambda: self.question_manager.data)
             raise ValueError("選單主題列表為空，無法建立 Quick Reply")
         
-        logger.info(f"已建立 {len(items)} 個 Quick Reply 項目")
         return QuickReply(items=items)
     
     def create_topic_quick_reply(self, topic_key: str) -> QuickReply:
         """建立主題問題 Quick Reply（該主題的 3 個問題）"""
         items = []
-        topic_info = question_manager.get_topic_info(topic_key)
+        topic_info = self.question_manager.get_topic_info(topic_key)
         
         for question in topic_info.questions:
             # 截斷太長的問題作為 label
@@ -161,9 +237,9 @@ class LINEClient:
         elif loading_seconds > 60:
             loading_seconds = 60
         
-        url = "https://api.line.me/v2/bot/chat/loading/start"
+        url = f"{settings.line_api_base}/v2/bot/chat/loading/start"
         headers = {
-            "Authorization": f"Bearer {settings.line_channel_access_token}",
+            "Authorization": f"Bearer {self.access_token}",
             "Content-Type": "application/json"
         }
         data = {
@@ -172,15 +248,46 @@ class LINEClient:
         }
         
         try:
-            with httpx.Client() as client:
-                response = client.post(url, headers=headers, json=data, timeout=5.0)
+            with span("line.start_loading"):
+                response = get_loading_http_client().post(url, headers=headers, json=data)
                 response.raise_for_status()
-                logger.info(f"已顯示載入動畫給使用者 {user_id}，持續 {loading_seconds} 秒")
+                sampled_logger.info("已顯示載入動畫給使用者 {}，持續 {} 秒", user_id, loading_seconds)
         except Exception as e:
             # 載入動畫失敗不應該影響主要功能，只記錄錯誤
-            logger.warning(f"顯示載入動畫失敗: {e}")
+            logger.warning("顯示載入動畫失敗: {}", e)
+
+    
+    def warm(self, connections: int, timeout: float = 3.0) -> int:
+        """
+        預先建立連到 LINE API 的 keep-alive 連線，回傳成功的請求數
+        
+        SDK 的連線池（回覆訊息、Rich Menu）與載入動畫的 client 各同時送出 connections 個 HEAD 請求，
+        每個請求各佔一條連線。SDK 連線池最多保留 Configuration.connection_pool_maxsize 條。
+        """
+        url = f"{settings.line_api_base}/"
+        pool_manager = self.api_client.rest_client.pool_manager
+        loading_client = get_loading_http_client()
+        
+        def ping_sdk():
+            pool_manager.request("HEAD", url, timeout=timeout, retries=False)
+        
+        def ping_loading():
+            loading_client.head(url, timeout=timeout)
+        
+        pings = [ping_sdk] * connections + [ping_loading] * connections
+        if not pings:
+            return 0
+        with ThreadPoolExecutor(len(pings), thread_name_prefix="line-warm") as executor:
+            futures = [executor.submit(ping) for ping in pings]
+        return sum(future.exception() is None for future in futures)
+
+
+def get_line_client(channel: Optional[str] = None) -> LINEClient:
+    """取得頻道的 LINE client（預設為目前處理中的頻道；第一次使用時才建立）"""
+    return _get_line_client(channel or current_channel())
 
 
-# 全域 LINE client instance
-line_client = LINEClient()
+@lru_cache(maxsize=None)
+def _get_line_client(channel: str) -> LINEClient:
+    return LINEClient(get_api_client(channel), get_question_manager(channel))
 
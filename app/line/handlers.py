@@ -1,59 +1,115 @@
 from loguru import logger
+import asyncio
 import hmac
 import hashlib
 import json
 import base64
+from contextlib import nullcontext
 from urllib.parse import parse_qs
-from linebot.v3.webhooks import (
-    MessageEvent,
-    TextMessageContent,
-    PostbackEvent
-)
 from linebot.v3.exceptions import InvalidSignatureError
 from app.config import settings
-from app.db.session import SessionLocal
+from app.db.session import create_session
 from app.db import crud
-from app.line.client import line_client, question_manager
-from app.llm.client import llm_client
+from app.db.history_buffer import get_history_buffer
+from app.line.channels import DEFAULT_CHANNEL, get_channel, line_user_id_of, set_current_channel, user_key
+from app.line.client import get_line_client, get_question_manager
+from app.llm.client import get_llm_client
+from app.llm.prefetch import get_answer_prefetcher
+from app.llm.tiers import get_tier_classifier
+from app.llm.usage import get_usage_tracker
+from app.logging_config import sampled_logger
+from app.metrics import (
+    DUPLICATE_EVENTS_TOTAL,
+    EVENTS_TOTAL,
+    LLM_BUDGET_EXCEEDED_TOTAL,
+    LLM_PREFETCH_TOTAL,
+    LLM_SHED_TOTAL,
+    SIGNATURE_VERIFY_SECONDS,
+    WEBHOOK_PARSE_SECONDS,
+    child,
+    event_labels,
+    record_cache,
+    record_error,
+    set_action_label,
+    set_event_labels,
+    timed,
+)
+from app.scheduler import get_scheduler
+from app.state import get_shared_state
+from app.tracing import log_event_summary, set_span_attribute, span
 
 
-def verify_signature(body: str, signature: str) -> bool:
-    """驗證 LINE webhook signature"""
+def compute_signature(body: str, channel_secret: str) -> str:
+    """計算 LINE webhook signature（壓力測試產生請求時也使用）"""
     # 1. 計算 HMAC-SHA256 (取得二進位 digest)
     hash_digest = hmac.new(
-        settings.line_channel_secret.encode('utf-8'),
+        channel_secret.encode('utf-8'),
         body.encode('utf-8'),
         hashlib.sha256
     ).digest()
     
     # 2. 將二進位結果轉為 Base64 字串 (LINE 的標準)
-    # 這裡移除了多餘的 hashlib.sha256() 呼叫
-    expected_signature = base64.b64encode(hash_digest).decode('utf-8')
-    
-    # 3. 比對簽章
+    return base64.b64encode(hash_digest).decode('utf-8')
+
+
+def verify_signature(body: str, signature: str, channel_secret: str) -> bool:
+    """驗證 LINE webhook signature"""
+    expected_signature = compute_signature(body, channel_secret)
     return hmac.compare_digest(signature, expected_signature)
 
 
-async def handle_line_webhook(body: str, signature: str):
-    """處理 LINE webhook 請求"""
+def is_duplicate_event(event: dict) -> bool:
+    """LINE 重送的事件（同一個 webhookEventId）在 EVENT_DEDUP_TTL 內只處理一次（跨 worker 共享）"""
+    event_id = event.get('webhookEventId')
+    if not event_id or settings.event_dedup_ttl <= 0:
+        return False
+    if get_shared_state().set_if_absent(f"event:{event_id}", "1", ttl=settings.event_dedup_ttl):
+        return False
+    sampled_logger.info("略過已處理過的事件: {}", event_id)
+    DUPLICATE_EVENTS_TOTAL.inc()
+    return True
+
+
+async def handle_line_webhook(body: str, signature: str, channel: str = DEFAULT_CHANNEL):
+    """處理 LINE webhook 請求（channel 沒有設定時拋出 UnknownChannelError）"""
+    channel_config = get_channel(channel)
+    # 之後的 get_line_client() / get_question_manager() 都取得這個頻道的物件
+    set_current_channel(channel)
+    set_span_attribute("channel", channel)
+    
     # 驗證 signature
-    if not verify_signature(body, signature):
+    with timed(SIGNATURE_VERIFY_SECONDS), span("webhook.verify_signature"):
+        is_valid = verify_signature(body, signature, channel_config.channel_secret)
+    if not is_valid:
         logger.error("Invalid signature")
+        record_error("signature", "invalid")
         raise InvalidSignatureError("Invalid signature")
     
     # 解析事件
-    data = json.loads(body)
+    with timed(WEBHOOK_PARSE_SECONDS), span("webhook.parse"):
+        data = json.loads(body)
     events = data.get('events', [])
     
     for event in events:
+        if is_duplicate_event(event):
+            continue
+        
         event_type = event.get('type')
+        set_event_labels(event_type)
         
-        if event_type == 'message':
-            await handle_message_event(event)
-        elif event_type == 'postback':
-            await handle_postback_event(event)
-        else:
-            logger.info(f"未處理的事件類型: {event_type}")
+        event_span = None
+        try:
+            with span("event", event_type=event_type) as event_span:
+                if event_type == 'message':
+                    await handle_message_event(event)
+                elif event_type == 'postback':
+                    await handle_postback_event(event)
+                else:
+                    sampled_logger.info("未處理的事件類型: {}", event_type)
+        finally:
+            labels = event_labels()
+            child(EVENTS_TOTAL, channel, *labels).inc()
+            log_event_summary(event_span, event=labels[0], action=labels[1])
 
 
 async def handle_message_event(event: dict):
@@ -64,14 +120,17 @@ async def handle_message_event(event: dict):
     if message_type != 'text':
         return
     
-    user_id = event['source']['userId']
+    # 資料表中的使用者 key（非 default 頻道加上頻道名稱前綴，各頻道的資料分開）
+    user_id = user_key(event['source']['userId'])
     reply_token = event['replyToken']
     user_text = message.get('text', '').strip()
     
-    logger.info(f"收到訊息 from {user_id}: {user_text}")
-    logger.debug(f"訊息處理 - 原始文字: '{user_text}', 小寫: '{user_text.lower()}'")
+    sampled_logger.info("收到訊息 from {}: {}", user_id, user_text)
     
-    db = SessionLocal()
+    line_client = get_line_client()
+    question_manager = get_question_manager()
+    
+    db = create_session()
     try:
         # 確保使用者存在
         crud.get_or_create_user(db, user_id)
@@ -81,31 +140,30 @@ async def handle_message_event(event: dict):
         user_text_lower = user_text.lower().strip()
         
         if user_text_lower in menu_keywords:
-            logger.info(f"觸發選單顯示，關鍵字: '{user_text_lower}'")
+            set_action_label("MENU")
+            sampled_logger.info("觸發選單顯示，關鍵字: '{}'", user_text_lower)
             try:
                 # 顯示主選單
                 quick_reply = line_client.create_menu_quick_reply()
                 topics = question_manager.get_menu_topics()
-                logger.info(f"選單主題數量: {len(topics)}")
                 if not topics:
                     logger.warning("選單主題列表為空，無法顯示選單")
                     line_client.reply_text(reply_token, "選單資料尚未設定，請聯繫管理員。")
                     return
                 
                 menu_title = question_manager.data.get('menu', {}).get('title', '請選擇主題')
-                logger.info(f"準備發送選單，標題: '{menu_title}', Quick Reply 項目數: {len(quick_reply.items)}")
                 line_client.reply_text(reply_token, menu_title, quick_reply)
-                logger.info("選單已成功發送")
-            except Exception as e:
-                logger.error(f"發送選單時發生錯誤", exc_info=True)
+                sampled_logger.info("選單已成功發送，Quick Reply 項目數: {}", len(quick_reply.items))
+            except Exception:
+                logger.opt(exception=True).error("發送選單時發生錯誤")
                 # 嘗試發送錯誤訊息給使用者
                 try:
                     line_client.reply_text(reply_token, "選單顯示失敗，請稍後再試。")
                 except Exception:
-                    logger.warning("回覆錯誤訊息給使用者時也失敗", exc_info=True)
+                    logger.opt(exception=True).warning("回覆錯誤訊息給使用者時也失敗")
             return
         else:
-            logger.debug(f"不是選單關鍵字，繼續處理為一般訊息")
+            set_action_label("FREE_TEXT")
         
         # 一般文字訊息：呼叫 LLM
         await handle_llm_query(db, user_id, reply_token, user_text)
@@ -116,17 +174,22 @@ async def handle_message_event(event: dict):
 
 async def handle_postback_event(event: dict):
     """處理 postback 事件"""
-    user_id = event['source']['userId']
+    # 資料表中的使用者 key（非 default 頻道加上頻道名稱前綴，各頻道的資料分開）
+    user_id = user_key(event['source']['userId'])
     reply_token = event['replyToken']
     postback_data = event['postback']['data']
     
     # 解析 postback data
     params = parse_qs(postback_data)
     action_type = params.get('action_type', [None])[0]
+    set_action_label(action_type)
+    
+    sampled_logger.info("收到 postback from {}: {}", user_id, action_type)
     
-    logger.info(f"收到 postback from {user_id}: {action_type}")
+    line_client = get_line_client()
+    question_manager = get_question_manager()
     
-    db = SessionLocal()
+    db = create_session()
     try:
         # 確保使用者存在
         crud.get_or_create_user(db, user_id)
@@ -142,6 +205,8 @@ async def handle_postback_event(event: dict):
                     f"【{topic_info.display_name}】\n請選擇你想了解的問題：",
                     quick_reply
                 )
+                if settings.llm_prefetch_enabled:
+                    prefetch_topic_answers(db, user_id, topic_info.questions)
         
         elif action_type == 'ASK_QUESTION':
             # 使用者點選問題，直接送給 LLM
@@ -163,40 +228,122 @@ async def handle_postback_event(event: dict):
             line_client.reply_text(reply_token, status_text)
         
         else:
-            logger.warning(f"未知的 action_type: {action_type}")
+            logger.warning("未知的 action_type: {}", action_type)
     
     finally:
         db.close()
 
 
-async def handle_llm_query(db, user_id: str, reply_token: str, user_text: str):
-    """處理 LLM 查詢"""
-    # 檢查 LLM 是否啟用
+def prefetch_topic_answers(db, user_id: str, questions: list):
+    """在背景預先產生主題問題的回答（使用者關閉 LLM 或額度已用完時不產生）"""
+    if not questions:
+        return
     user_setting = crud.get_or_create_user_setting(db, user_id)
-    
-    if not user_setting.llm_enabled:
-        line_client.reply_text(
-            reply_token,
-            "目前已關閉 LLM 解釋模式，請到選單開啟。"
-        )
+    if not user_setting.llm_enabled or get_usage_tracker().is_over_budget(user_id):
         return
-    
-    # 顯示載入動畫（設定 60 秒，如果 LLM 回應較快會自動消失）
-    line_client.start_loading(user_id, loading_seconds=60)
-    
-    # 取得最近對話歷史
-    chat_history = crud.get_recent_chat_history(db, user_id, limit=4)
-    
-    # 呼叫 LLM
-    response_text = await llm_client.get_response(user_text, chat_history)
-    
-    # 儲存對話歷史
-    crud.add_chat_history(db, user_id, 'user', user_text)
-    crud.add_chat_history(db, user_id, 'assistant', response_text)
-    
-    # 清理舊對話（保留最近 4 則）
-    crud.clear_old_chat_history(db, user_id, keep_last=4)
-    
-    # 回覆使用者（發送新訊息時，載入動畫會自動消失）
-    line_client.reply_text(reply_token, response_text)
+    chat_history = get_history_buffer().get_recent(db, user_id, limit=4)
+    started = get_answer_prefetcher().prefetch(user_id, questions, chat_history)
+    set_span_attribute("prefetch_started", started)
 
+
+async def use_prefetched_answer(user_id: str, task: asyncio.Task) -> str | None:
+    """等待預先產生的回答（產生失敗或被取消時為 None），並把使用的 token 計入使用者額度"""
+    try:
+        # shield：目前的請求被取消時不要連帶取消預先產生的 task
+        response_text, response_info = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        response_info = {}
+    if not response_info:
+        child(LLM_PREFETCH_TOTAL, "failed").inc()
+        return None
+    get_usage_tracker().record(user_id, response_info.get("usage"))
+    child(LLM_PREFETCH_TOTAL, "used").inc()
+    return response_text
+
+
+def reply_busy(line_client, reply_token: str):
+    """LLM lane 排隊過久：回覆忙碌訊息（計入 shed）"""
+    child(LLM_SHED_TOTAL, *event_labels()).inc()
+    line_client.reply_text(
+        reply_token,
+        "目前提問的人比較多，請稍後再問我一次！\n也可以輸入「選單」查看題庫。"
+    )
+
+
+async def handle_llm_query(db, user_id: str, reply_token: str, user_text: str):
+    """處理 LLM 查詢"""
+    line_client = get_line_client()
+    
+    with span("handle_llm_query"):
+        # 檢查 LLM 是否啟用
+        user_setting = crud.get_or_create_user_setting(db, user_id)
+        
+        if not user_setting.llm_enabled:
+            line_client.reply_text(
+                reply_token,
+                "目前已關閉 LLM 解釋模式，請到選單開啟。"
+            )
+            return
+        
+        # 檢查今日 token 額度（只查記憶體中的累計，不需要額外的 SQL）
+        if get_usage_tracker().is_over_budget(user_id):
+            child(LLM_BUDGET_EXCEEDED_TOTAL, *event_labels()).inc()
+            line_client.reply_text(
+                reply_token,
+                "今天的 AI 解釋額度已經用完囉，明天再來問我吧！\n也可以輸入「選單」查看題庫。"
+            )
+            return
+        
+        # 取出 SHOW_TOPIC 時預先產生的回答；這位使用者其他未使用的預先產生一併取消（對話歷史即將改變）
+        prefetch_task = None
+        if settings.llm_prefetch_enabled:
+            prefetch_task = get_answer_prefetcher().take(user_id, user_text)
+            if event_labels()[1] == "ASK_QUESTION":
+                record_cache("llm_prefetch", prefetch_task is not None)
+        
+        # LLM lane：新的 LLM 呼叫需要排隊取得 slot，排隊過久時直接回覆忙碌訊息
+        # （使用預先產生的回答不佔 slot，選單等便宜的事件不經過 lane；排隊與等待期間不佔用資料庫連線）
+        db.close()
+        lane = get_scheduler().llm_lane() if prefetch_task is None else nullcontext(True)
+        async with lane as admitted:
+            if not admitted:
+                reply_busy(line_client, reply_token)
+                return
+            
+            # 顯示載入動畫（設定 60 秒，如果 LLM 回應較快會自動消失；預先產生的回答已完成時不需要）
+            if prefetch_task is None or not prefetch_task.done():
+                line_client.start_loading(line_user_id_of(user_id), loading_seconds=60)
+            
+            history_buffer = get_history_buffer()
+            response_text = None
+            if prefetch_task is not None:
+                response_text = await use_prefetched_answer(user_id, prefetch_task)
+                set_span_attribute("prefetched", response_text is not None)
+            
+            if response_text is None:
+                # 取得最近對話歷史（尚未寫入資料庫的訊息由 buffer 補上）
+                chat_history = history_buffer.get_recent(db, user_id, limit=4)
+            
+                # 結束讀取交易，把連線還給連線池；否則等待 LLM 的請求會各佔一條連線，
+                # 並行數超過連線池上限時，取得連線的等待會卡住整個 event loop
+                # （close 不會讓已載入的物件過期，session 之後仍可使用）
+                db.close()
+            
+                # 呼叫 LLM（簡單的定義型問題走 fast tier）；預先產生失敗時這裡才是新的 LLM 呼叫，同樣要取得 lane 的 slot
+                tier = get_tier_classifier().classify(user_text, has_history=bool(chat_history))
+                set_span_attribute("tier", tier)
+                fallback_lane = get_scheduler().llm_lane() if prefetch_task is not None else nullcontext(True)
+                async with fallback_lane as admitted:
+                    if not admitted:
+                        reply_busy(line_client, reply_token)
+                        return
+                    response_text = await get_llm_client().get_response(user_text, chat_history, user_id=user_id, tier=tier)
+            
+            # 儲存對話歷史（背景批次寫入並清理舊對話，不等待資料庫）
+            history_buffer.add(user_id, 'user', user_text)
+            history_buffer.add(user_id, 'assistant', response_text)
+            
+            # 回覆使用者（發送新訊息時，載入動畫會自動消失）
+            line_client.reply_text(reply_token, response_text)
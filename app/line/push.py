@@ -0,0 +1,235 @@
+"""
+公告推播（新主題、維護通知等，送給一個頻道的所有使用者）
+
+- 以 server-side cursor 依 line_user_id 排序串流該頻道的使用者 key（見 app/line/channels.py 的 user_key），
+  不會一次載入所有使用者
+- 每 LINE_PUSH_BATCH_SIZE 人（最多 500）組成一個 multicast 請求，最多 LINE_PUSH_CONCURRENCY 個同時送出，
+  整體不超過每秒 LINE_PUSH_RATE 個請求
+- 429 / 5xx / 連線錯誤會重試：429 時依 Retry-After（沒有時指數退避）暫停所有送出中的執行緒；
+  其他 4xx 不重試，該批計入失敗
+- 每批以 X-Line-Retry-Key 送出（由工作 ID 與該批的使用者範圍決定），重試或當機後重送已被接受的批次時
+  LINE 回傳 409，不會重複推播
+- 進度（cursor）存在 push_jobs 表：依序完成的批次才推進 cursor，當機後以同一個工作 ID 從 cursor 之後繼續
+
+繼續執行時批次是從 cursor 之後重新切分；期間新增的使用者只要排在 cursor 之後也會收到。
+"""
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Deque, Optional, Tuple
+from loguru import logger
+from linebot.v3.messaging import ApiException
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.db import crud
+from app.db.session import get_session_factory
+from app.line.channels import DEFAULT_CHANNEL, channel_of, line_user_id_of
+from app.line.client import LINEClient, get_line_client
+from app.metrics import LINE_PUSH_RECIPIENTS_TOTAL, child, record_error
+
+# LINE multicast 每個請求的收件人上限與文字訊息長度上限
+MULTICAST_MAX_RECIPIENTS = 500
+TEXT_MAX_LENGTH = 5000
+
+# 沒有 Retry-After 時的退避（秒）
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# 推播期間每隔多久（秒）記錄一次進度
+PROGRESS_LOG_INTERVAL = 10.0
+
+
+class _RateLimiter:
+    """所有執行緒共用的請求速率上限（平均分散，不累積 burst）"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+    def pause(self, seconds: float):
+        """seconds 秒內不再送出任何請求（收到 429 時）"""
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+@dataclass
+class PushReport:
+    """一次推播執行的結果（resumed 為繼續執行前已送出的人數）"""
+    job_id: str
+    recipients_sent: int = 0
+    recipients_failed: int = 0
+    batches: int = 0
+    retries: int = 0
+    resumed: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def recipients_per_second(self) -> float:
+        return self.recipients_sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def batches_per_second(self) -> float:
+        return self.batches / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def create_push_job(message: str, session_factory: Optional[Callable[[], Session]] = None) -> str:
+    """建立公告推播工作，回傳工作 ID"""
+    if not message.strip():
+        raise ValueError("公告內容不可為空白")
+    if len(message) > TEXT_MAX_LENGTH:
+        raise ValueError(f"公告內容超過 {TEXT_MAX_LENGTH} 字：{len(message)}")
+    job_id = str(uuid.uuid4())
+    with (session_factory or get_session_factory())() as db:
+        crud.create_push_job(db, job_id, message)
+    return job_id
+
+
+def _retry_after(error: ApiException) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AnnouncementPusher:
+    """以 LINE multicast 分批推播公告，可從 push_jobs 的 cursor 繼續"""
+
+    def __init__(
+        self,
+        line_client: Optional[LINEClient] = None,
+        session_factory: Optional[Callable[[], Session]] = None,
+        batch_size: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        rate: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        channel: str = DEFAULT_CHANNEL,
+    ):
+        self.channel = channel
+        self.line_client = line_client or get_line_client(channel)
+        self.session_factory = session_factory or get_session_factory()
+        self.batch_size = min(batch_size or settings.line_push_batch_size, MULTICAST_MAX_RECIPIENTS)
+        self.concurrency = max(1, concurrency or settings.line_push_concurrency)
+        self.max_retries = settings.line_push_max_retries if max_retries is None else max_retries
+        self.limiter = _RateLimiter(settings.line_push_rate if rate is None else rate)
+
+    def _send_batch(self, job_uuid: uuid.UUID, message: str, user_ids: list) -> Tuple[bool, int]:
+        """送出一批，回傳 (是否成功, 重試次數)"""
+        # 同一批（同樣的使用者範圍）不論重試或當機後重送都使用相同的 retry key
+        retry_key = str(uuid.uuid5(job_uuid, f"{user_ids[0]}:{user_ids[-1]}:{len(user_ids)}"))
+        for attempt in range(self.max_retries + 1):
+            self.limiter.wait()
+            try:
+                self.line_client.multicast_text([line_user_id_of(key) for key in user_ids], message, retry_key=retry_key)
+                return True, attempt
+            except ApiException as e:
+                status = e.status or 0
+                if status == 409:
+                    # 這個 retry key 已被接受過（先前的嘗試其實成功了）
+                    return True, attempt
+                record_error("line_multicast", status)
+                if status != 429 and status < 500:
+                    logger.error("公告推播失敗（不重試）: status={}, body={}, 使用者 {}..{}", status, e.body, user_ids[0], user_ids[-1])
+                    return False, attempt
+                delay = _retry_after(e)
+            except Exception as e:
+                record_error("line_multicast", type(e).__name__)
+                delay = None
+                logger.warning("公告推播請求失敗: {}", e)
+            if attempt == self.max_retries:
+                break
+            if delay is None:
+                delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+            # 429 時所有執行緒一起暫停，避免其他批次繼續撞上限
+            self.limiter.pause(delay)
+            time.sleep(delay)
+        logger.error("公告推播重試 {} 次仍失敗，使用者 {}..{}", self.max_retries, user_ids[0], user_ids[-1])
+        return False, self.max_retries
+
+    def run(self, job_id: str) -> PushReport:
+        """執行（或繼續）推播工作，回傳這次執行的結果"""
+        with self.session_factory() as db:
+            job = crud.get_push_job(db, job_id)
+            if job is None:
+                raise ValueError(f"找不到推播工作: {job_id}")
+            message, cursor, status = job.message, job.cursor, job.status
+            total_sent, total_failed = job.recipients_sent, job.recipients_failed
+        report = PushReport(job_id=job_id, resumed=total_sent + total_failed)
+        if status == "completed":
+            logger.info("推播工作 {} 已完成，略過", job_id)
+            return report
+        if cursor is not None and channel_of(cursor) != self.channel:
+            raise ValueError(f"推播工作 {job_id} 是以頻道 {channel_of(cursor)} 送出的，請以相同的 --channel 繼續")
+        if cursor is not None:
+            logger.info("推播工作 {} 從 {} 之後繼續（已處理 {} 人）", job_id, cursor, report.resumed)
+
+        job_uuid = uuid.UUID(job_id)
+        # (該批最後一位使用者, 人數, future)，依送出順序
+        inflight: Deque[Tuple[str, int, Future]] = deque()
+        start = last_log = time.monotonic()
+        stream_db = self.session_factory()
+        checkpoint_db = self.session_factory()
+
+        def complete_head():
+            nonlocal cursor, total_sent, total_failed, last_log
+            last_id, count, future = inflight.popleft()
+            ok, retries = future.result()
+            report.batches += 1
+            report.retries += retries
+            if ok:
+                report.recipients_sent += count
+                total_sent += count
+            else:
+                report.recipients_failed += count
+                total_failed += count
+            child(LINE_PUSH_RECIPIENTS_TOTAL, "sent" if ok else "failed").inc(count)
+            # 前面的批次都已完成，cursor 可以推進到這一批
+            cursor = last_id
+            crud.update_push_job(
+                checkpoint_db, job_id,
+                cursor=cursor, recipients_sent=total_sent, recipients_failed=total_failed,
+            )
+            now = time.monotonic()
+            if now - last_log >= PROGRESS_LOG_INTERVAL:
+                last_log = now
+                logger.info(
+                    "推播進度: 已送出 {} 人、失敗 {} 人（{:.0f} 人/秒）",
+                    total_sent, total_failed, report.recipients_sent / (now - start),
+                )
+
+        executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix="line-push")
+        try:
+            for user_ids in crud.iter_user_id_batches(stream_db, self.batch_size, after=cursor, channel=self.channel):
+                inflight.append((user_ids[-1], len(user_ids), executor.submit(self._send_batch, job_uuid, message, user_ids)))
+                # 已完成的批次依序記錄進度；排隊的批次不超過並行數的兩倍（限制記憶體用量）
+                while inflight and (inflight[0][2].done() or len(inflight) >= self.concurrency * 2):
+                    complete_head()
+            while inflight:
+                complete_head()
+            crud.update_push_job(checkpoint_db, job_id, status="completed")
+        finally:
+            # 發生錯誤時不再送出尚未開始的批次；已送出但未記錄的批次，繼續執行時會以相同的 retry key 重送
+            executor.shutdown(wait=True, cancel_futures=True)
+            stream_db.close()
+            checkpoint_db.close()
+            report.elapsed = time.monotonic() - start
+
+        logger.info(
+            "推播工作 {} 完成: 送出 {} 人、失敗 {} 人、{} 批、重試 {} 次，耗時 {:.1f} 秒（{:.0f} 人/秒）",
+            job_id, report.recipients_sent, report.recipients_failed, report.batches,
+            report.retries, report.elapsed, report.recipients_per_second,
+        )
+        return report
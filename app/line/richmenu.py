@@ -1,18 +1,23 @@
 """
 Rich Menu 上傳功能
 
-在應用程式啟動時自動上傳 Rich Menu 到 LINE Bot
+在應用程式啟動時於背景同步 Rich Menu 到 LINE Bot（每個頻道各自同步）：
+以「選單定義 + 圖片」的內容雜湊判斷是否需要重新上傳，並清除舊的選單
 """
+import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
 from loguru import logger
 from pathlib import Path
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
     MessagingApi,
     MessagingApiBlob,
     ApiException,
     RichMenuRequest,
+    RichMenuResponse,
     RichMenuSize,
     RichMenuArea,
     RichMenuBounds,
@@ -20,11 +25,27 @@ from linebot.v3.messaging import (
     URIAction,
 )
 from app.config import settings
+from app.line.channels import DEFAULT_CHANNEL, get_channels
+from app.line.client import get_api_client
+from app.state import LockTimeoutError, get_shared_state
 
-configuration = Configuration(access_token=settings.line_channel_access_token)
-api_client = ApiClient(configuration)
-messaging_api = MessagingApi(api_client)
-blob_api = MessagingApiBlob(api_client)
+RICH_MENU_NAME = "MetaBear 投資問答選單"
+RICH_MENU_HASH_LENGTH = 12
+RICH_MENU_DELETE_WORKERS = 4
+# 同步（含上傳圖片與刪除舊選單）最多佔用共享鎖的秒數
+RICH_MENU_SYNC_LEASE = 300
+
+
+@lru_cache(maxsize=None)
+def get_messaging_api(channel: str = DEFAULT_CHANNEL) -> MessagingApi:
+    """Rich Menu 用的 MessagingApi（與該頻道的 LINEClient 共用 ApiClient）"""
+    return MessagingApi(get_api_client(channel))
+
+
+@lru_cache(maxsize=None)
+def get_blob_api(channel: str = DEFAULT_CHANNEL) -> MessagingApiBlob:
+    """Rich Menu 圖片上傳用的 MessagingApiBlob"""
+    return MessagingApiBlob(get_api_client(channel))
 
 def create_rich_menu():
     """建立 Rich Menu 定義"""
@@ -61,7 +82,7 @@ def create_rich_menu():
     rich_menu = RichMenuRequest(
         size=RichMenuSize(width=2500, height=1686),
         selected=True,
-        name="MetaBear 投資問答選單",
+        name=RICH_MENU_NAME,
         chat_bar_text="開啟選單",
         areas=[
             # 1. 左上：開啟 LLM
@@ -106,52 +127,54 @@ def create_rich_menu():
     return rich_menu
 
 
-def upload_rich_menu():
-    """上傳 Rich Menu 到 LINE"""
-    
-    # 檢查圖片檔案是否存在（在 app/line/ 目錄下）
-    current_dir = Path(__file__).resolve().parent
-    image_path = current_dir / "rich_menu.png"
-    
-    logger.debug(f"Rich Menu 上傳 - 當前檔案: {__file__}")
-    logger.debug(f"Rich Menu 上傳 - 解析路徑: {image_path}")
-    logger.debug(f"Rich Menu 上傳 - 路徑是否存在: {image_path.exists()}")
-    logger.debug(f"Rich Menu 上傳 - 當前工作目錄: {os.getcwd()}")
-    
-    if not image_path.exists():
-        logger.warning(f"找不到 Rich Menu 圖片：{image_path}")
-        logger.info("Rich Menu 上傳已跳過（圖片檔案不存在）")
-        return False
-    
+def compute_rich_menu_hash(rich_menu: RichMenuRequest, image_data: bytes) -> str:
+    """計算 Rich Menu 定義 + 圖片的內容雜湊（用於判斷是否需要重新上傳）"""
+    definition = json.dumps(rich_menu.to_dict(), sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha256()
+    digest.update(definition.encode("utf-8"))
+    digest.update(image_data)
+    return digest.hexdigest()[:RICH_MENU_HASH_LENGTH]
+
+
+def get_default_rich_menu_id(channel: str = DEFAULT_CHANNEL) -> Optional[str]:
+    """取得目前預設 Rich Menu 的 ID（沒有設定時回傳 None）"""
+    try:
+        return get_messaging_api(channel).get_default_rich_menu_id().rich_menu_id
+    except ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+def get_current_default_rich_menu(channel: str = DEFAULT_CHANNEL) -> Optional[RichMenuResponse]:
+    """取得目前的預設 Rich Menu（沒有設定時回傳 None）"""
+    rich_menu_id = get_default_rich_menu_id(channel)
+    if rich_menu_id is None:
+        return None
+    return get_messaging_api(channel).get_rich_menu(rich_menu_id=rich_menu_id)
+
+
+def upload_rich_menu(rich_menu: RichMenuRequest, image_data: bytes, channel: str = DEFAULT_CHANNEL) -> Optional[str]:
+    """上傳 Rich Menu 到 LINE 並設為預設，成功時回傳 rich_menu_id"""
     try:
         logger.info("正在上傳 Rich Menu...")
-        
-        # 1. 建立 Rich Menu
-        rich_menu = create_rich_menu()
-        if rich_menu is None:
-            logger.warning("Rich Menu 建立已取消（預設連結未設定）")
-            return False
 
+        # 1. 建立 Rich Menu
         try:
-            response = messaging_api.create_rich_menu(rich_menu_request=rich_menu)
+            response = get_messaging_api(channel).create_rich_menu(rich_menu_request=rich_menu)
             rich_menu_id = response.rich_menu_id
             logger.info(f"Rich Menu 已建立，ID: {rich_menu_id}")
         except ApiException as e:
             logger.error(f"建立 Rich Menu 失敗 (API 錯誤): status={e.status}, reason={e.reason}, body={e.body}")
-            return False
+            return None
         except Exception as e:
-            logger.error(f"建立 Rich Menu 失敗: {type(e).__name__}: {e}", exc_info=True)
-            return False
+            logger.opt(exception=True).error(f"建立 Rich Menu 失敗: {type(e).__name__}: {e}")
+            return None
 
         # 2. 上傳圖片（改用 blob_api + Content-Type）
         try:
-            logger.info(f"正在上傳圖片：{image_path}")
-            image_size = image_path.stat().st_size
-            logger.debug(f"圖片大小: {image_size} bytes")
-            with open(image_path, "rb") as f:
-                image_data = f.read()
-
-            blob_api.set_rich_menu_image(
+            logger.debug(f"圖片大小: {len(image_data)} bytes")
+            get_blob_api(channel).set_rich_menu_image(
                 rich_menu_id=rich_menu_id,
                 body=image_data,
                 _headers={"Content-Type": "image/png"},
@@ -159,38 +182,108 @@ def upload_rich_menu():
             logger.info("圖片已上傳")
         except ApiException as e:
             logger.error(f"上傳 Rich Menu 圖片失敗 (API 錯誤): status={e.status}, reason={e.reason}, body={e.body}")
-            return False
+            return None
         except Exception as e:
-            logger.error(f"上傳 Rich Menu 圖片失敗: {type(e).__name__}: {e}", exc_info=True)
-            return False
+            logger.opt(exception=True).error(f"上傳 Rich Menu 圖片失敗: {type(e).__name__}: {e}")
+            return None
 
         # 3. 設為預設 Rich Menu（用真正的 rich_menu_id 字串）
         try:
             logger.info("正在設為預設 Rich Menu...")
-            messaging_api.set_default_rich_menu(rich_menu_id=rich_menu_id)
-            logger.info("✅ Rich Menu 上傳成功！")
-            logger.info(f"Rich Menu ID: {rich_menu_id}")
-            return True
+            get_messaging_api(channel).set_default_rich_menu(rich_menu_id=rich_menu_id)
+            logger.info(f"✅ Rich Menu 上傳成功！ID: {rich_menu_id}")
+            return rich_menu_id
         except ApiException as e:
             logger.error(f"設定預設 Rich Menu 失敗 (API 錯誤): status={e.status}, reason={e.reason}, body={e.body}")
-            return False
+            return None
         except Exception as e:
-            logger.error(f"設定預設 Rich Menu 失敗: {type(e).__name__}: {e}", exc_info=True)
-            return False
-        
+            logger.opt(exception=True).error(f"設定預設 Rich Menu 失敗: {type(e).__name__}: {e}")
+            return None
+
     except Exception as e:
-        logger.error(f"Rich Menu 上傳失敗：{e}", exc_info=True)
+        logger.opt(exception=True).error(f"Rich Menu 上傳失敗：{e}")
+        return None
+
+
+def delete_obsolete_rich_menus(keep_rich_menu_id: str, channel: str = DEFAULT_CHANNEL) -> int:
+    """批次刪除本程式建立、但已不是預設的舊 Rich Menu，回傳刪除數量"""
+    rich_menus = get_messaging_api(channel).get_rich_menu_list().richmenus
+    # 刪除前重新讀取目前的預設選單：其他行程可能在這段期間設定了新的預設選單，不能刪掉線上使用中的選單
+    keep_ids = {keep_rich_menu_id, get_default_rich_menu_id(channel)}
+    obsolete_ids = [
+        menu.rich_menu_id
+        for menu in rich_menus
+        if menu.rich_menu_id not in keep_ids and menu.name.startswith(RICH_MENU_NAME)
+    ]
+    if not obsolete_ids:
+        return 0
+
+    def _delete(rich_menu_id: str) -> bool:
+        try:
+            get_messaging_api(channel).delete_rich_menu(rich_menu_id=rich_menu_id)
+            return True
+        except ApiException as e:
+            logger.warning(f"刪除舊 Rich Menu 失敗: id={rich_menu_id}, status={e.status}")
+            return False
+
+    # LINE 沒有批次刪除 API，改用少量執行緒並行刪除
+    with ThreadPoolExecutor(max_workers=RICH_MENU_DELETE_WORKERS) as executor:
+        deleted = sum(executor.map(_delete, obsolete_ids))
+
+    logger.info(f"已刪除 {deleted}/{len(obsolete_ids)} 個舊 Rich Menu")
+    return deleted
+
+
+def sync_rich_menu(channel: str = DEFAULT_CHANNEL) -> bool:
+    """同步 Rich Menu：內容雜湊與目前預設選單相同時跳過上傳"""
+    image_path = Path(__file__).resolve().parent / "rich_menu.png"
+    if not image_path.exists():
+        logger.warning(f"找不到 Rich Menu 圖片：{image_path}")
+        logger.info("Rich Menu 上傳已跳過（圖片檔案不存在）")
         return False
 
+    image_data = image_path.read_bytes()
+    rich_menu = create_rich_menu()
+    content_hash = compute_rich_menu_hash(rich_menu, image_data)
+    # 雜湊寫在名稱裡，下次啟動時只需讀取預設選單即可比對
+    rich_menu.name = f"{RICH_MENU_NAME} #{content_hash}"
+
+    current = get_current_default_rich_menu(channel)
+    if current is not None and current.name == rich_menu.name:
+        logger.info(f"Rich Menu 未變更（hash: {content_hash}），跳過上傳")
+        rich_menu_id = current.rich_menu_id
+    else:
+        rich_menu_id = upload_rich_menu(rich_menu, image_data, channel)
+        if rich_menu_id is None:
+            return False
+
+    delete_obsolete_rich_menus(rich_menu_id, channel)
+    return True
+
 
 def setup_rich_menu():
-    """設定 Rich Menu（應用程式啟動時呼叫）"""
-    if not settings.line_channel_access_token:
-        logger.warning("LINE_CHANNEL_ACCESS_TOKEN 未設定，跳過 Rich Menu 上傳")
+    """
+    設定所有頻道的 Rich Menu（gunicorn master 在 fork 前呼叫；單一行程時於 lifespan 的背景執行緒呼叫）
+    
+    多個副本同時啟動時只有取得共享鎖的行程同步，其他行程直接跳過。
+    """
+    if not settings.rich_menu_sync_enabled:
+        logger.info("RICH_MENU_SYNC=false，跳過 Rich Menu 同步")
         return
     
     try:
-        upload_rich_menu()
-    except Exception as e:
-        logger.error(f"Rich Menu 設定失敗：{e}", exc_info=True)
+        with get_shared_state().lock("rich_menu", timeout=0, lease=RICH_MENU_SYNC_LEASE):
+            _setup_rich_menus()
+    except LockTimeoutError:
+        logger.info("其他行程正在同步 Rich Menu，跳過")
 
+
+def _setup_rich_menus():
+    for channel, config in get_channels().items():
+        if not config.access_token:
+            logger.warning(f"頻道 {channel} 的 channel access token 未設定，跳過 Rich Menu 上傳")
+            continue
+        try:
+            sync_rich_menu(channel)
+        except Exception as e:
+            logger.opt(exception=True).error(f"頻道 {channel} 的 Rich Menu 設定失敗：{e}")
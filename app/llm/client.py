@@ -1,8 +1,16 @@
+import asyncio
+import time
+from functools import lru_cache
 from loguru import logger
 import httpx
 from app.config import settings
+from app.logging_config import sampled_logger
+from app.metrics import LLM_REQUEST_SECONDS, LLM_TOKENS_TOTAL, child, event_labels, record_error
+from app.tracing import set_span_attribute, span
 from app.llm.prompts import build_user_message
 from app.llm.output_checker import is_trading_question, FALLBACK_RESPONSE
+from app.llm.tiers import REASONING, get_tiers
+from app.llm.usage import get_usage_tracker, parse_usage
 
 
 class LLMClient:
@@ -39,20 +47,39 @@ class LLMClient:
                     if not headers["X-Title"]:
                         # 如果全部被移除，使用預設的 ASCII 值
                         headers["X-Title"] = "Investment Q&A Bot"
-            logger.info(f"使用 OpenRouter，設定 headers: {headers}")
+            # 只記錄 header 名稱，避免把 Authorization 寫進 log
+            logger.info("使用 OpenRouter，設定 headers: {}", sorted(headers))
+        
+        # HTTP/2 需要 h2 套件（httpx[http2]），未安裝時退回 HTTP/1.1
+        self.http2 = settings.llm_http2
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning('LLM_HTTP2=true 但未安裝 h2（pip install "httpx[http2]"），改用 HTTP/1.1')
+                self.http2 = False
         
         # 使用 httpx.AsyncClient 支援異步高併發
+        # keepalive_expiry 預設只有 5 秒，閒置連線會在兩次提問之間被關掉，這裡改為可設定
         self.client = httpx.AsyncClient(
             base_url=self.api_base,
             headers=headers,
             timeout=30.0,
-            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)  # 高併發設定
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_keepalive_connections=20,
+                max_connections=100,
+                keepalive_expiry=settings.upstream_keepalive_expiry
+            )  # 高併發設定
         )
     
     async def get_response(
         self,
         user_text: str,
-        chat_history: list = None
+        chat_history: list = None,
+        user_id: str = None,
+        tier: str = REASONING,
+        response_info: dict = None
     ) -> str:
         """
         取得 LLM 回應（使用 httpx 異步呼叫，支援高併發）
@@ -60,6 +87,10 @@ class LLMClient:
         Args:
             user_text: 使用者輸入文字
             chat_history: 對話歷史（可選）
+            user_id: LINE 使用者 ID（可選，提供時計入每日 token 用量）
+            tier: 回答層級（fast / reasoning，決定模型、reasoning 與 max_tokens）
+            response_info: 可選，成功取得 LLM 回應時寫入 {"usage": ...}；
+                仍為空 dict 代表回傳的是錯誤提示或 fallback 文字
         
         Returns:
             LLM 的回應文字（已通過安全檢查）
@@ -67,44 +98,61 @@ class LLMClient:
         try:
             # 提早攔截明顯的交易建議問題
             if is_trading_question(user_text):
-                logger.warning(f"偵測到交易建議問題，直接返回 fallback: {user_text}")
+                sampled_logger.warning("偵測到交易建議問題，直接返回 fallback: {}", user_text)
                 return FALLBACK_RESPONSE
             
             # 建立訊息
             messages = build_user_message(user_text, chat_history)
             
-            # 準備請求 payload
+            # 準備請求 payload（模型、reasoning 與 max_tokens 依 tier 決定）
+            llm_tier = get_tiers()[tier]
             payload = {
-                "model": self.model,
+                "model": llm_tier.model,
                 "messages": [
                     {"role": msg["role"], "content": msg["content"]}
                     for msg in messages
                 ],
                 "temperature": 0.7,
-                "max_tokens": settings.max_tokens,
-                "reasoning": {"enabled": True}
+                "max_tokens": llm_tier.max_tokens,
+                "reasoning": {"enabled": llm_tier.reasoning}
             }
             
             # 呼叫 LLM API（異步，不阻塞）
-            logger.info(f"呼叫 LLM，模型: {self.model}")
-            response = await self.client.post(
-                "/chat/completions",
-                json=payload
-            )
-            
-            # 檢查 HTTP 狀態碼
-            response.raise_for_status()
+            sampled_logger.info("呼叫 LLM，模型: {}，tier: {}", llm_tier.model, tier)
+            start = time.perf_counter()
+            status = "error"
+            with span("llm.chat_completion", model=llm_tier.model, tier=tier):
+                try:
+                    response = await self.client.post(
+                        "/chat/completions",
+                        json=payload
+                    )
+                    status = str(response.status_code)
+                except httpx.TimeoutException:
+                    status = "timeout"
+                    raise
+                finally:
+                    child(LLM_REQUEST_SECONDS, *event_labels(), tier, status).observe(time.perf_counter() - start)
+                    set_span_attribute("status", status)
+                
+                # 檢查 HTTP 狀態碼
+                response.raise_for_status()
+                
+                # 解析回應
+                data = response.json()
+                self._record_usage(data.get("usage"), user_id)
             
-            # 解析回應
-            data = response.json()
             llm_output = data["choices"][0]["message"]["content"].strip()
-            logger.info(f"LLM 原始回應: {llm_output[:100]}...")
+            if response_info is not None:
+                response_info["usage"] = data.get("usage")
+            sampled_logger.debug("LLM 原始回應: {}...", llm_output[:100])
             
             # 直接返回 LLM 輸出（已移除輸出後的安全檢查）
             return llm_output
             
         except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP 錯誤: {e.response.status_code} - {e.response.text}")
+            logger.error("HTTP 錯誤: {} - {}", e.response.status_code, e.response.text)
+            record_error("llm", e.response.status_code)
             if e.response.status_code == 401:
                 return "API Key 無效，請檢查設定。"
             elif e.response.status_code == 429:
@@ -113,16 +161,59 @@ class LLMClient:
                 return "抱歉，我現在無法回答。請稍後再試，或輸入「選單」查看可以問我的問題。"
         except httpx.TimeoutException:
             logger.error("LLM 請求超時")
+            record_error("llm", "timeout")
             return "請求超時，請稍後再試。"
         except Exception as e:
-            logger.error(f"LLM 呼叫失敗: {e}", exc_info=True)
+            logger.opt(exception=True).error("LLM 呼叫失敗: {}", e)
+            record_error("llm", type(e).__name__)
             return "抱歉，我現在無法回答。請稍後再試，或輸入「選單」查看可以問我的問題。"
     
+    @staticmethod
+    def _record_usage(usage: dict = None, user_id: str = None):
+        """記錄回應中 usage 區塊的 token 數（metrics、trace 與每位使用者的每日用量）"""
+        if user_id:
+            get_usage_tracker().record(user_id, usage)
+        if not usage:
+            return
+        prompt, completion, reasoning, cached = parse_usage(usage)
+        set_span_attribute("prompt_tokens", prompt)
+        set_span_attribute("completion_tokens", completion)
+        labels = event_labels()
+        child(LLM_TOKENS_TOTAL, *labels, "prompt").inc(prompt)
+        child(LLM_TOKENS_TOTAL, *labels, "completion").inc(completion)
+        if reasoning:
+            child(LLM_TOKENS_TOTAL, *labels, "reasoning").inc(reasoning)
+        if cached:
+            child(LLM_TOKENS_TOTAL, *labels, "cached").inc(cached)
+    
+    async def warm(self, connections: int, timeout: float = 3.0) -> int:
+        """
+        預先建立連到 LLM API 的 keep-alive 連線（TCP + TLS 握手），回傳成功的請求數
+        
+        同時送出 connections 個 HEAD 請求，每個請求各佔一條連線；HTTP/2 時一條連線即可多工，只送一個。
+        任何 HTTP 回應（包含 404 / 405）都代表連線已建立。
+        """
+        if self.http2:
+            connections = min(connections, 1)
+        results = await asyncio.gather(
+            *(self.client.head("", timeout=timeout) for _ in range(connections)),
+            return_exceptions=True
+        )
+        return sum(not isinstance(result, Exception) for result in results)
+    
     async def close(self):
         """關閉 httpx client（應用程式關閉時呼叫）"""
         await self.client.aclose()
 
 
-# 全域 LLM client instance
-llm_client = LLMClient()
+@lru_cache(maxsize=None)
+def get_llm_client() -> LLMClient:
+    """取得全域 LLM client instance（第一次使用時才建立）"""
+    return LLMClient()
+
+
+async def close_llm_client():
+    """關閉 LLM client（只有曾經建立過時才需要關閉）"""
+    if get_llm_client.cache_info().currsize:
+        await get_llm_client().close()
 
@@ -0,0 +1,136 @@
+"""
+預先產生主題問題的回答
+
+使用者點選主題（SHOW_TOPIC）後，通常幾秒內就會點選其中一個問題（ASK_QUESTION）。
+啟用 LLM_PREFETCH 時，主題選單送出後就在背景對該主題的每個問題呼叫 LLM，
+點選問題時直接使用已產生（或產生中）的回答，不必從頭等待 LLM。
+
+- 每位使用者只保留最近一次打開的主題；使用者送出任何 LLM 查詢後，其餘未使用的回答都會取消
+  （對話歷史已經改變，先前產生的回答不再適用）
+- 同時進行的預先產生不超過 LLM_PREFETCH_MAX_INFLIGHT 個，超過時略過
+- 預先產生不經過 LLM lane 排隊，但計入 LLM_LANE_CONCURRENCY：lane 有請求排隊，
+  或進行中的查詢加上預先產生已達上限時略過，不和使用者實際送出的查詢搶 slot
+- 未被使用的回答在 LLM_PREFETCH_TTL 秒後丟棄
+- 預先產生的 token 計入 metrics，但只有實際使用的回答才計入使用者的每日額度
+
+狀態存在行程記憶體中；多個 worker 時，ASK_QUESTION 送到其他 worker 就只是未命中。
+"""
+import asyncio
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+from loguru import logger
+from app.config import settings
+from app.llm.client import get_llm_client
+from app.llm.tiers import get_tier_classifier
+from app.metrics import LLM_PREFETCH_TOTAL, child
+from app.scheduler import get_scheduler
+from app.tracing import detach_trace
+
+
+class _Prefetch:
+    """一個預先產生中的回答"""
+    __slots__ = ("task", "expire_handle")
+
+    def __init__(self, task: asyncio.Task, expire_handle: asyncio.TimerHandle):
+        self.task = task
+        self.expire_handle = expire_handle
+
+    def discard(self):
+        self.expire_handle.cancel()
+        if not self.task.done():
+            self.task.cancel()
+
+
+class AnswerPrefetcher:
+    """管理每位使用者預先產生的回答"""
+
+    def __init__(self, max_inflight: int, ttl: float):
+        self.max_inflight = max_inflight
+        self.ttl = ttl
+        # line_user_id -> {question: _Prefetch}
+        self._entries: Dict[str, Dict[str, _Prefetch]] = {}
+        self._inflight = 0
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    @staticmethod
+    async def _generate(question: str, chat_history: List[dict], tier: str) -> Tuple[str, dict]:
+        # 這個 task 可能比觸發它的請求活得更久，不要把 span 記到該請求的 trace
+        detach_trace()
+        response_info: dict = {}
+        text = await get_llm_client().get_response(question, chat_history, tier=tier, response_info=response_info)
+        return text, response_info
+
+    def _task_done(self, task: asyncio.Task):
+        self._inflight -= 1
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("預先產生回答失敗: {}", task.exception())
+
+    def _expire(self, user_id: str, question: str):
+        entries = self._entries.get(user_id)
+        if not entries or question not in entries:
+            return
+        entries.pop(question).discard()
+        if not entries:
+            del self._entries[user_id]
+        child(LLM_PREFETCH_TOTAL, "expired").inc()
+
+    def prefetch(self, user_id: str, questions: Iterable[str], chat_history: List[dict]) -> int:
+        """在背景預先產生 questions 的回答（取代這位使用者先前的預先產生），回傳實際開始的數量"""
+        self.discard(user_id)
+        loop = asyncio.get_running_loop()
+        classifier = get_tier_classifier()
+        scheduler = get_scheduler()
+        entries: Dict[str, _Prefetch] = {}
+        for question in questions:
+            if self._inflight >= self.max_inflight or not scheduler.has_spare_capacity(self._inflight):
+                child(LLM_PREFETCH_TOTAL, "skipped").inc()
+                continue
+            tier = classifier.classify(question, has_history=bool(chat_history))
+            task = asyncio.create_task(self._generate(question, chat_history, tier))
+            self._inflight += 1
+            task.add_done_callback(self._task_done)
+            entries[question] = _Prefetch(task, loop.call_later(self.ttl, self._expire, user_id, question))
+            child(LLM_PREFETCH_TOTAL, "started").inc()
+        if entries:
+            self._entries[user_id] = entries
+        return len(entries)
+
+    def take(self, user_id: str, question: str) -> Optional[asyncio.Task]:
+        """
+        取出 question 的預先產生 task（沒有時為 None）
+
+        這位使用者其他未使用的預先產生一併取消。task 的結果為 (回答, response_info)。
+        """
+        entries = self._entries.pop(user_id, None)
+        if not entries:
+            return None
+        entry = entries.pop(question, None)
+        self._discard_entries(entries)
+        if entry is None:
+            return None
+        entry.expire_handle.cancel()
+        return entry.task
+
+    def _discard_entries(self, entries: Dict[str, _Prefetch]):
+        for entry in entries.values():
+            entry.discard()
+        if entries:
+            child(LLM_PREFETCH_TOTAL, "discarded").inc(len(entries))
+
+    def discard(self, user_id: str):
+        """取消這位使用者所有未使用的預先產生"""
+        self._discard_entries(self._entries.pop(user_id, {}))
+
+    def discard_all(self):
+        """取消所有預先產生（關閉時呼叫）"""
+        for user_id in list(self._entries):
+            self.discard(user_id)
+
+
+@lru_cache(maxsize=None)
+def get_answer_prefetcher() -> AnswerPrefetcher:
+    """取得全域的回答預先產生器"""
+    return AnswerPrefetcher(settings.llm_prefetch_max_inflight, settings.llm_prefetch_ttl)
@@ -0,0 +1,135 @@
+"""
+LLM 回答層級（tier）
+
+簡單的定義型問題（「RSI 是什麼？」）不需要推理模型：改走 fast tier（LLM_FAST_MODEL、關閉 reasoning、
+較小的 max_tokens），需要比較、解釋原因或情境的問題才走 reasoning tier。
+
+判斷完全在本機進行（關鍵字規則 + questions.yaml 的主題名稱），題庫中的問題在載入時就先分類好。
+沒有設定 LLM_FAST_MODEL 時一律走 reasoning tier：推理模型在關閉 reasoning、較小的 max_tokens 下
+可能把 token 用在推理上而回傳空的內容。
+"""
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, Optional
+from app.config import settings
+from app.line.channels import current_channel
+
+FAST = "fast"
+REASONING = "reasoning"
+TIERS = (FAST, REASONING)
+
+# 問「是什麼 / 什麼意思」的定義型問法
+DEFINITION_MARKERS = ("是什麼", "什麼是", "是啥", "什麼意思", "意思是", "定義", "白話", "what is", "what's", "meaning of")
+
+# 需要推理的問法：原因、比較、情境、誤解與風險
+NUANCE_MARKERS = (
+    "為什麼", "為何", "怎麼", "如何", "怎樣", "比較", "不同", "差別", "差異", "關係", "背離",
+    "誤解", "誤判", "不準", "風險", "情況", "假的", "同時", "why", "how", " vs", "compare", "difference",
+)
+
+# 接續上一輪對話的開頭（需要結合上下文）
+FOLLOW_UP_PREFIXES = ("那", "所以", "如果", "可是", "但是", "不過", "還有")
+
+# 超過這個長度的問題通常帶有情境，直接走 reasoning
+MAX_FAST_LENGTH = 40
+
+_LABEL_SPLIT = re.compile(r"[（）()、/]")
+
+# 英數字的主題名稱前後不可緊接英數字（「oi」不可比對到「coin」、「point」）
+_ASCII_TERM = re.compile(r"^[a-z0-9 ]+$")
+
+
+@dataclass(frozen=True)
+class LLMTier:
+    """一個 tier 的呼叫參數"""
+    name: str
+    model: str
+    max_tokens: int
+    reasoning: bool
+
+
+@lru_cache(maxsize=None)
+def get_tiers() -> Dict[str, LLMTier]:
+    """取得各 tier 的設定（沒有設定 LLM_FAST_MODEL 時 fast tier 與 reasoning tier 相同）"""
+    reasoning = LLMTier(REASONING, settings.llm_model, settings.max_tokens, True)
+    if not settings.llm_fast_model:
+        return {FAST: LLMTier(FAST, reasoning.model, reasoning.max_tokens, reasoning.reasoning), REASONING: reasoning}
+    return {
+        FAST: LLMTier(FAST, settings.llm_fast_model, settings.llm_fast_max_tokens, settings.llm_fast_reasoning),
+        REASONING: reasoning,
+    }
+
+
+def _term_pattern(terms: Iterable[str]) -> Optional[re.Pattern]:
+    """比對任一主題名稱的 regex（沒有主題時為 None）"""
+    parts = [
+        rf"(?<![a-z0-9]){re.escape(term)}(?![a-z0-9])" if _ASCII_TERM.match(term) else re.escape(term)
+        for term in terms
+    ]
+    return re.compile("|".join(parts)) if parts else None
+
+
+def topic_terms(question_data: dict) -> set:
+    """從題庫取出主題名稱（key、選單標籤與顯示名稱，括號內外分開），皆為小寫"""
+    names = []
+    for topic in question_data.get("menu", {}).get("topics", []):
+        names += [topic.get("key", ""), topic.get("label", "")]
+    for key, topic in question_data.get("topics", {}).items():
+        names += [key, topic.get("display_name", "")]
+    terms = set()
+    for name in names:
+        for part in _LABEL_SPLIT.split(name):
+            part = part.strip().lower()
+            if part.endswith("指標"):  # 「RSI 指標」也要能比對「RSI 是什麼」
+                part = part[:-2].strip()
+            if part:
+                terms.add(part)
+    return terms
+
+
+class TierClassifier:
+    """以規則判斷問題該走哪個 tier"""
+
+    def __init__(self, terms: Iterable[str], known_questions: Iterable[str] = ()):
+        self.terms = tuple(sorted(set(terms), key=len, reverse=True))
+        self._term_pattern = _term_pattern(self.terms)
+        # 題庫問題預先分類，ASK_QUESTION 只需要一次 dict 查詢
+        self._known = {question.strip(): self._classify(question.strip().lower(), False) for question in known_questions}
+
+    def _classify(self, text: str, has_history: bool) -> str:
+        if len(text) > MAX_FAST_LENGTH:
+            return REASONING
+        if any(marker in text for marker in NUANCE_MARKERS):
+            return REASONING
+        if has_history and text.startswith(FOLLOW_UP_PREFIXES):
+            return REASONING
+        if any(marker in text for marker in DEFINITION_MARKERS) and self._mentions_topic(text):
+            return FAST
+        return REASONING
+
+    def _mentions_topic(self, text: str) -> bool:
+        return self._term_pattern is not None and self._term_pattern.search(text) is not None
+
+    def classify(self, user_text: str, has_history: bool = False) -> str:
+        """回傳 FAST 或 REASONING"""
+        if not settings.llm_tiering_enabled or not settings.llm_fast_model:
+            return REASONING
+        text = user_text.strip()
+        known = self._known.get(text)
+        if known is not None:
+            return known
+        return self._classify(text.lower(), has_history)
+
+
+def get_tier_classifier(channel: Optional[str] = None) -> TierClassifier:
+    """取得頻道的 tier 分類器（預設為目前處理中的頻道；以該頻道題庫的主題與問題建立）"""
+    return _get_tier_classifier(channel or current_channel())
+
+
+@lru_cache(maxsize=None)
+def _get_tier_classifier(channel: str) -> TierClassifier:
+    from app.line.client import get_question_manager
+    data = get_question_manager(channel).data
+    questions = [q for topic in data.get("topics", {}).values() for q in topic.get("questions", [])]
+    return TierClassifier(topic_terms(data), questions)
@@ -0,0 +1,172 @@
+"""
+LLM token 用量統計與每日額度
+
+每次 LLM 回應的 usage（prompt / completion / reasoning / cached tokens）先在記憶體中依
+(使用者, 日期) 彙總，由背景 task 每 LLM_USAGE_FLUSH_INTERVAL 秒以一個批次 upsert 寫入
+llm_usage_daily，熱路徑上不會多出任何 SQL。
+
+每日額度（LLM_DAILY_TOKEN_BUDGET）以記憶體中的當日累計判斷，呼叫 LLM 前的檢查只是一次 dict 查詢。
+啟動後第一次 flush 前會先載入資料庫中當日已寫入的用量；多個 worker 時各自只看得到自己的增量與
+啟動時載入的值，額度是「大約」的上限。
+"""
+import asyncio
+import time
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+from loguru import logger
+from app.config import settings
+from app.db import crud
+from app.db.session import create_session
+from app.metrics import LLM_USAGE_FLUSH_SECONDS, record_error, timed
+
+# 彙總中的計數順序與 crud.LLM_USAGE_COUNTERS 相同
+_REQUESTS, _PROMPT, _COMPLETION, _REASONING, _CACHED = range(5)
+
+
+def parse_usage(usage: Optional[dict]) -> Tuple[int, int, int, int]:
+    """從 OpenAI 相容的 usage 區塊取出 (prompt, completion, reasoning, cached) tokens"""
+    if not usage:
+        return 0, 0, 0, 0
+    completion_details = usage.get("completion_tokens_details") or {}
+    prompt_details = usage.get("prompt_tokens_details") or {}
+    return (
+        usage.get("prompt_tokens") or 0,
+        usage.get("completion_tokens") or 0,
+        completion_details.get("reasoning_tokens") or 0,
+        prompt_details.get("cached_tokens") or 0,
+    )
+
+
+class UsageTracker:
+    """在記憶體彙總 token 用量並定期批次寫入資料庫"""
+
+    def __init__(self, daily_budget: int, flush_interval: float, timezone: str):
+        self.daily_budget = daily_budget
+        self.flush_interval = flush_interval
+        self._tz = ZoneInfo(timezone)
+        self._day = self.today()
+        # 尚未寫入資料庫的增量：(user_id, date) -> [requests, prompt, completion, reasoning, cached]
+        self._pending: Dict[Tuple[str, date], List[int]] = {}
+        # 當日每位使用者已用的 token 總數（額度檢查用）
+        self._totals: Dict[str, int] = {}
+        self._loaded = False
+        self._task: Optional[asyncio.Task] = None
+
+    def today(self) -> date:
+        """取得目前的統計日期（依 USAGE_TIMEZONE 換日）"""
+        return datetime.now(self._tz).date()
+
+    def _roll_day(self) -> date:
+        """換日時清空當日累計（尚未寫入的增量保留原日期）"""
+        day = self.today()
+        if day != self._day:
+            self._day = day
+            self._totals = {}
+        return day
+
+    def record(self, user_id: str, usage: Optional[dict]):
+        """記錄一次 LLM 呼叫的用量"""
+        prompt, completion, reasoning, cached = parse_usage(usage)
+        day = self._roll_day()
+        counts = self._pending.get((user_id, day))
+        if counts is None:
+            counts = self._pending[(user_id, day)] = [0, 0, 0, 0, 0]
+        counts[_REQUESTS] += 1
+        counts[_PROMPT] += prompt
+        counts[_COMPLETION] += completion
+        counts[_REASONING] += reasoning
+        counts[_CACHED] += cached
+        self._totals[user_id] = self._totals.get(user_id, 0) + prompt + completion
+
+    def used_today(self, user_id: str) -> int:
+        """取得使用者今日已用的 token 數"""
+        self._roll_day()
+        return self._totals.get(user_id, 0)
+
+    def is_over_budget(self, user_id: str) -> bool:
+        """使用者今日是否已用完額度（未設定額度時永遠為 False）"""
+        return self.daily_budget > 0 and self.used_today(user_id) >= self.daily_budget
+
+    def _load_totals(self, day: date) -> Dict[str, int]:
+        """從資料庫載入當日用量（在執行緒中執行）"""
+        db = create_session()
+        try:
+            return crud.get_llm_usage_totals(db, day)
+        finally:
+            db.close()
+
+    def _write(self, pending: Dict[Tuple[str, date], List[int]]):
+        """把彙總的增量寫入資料庫（在執行緒中執行）"""
+        rows = [
+            dict(zip(crud.LLM_USAGE_COUNTERS, counts), line_user_id=user_id, usage_date=day)
+            for (user_id, day), counts in pending.items()
+        ]
+        db = create_session()
+        try:
+            with timed(LLM_USAGE_FLUSH_SECONDS):
+                crud.upsert_llm_usage(db, rows)
+        finally:
+            db.close()
+
+    async def flush(self):
+        """寫入目前累積的增量（失敗時放回，下次再寫）"""
+        if not self._loaded:
+            day = self._day
+            loaded = await asyncio.to_thread(self._load_totals, day)
+            # 尚未 flush 過，記憶體中的累計都是本行程的增量，直接加上資料庫的值
+            if day == self._day:
+                for user_id, tokens in loaded.items():
+                    self._totals[user_id] = self._totals.get(user_id, 0) + tokens
+            self._loaded = True
+
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write, pending)
+        except Exception as e:
+            logger.error("寫入 token 用量失敗（{} 筆，稍後重試）: {}", len(pending), e)
+            record_error("llm_usage_flush", type(e).__name__)
+            for key, counts in pending.items():
+                merged = self._pending.setdefault(key, [0, 0, 0, 0, 0])
+                for i, value in enumerate(counts):
+                    merged[i] += value
+
+    async def _run(self):
+        """背景定期 flush"""
+        while True:
+            started = time.monotonic()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("token 用量背景 flush 失敗: {}", e)
+            await asyncio.sleep(max(0.0, self.flush_interval - (time.monotonic() - started)))
+
+    def start(self):
+        """啟動背景 flush task（在 lifespan 中呼叫）"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止背景 task 並寫入剩餘的用量"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._loaded = True  # 關閉時不需要再載入當日用量
+        await self.flush()
+
+
+@lru_cache(maxsize=None)
+def get_usage_tracker() -> UsageTracker:
+    """取得全域 token 用量統計"""
+    return UsageTracker(
+        settings.llm_daily_token_budget,
+        settings.llm_usage_flush_interval,
+        settings.usage_timezone,
+    )
@@ -0,0 +1,119 @@
+"""
+Log 設定
+
+- enqueue=True：log 由 loguru 的背景執行緒寫出，請求路徑上不做 I/O
+- 取樣：每則訊息都會出現的 log 使用 sampled_logger，依 LOG_SAMPLE_RATES 各等級的比例保留
+  （WARNING 以上一律保留）
+- 遮蔽：輸出前把 Bearer token 與設定中的金鑰替換成 ***（訊息與 exception traceback 都會處理）
+
+熱路徑上的 log 請用 `logger.info("... {}", value)` 的參數形式（低於 LOG_LEVEL 時不會格式化），
+需要組大字串時用 `logger.opt(lazy=True)`。
+"""
+import random
+import re
+import sys
+import traceback
+from loguru import logger
+from app.config import settings
+
+# 每則訊息都會出現的 log 使用這個 logger，才會被取樣
+sampled_logger = logger.bind(sampled=True)
+
+REDACTED = "***"
+WARNING_LEVEL_NO = 30
+BEARER_PATTERN = re.compile(r"(Bearer\s+)[A-Za-z0-9._~+/=-]+", re.IGNORECASE)
+LOG_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+)
+
+
+def parse_sample_rates(value: str) -> dict:
+    """解析 LOG_SAMPLE_RATES，例如 "DEBUG=0,INFO=0.1" """
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        level, rate = item.split("=")
+        rates[level.strip().upper()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+def _secrets() -> list[str]:
+    """需要遮蔽的設定值（太短的值不處理，避免誤傷一般文字）"""
+    values = [
+        settings.llm_api_key,
+        settings.line_channel_access_token,
+        settings.line_channel_secret,
+        settings.admin_token,
+        settings.webhook_capture_salt,
+    ]
+    # LINE_CHANNELS 中其他頻道的金鑰（設定錯誤時由 lifespan 啟動時回報）
+    try:
+        from app.line.channels import get_channels
+        for channel in get_channels().values():
+            values += [channel.channel_secret, channel.access_token]
+    except ValueError:
+        pass
+    return [value for value in values if value and len(value) >= 8]
+
+
+def _redact_text(text: str, secrets: list[str]) -> str:
+    if "earer" in text:
+        text = BEARER_PATTERN.sub(rf"\1{REDACTED}", text)
+    for secret in secrets:
+        if secret in text:
+            text = text.replace(secret, REDACTED)
+    return text
+
+
+def make_redactor(secrets: list[str]):
+    """
+    建立 loguru patcher：遮蔽訊息中的 Bearer token 與金鑰
+
+    exception 的 traceback 在這裡先格式化並遮蔽，存在 extra["exception_text"]（由 format_record 輸出），
+    record["exception"] 改為 None，sink 不會再輸出未遮蔽的 traceback。
+    """
+    def redact(record):
+        record["message"] = _redact_text(record["message"], secrets)
+        exception = record["exception"]
+        if exception is not None:
+            text = "".join(traceback.format_exception(exception.type, exception.value, exception.traceback))
+            record["extra"]["exception_text"] = _redact_text(text, secrets)
+            record["exception"] = None
+    return redact
+
+
+def format_record(record) -> str:
+    """loguru format：LOG_FORMAT 加上（已遮蔽的）exception traceback"""
+    if "exception_text" in record["extra"]:
+        return LOG_FORMAT + "\n{extra[exception_text]}"
+    return LOG_FORMAT + "\n"
+
+
+def make_sampling_filter(rates: dict):
+    """建立 loguru filter：只對 sampled_logger 的紀錄依等級取樣"""
+    def sample(record) -> bool:
+        if not record["extra"].get("sampled") or record["level"].no >= WARNING_LEVEL_NO:
+            return True
+        rate = rates.get(record["level"].name)
+        return rate is None or rate >= 1.0 or random.random() < rate
+    return sample
+
+
+def setup_logging():
+    """設定 loguru（應用程式啟動時呼叫一次）"""
+    logger.remove()
+    logger.configure(patcher=make_redactor(_secrets()))
+    logger.add(
+        sys.stderr,
+        level=settings.log_level,
+        format=format_record,
+        filter=make_sampling_filter(parse_sample_rates(settings.log_sample_rates)),
+        enqueue=settings.log_enqueue,
+        backtrace=False,
+        diagnose=False,
+    )
+
+
+async def flush_logging():
+    """等待背景執行緒寫完所有 log（應用程式關閉時呼叫）"""
+    await logger.complete()
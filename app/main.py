@@ -1,39 +1,92 @@
+import asyncio
+import hmac
+import time
 from loguru import logger
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, Response
 
+from app.capture import close_webhook_capture, get_webhook_capture
 from app.config import settings
+from app.logging_config import flush_logging, setup_logging
+from app.metrics import record_error, render_metrics
+from app.tracing import start_trace
 from app.db.session import run_migrations
+from app.line.channels import DEFAULT_CHANNEL, get_channels
 from app.line.handlers import handle_line_webhook
 
+setup_logging()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """應用程式生命週期管理"""
     logger.info("啟動 LINE Bot...")
     
-    # 自動執行資料庫 migrations
-    try:
-        run_migrations()
-    except Exception as e:
-        logger.error(f"資料庫 migrations 失敗，應用程式無法啟動：{e}")
-        raise
+    # 自動執行資料庫 migrations（schema 已是最新版本時會直接跳過）
+    if settings.run_migrations_on_startup:
+        try:
+            run_migrations()
+        except Exception as e:
+            logger.error(f"資料庫 migrations 失敗，應用程式無法啟動：{e}")
+            raise
     
-    # 自動上傳 Rich Menu
-    try:
-        from app.line.richmenu import setup_rich_menu
-        setup_rich_menu()
-    except Exception as e:
-        logger.warning(f"Rich Menu 上傳失敗（可忽略）：{e}")
+    # 讀取所有 LINE 頻道的設定（LINE_CHANNELS 設定錯誤時在啟動時就失敗）
+    channels = get_channels()
+    if len(channels) > 1:
+        logger.info("LINE 頻道: {}", ", ".join(channels))
+    
+    # 建立共享狀態（SHARED_STATE_BACKEND 設定錯誤時在啟動時就失敗）
+    from app.state import get_shared_state
+    get_shared_state()
+    
+    # 在背景同步 Rich Menu，不阻塞 webhook 的接收
+    from app.line.richmenu import setup_rich_menu
+    rich_menu_task = asyncio.create_task(asyncio.to_thread(setup_rich_menu))
+    
+    # 定期把記憶體中彙總的 token 用量寫入資料庫
+    from app.llm.usage import get_usage_tracker
+    usage_tracker = get_usage_tracker()
+    usage_tracker.start()
+    
+    # 對話歷史在背景批次寫入
+    from app.db.history_buffer import get_history_buffer
+    history_buffer = get_history_buffer()
+    history_buffer.start()
+    
+    # 在背景批次清理舊對話（寫入路徑不再做刪除）
+    from app.db.retention import get_chat_history_sweeper
+    history_sweeper = get_chat_history_sweeper()
+    history_sweeper.start()
+    
+    # 先建立連到 LLM / LINE API 的 keep-alive 連線，第一個請求不必等 TLS 握手
+    from app.warmup import get_upstream_warmer
+    upstream_warmer = get_upstream_warmer()
+    if upstream_warmer.connections > 0:
+        warm_start = time.perf_counter()
+        warmed = await upstream_warmer.warm()
+        logger.info("已預熱上游連線 {}（{:.0f} ms）", warmed, (time.perf_counter() - warm_start) * 1000)
+    upstream_warmer.start()
     
     # 啟動時初始化完成
     yield
     
     # 關閉時清理資源
     logger.info("關閉 LINE Bot...")
-    from app.llm.client import llm_client
-    await llm_client.close()  # 關閉 httpx client
+    if not rich_menu_task.done():
+        rich_menu_task.cancel()
+    await upstream_warmer.stop()
+    from app.llm.prefetch import get_answer_prefetcher
+    get_answer_prefetcher().discard_all()  # 取消尚未使用的預先產生回答
+    from app.llm.client import close_llm_client
+    await close_llm_client()  # 關閉 httpx client
+    from app.line.client import close_loading_http_client
+    close_loading_http_client()
+    await history_sweeper.stop()  # 中止進行中的清理（下次從同一個時間點重新檢查）
+    await history_buffer.stop()  # 寫入尚未 flush 的對話歷史
+    await usage_tracker.stop()  # 寫入尚未 flush 的 token 用量
+    close_webhook_capture()  # 寫完尚未寫入的擷取紀錄
+    await flush_logging()  # 等待背景執行緒寫完 log
 
 
 app = FastAPI(
@@ -50,32 +103,93 @@ async def root():
     return {"status": "ok", "message": "LINE Bot is running"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics 端點"""
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+def require_admin(request: Request):
+    """檢查管理員 token（未設定 ADMIN_TOKEN 時視為端點不存在）"""
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization, f"Bearer {settings.admin_token}"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+@app.post("/debug/profile", dependencies=[Depends(require_admin)])
+async def debug_profile(
+    seconds: float = 10.0,
+    format: str = "collapsed",
+    interval_ms: float = 5.0,
+    block_threshold_ms: float = 100.0
+):
+    """取樣目前行程 N 秒，回傳 collapsed stack 或 pstats，以及 event loop 阻塞片段"""
+    from app.profiler import ProfilerBusyError, run_profile
+    
+    try:
+        return await run_profile(seconds, format, interval_ms, block_threshold_ms)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.post("/webhook/line")
 async def webhook(request: Request):
-    """LINE Webhook 端點"""
+    """LINE Webhook 端點（default 頻道）"""
+    return await handle_webhook_request(request, DEFAULT_CHANNEL)
+
+
+@app.post("/webhook/line/{channel}")
+async def channel_webhook(request: Request, channel: str):
+    """LINE Webhook 端點（LINE_CHANNELS 中的其他頻道）"""
+    if channel not in get_channels():
+        record_error("webhook", 404)
+        raise HTTPException(status_code=404, detail="Unknown channel")
+    return await handle_webhook_request(request, channel)
+
+
+async def handle_webhook_request(request: Request, channel: str):
+    """驗證並處理一個頻道的 webhook 請求"""
     # 取得 LINE signature
     signature = request.headers.get("X-Line-Signature")
     if not signature:
+        record_error("webhook", 400)
         raise HTTPException(status_code=400, detail="Missing X-Line-Signature header")
     
     # 取得 request body
     body = await request.body()
     body_str = body.decode("utf-8")
     
+    received_at = time.time()
+    start = time.perf_counter()
+    status = 500
     try:
-        await handle_line_webhook(body_str, signature)
+        with start_trace("webhook", body_bytes=len(body)):
+            await handle_line_webhook(body_str, signature, channel)
+        status = 200
         return JSONResponse(content={"status": "ok"})
     except Exception as e:
-        logger.error(f"Webhook 處理錯誤: {e}", exc_info=True)
+        logger.opt(exception=True).error("Webhook 處理錯誤: {}", e)
+        record_error("webhook", 500)
         raise HTTPException(status_code=500, detail="Internal Server Error")
+    finally:
+        # 擷取流量供重播（未啟用時為 None）
+        capture = get_webhook_capture()
+        if capture is not None:
+            capture.record(body, signature, status, (time.perf_counter() - start) * 1000, received_at, channel)
 
 
 if __name__ == "__main__":
+    # 開發用（單一 worker）；正式環境請使用 python -m app.server
     import uvicorn
     uvicorn.run(
         "app.main:app",
         host=settings.host,
         port=settings.port,
-        log_level="debug"
+        log_level=settings.log_level.lower()
     )
 
@@ -0,0 +1,259 @@
+"""
+Prometheus metrics
+
+所有 metrics 都註冊在 prometheus_client 的預設 registry，由 `GET /metrics` 輸出。
+事件類型與 action 透過 contextvars 傳遞，crud / LLM / LINE 的量測不需要額外參數就能帶上 label。
+
+多個 worker 時（app.server 設定 PROMETHEUS_MULTIPROC_DIR）使用 prometheus_client 的 multiprocess 模式：
+每個 worker 把 counter / histogram 寫入該目錄的檔案，/metrics 輸出所有 worker 的加總。
+scrape 時才讀取的 collector（連線池狀態）以 register_process_collector() 註冊，只反映回應該次請求的 worker。
+"""
+import os
+import time
+from contextvars import ContextVar
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# 已知的 action（其他值一律記為 OTHER，避免使用者輸入造成 label 爆量）
+ACTIONS = ("SHOW_TOPIC", "ASK_QUESTION", "TOGGLE_LLM", "MENU", "FREE_TEXT")
+EVENT_TYPES = ("message", "postback")
+
+FAST_BUCKETS = (0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+DB_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+NETWORK_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+QUEUE_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 資料庫連線池：等待取得連線的時間（包含池內無連線時建立新連線）
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "linebot_db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the database pool",
+    ["pool"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+
+DB_STATEMENTS_TOTAL = Counter(
+    "linebot_db_statements_total",
+    "SQL statements executed",
+    ["pool"],
+)
+
+DB_READ_ROUTING_TOTAL = Counter(
+    "linebot_db_read_routing_total",
+    "Read-only crud queries by target (replica, or primary because the user wrote recently)",
+    ["target"],
+)
+
+SIGNATURE_VERIFY_SECONDS = Histogram(
+    "linebot_signature_verify_seconds",
+    "Time spent verifying the X-Line-Signature header",
+    buckets=FAST_BUCKETS,
+)
+
+WEBHOOK_PARSE_SECONDS = Histogram(
+    "linebot_webhook_parse_seconds",
+    "Time spent parsing the webhook JSON body",
+    buckets=FAST_BUCKETS,
+)
+
+EVENTS_TOTAL = Counter(
+    "linebot_events_total",
+    "Webhook events handled",
+    ["channel", "event", "action"],
+)
+
+DUPLICATE_EVENTS_TOTAL = Counter(
+    "linebot_duplicate_events_total",
+    "Redelivered webhook events skipped because their webhookEventId was already handled",
+)
+
+DB_QUERY_SECONDS = Histogram(
+    "linebot_db_query_seconds",
+    "Time spent in each crud call",
+    ["operation", "event", "action"],
+    buckets=DB_BUCKETS,
+)
+
+LLM_REQUEST_SECONDS = Histogram(
+    "linebot_llm_request_seconds",
+    "LLM chat completion latency",
+    ["event", "action", "tier", "status"],
+    buckets=NETWORK_BUCKETS,
+)
+
+LLM_TOKENS_TOTAL = Counter(
+    "linebot_llm_tokens_total",
+    "Tokens reported in the LLM response usage block",
+    ["event", "action", "kind"],
+)
+
+LLM_BUDGET_EXCEEDED_TOTAL = Counter(
+    "linebot_llm_budget_exceeded_total",
+    "LLM requests refused because the user's daily token budget is used up",
+    ["event", "action"],
+)
+
+LLM_PREFETCH_TOTAL = Counter(
+    "linebot_llm_prefetch_total",
+    "Speculative topic answer generations by outcome",
+    ["outcome"],
+)
+
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    "linebot_llm_queue_wait_seconds",
+    "Time LLM queries waited for a slot in the LLM lane",
+    buckets=QUEUE_BUCKETS,
+)
+
+LLM_SHED_TOTAL = Counter(
+    "linebot_llm_shed_total",
+    "LLM queries answered with a busy reply because the LLM lane queue was too long",
+    ["event", "action"],
+)
+
+LLM_USAGE_FLUSH_SECONDS = Histogram(
+    "linebot_llm_usage_flush_seconds",
+    "Time spent writing aggregated token usage to the database",
+    buckets=DB_BUCKETS,
+)
+
+CHAT_HISTORY_SWEEP_SECONDS = Histogram(
+    "linebot_chat_history_sweep_seconds",
+    "Duration of one chat_history retention sweep (including pauses between batches)",
+    buckets=NETWORK_BUCKETS,
+)
+
+CHAT_HISTORY_DROPPED_TOTAL = Counter(
+    "linebot_chat_history_dropped_total",
+    "Chat messages dropped by the write-behind buffer (reason: write_failed, overflow, shutdown)",
+    ["reason"],
+)
+
+CHAT_HISTORY_SWEPT_TOTAL = Counter(
+    "linebot_chat_history_swept_total",
+    "chat_history rows deleted by the retention sweeper (reason: keep_last, expired)",
+    ["reason"],
+)
+
+LINE_REPLY_SECONDS = Histogram(
+    "linebot_line_reply_seconds",
+    "LINE reply API latency",
+    ["event", "action"],
+    buckets=NETWORK_BUCKETS,
+)
+
+LINE_PUSH_BATCH_SECONDS = Histogram(
+    "linebot_line_push_batch_seconds",
+    "LINE multicast API latency per batch (each attempt)",
+    buckets=NETWORK_BUCKETS,
+)
+
+LINE_PUSH_RECIPIENTS_TOTAL = Counter(
+    "linebot_line_push_recipients_total",
+    "Announcement recipients by outcome",
+    ["outcome"],
+)
+
+UPSTREAM_WARM_SECONDS = Histogram(
+    "linebot_upstream_warm_seconds",
+    "Time spent pre-establishing / keeping warm upstream connections",
+    ["upstream"],
+    buckets=NETWORK_BUCKETS,
+)
+
+CACHE_REQUESTS_TOTAL = Counter(
+    "linebot_cache_requests_total",
+    "Cache lookups by result",
+    ["cache", "result"],
+)
+
+ERRORS_TOTAL = Counter(
+    "linebot_errors_total",
+    "Errors by stage and code (HTTP status or exception name)",
+    ["stage", "code", "event", "action"],
+)
+
+_current_event: ContextVar[str] = ContextVar("metrics_event", default="none")
+_current_action: ContextVar[str] = ContextVar("metrics_action", default="none")
+
+
+def set_event_labels(event_type: str, action: str = "none"):
+    """設定目前事件的 label（每個 webhook 事件開始處理時呼叫）"""
+    _current_event.set(event_type if event_type in EVENT_TYPES else "other")
+    _current_action.set(action if action in ACTIONS or action == "none" else "OTHER")
+
+
+def set_action_label(action: str):
+    """更新目前事件的 action label（例如判斷出是選單關鍵字後）"""
+    _current_action.set(action if action in ACTIONS else "OTHER")
+
+
+def event_labels() -> tuple[str, str]:
+    """取得目前事件的 (event, action) label"""
+    return _current_event.get(), _current_action.get()
+
+
+# metric.labels() 每次都要驗證並加鎖，熱路徑上改查這個 dict
+# （label 值都已正規化為有限集合，數量有上限）
+_children: dict = {}
+
+
+def child(metric, *labels: str):
+    """取得帶 label 的 metric child（快取）"""
+    key = (id(metric), labels)
+    metric_child = _children.get(key)
+    if metric_child is None:
+        metric_child = _children[key] = metric.labels(*labels)
+    return metric_child
+
+
+class Timer:
+    """量測區塊耗時並記錄到 histogram（比 @contextmanager 便宜，適合熱路徑）"""
+    __slots__ = ("_metric", "_start")
+
+    def __init__(self, metric):
+        self._metric = metric
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metric.observe(time.perf_counter() - self._start)
+        return False
+
+
+def timed(histogram: Histogram, *labels: str) -> Timer:
+    """量測區塊耗時並記錄到 histogram"""
+    return Timer(child(histogram, *labels) if labels else histogram)
+
+
+def record_error(stage: str, code) -> None:
+    """記錄錯誤（code 為 HTTP status 或例外名稱）"""
+    child(ERRORS_TOTAL, stage, str(code), *event_labels()).inc()
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """記錄快取命中 / 未命中"""
+    child(CACHE_REQUESTS_TOTAL, cache, "hit" if hit else "miss").inc()
+
+
+# scrape 時讀取行程內狀態的 collector（multiprocess 模式下另外加入）
+_process_collectors = []
+
+
+def register_process_collector(collector) -> None:
+    """註冊 scrape 時才讀取行程內狀態的 collector"""
+    REGISTRY.register(collector)
+    _process_collectors.append(collector)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """輸出 Prometheus text format，回傳 (內容, Content-Type)（multiprocess 模式下為所有 worker 的加總）"""
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return generate_latest(), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in _process_collectors:
+        registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
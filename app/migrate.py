@@ -0,0 +1,31 @@
+"""
+資料庫 migrations 獨立執行入口
+
+正式環境建議在擴展 web workers 之前先執行一次：
+    python -m app.migrate
+並設定 RUN_MIGRATIONS_ON_STARTUP=false，讓 web workers 啟動時不再處理 migrations。
+"""
+import argparse
+import sys
+from loguru import logger
+
+from app.db.session import is_schema_up_to_date, run_migrations
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="執行資料庫 migrations")
+    parser.add_argument("--check", action="store_true", help="只檢查 schema 是否為最新版本（不是時回傳 1）")
+    parser.add_argument("--force", action="store_true", help="略過版本比對，一律執行 alembic upgrade")
+    args = parser.parse_args()
+
+    if args.check:
+        up_to_date = is_schema_up_to_date()
+        logger.info(f"資料庫 schema {'已是' if up_to_date else '不是'}最新版本")
+        return 0 if up_to_date else 1
+
+    run_migrations(force=args.force)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
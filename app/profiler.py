@@ -0,0 +1,183 @@
+"""
+隨選取樣 profiler（正式環境診斷用）
+
+只有在呼叫 /debug/profile 的期間才會啟動，平常不會有任何背景執行緒或 hook：
+- collapsed：背景執行緒每隔 interval 讀取所有執行緒的 stack（sys._current_frames），
+  輸出 flamegraph.pl / speedscope 可讀的 collapsed stack 格式
+- pstats：在 event loop 執行緒啟用 cProfile，輸出 pstats 二進位檔
+兩種模式都會同時偵測 event loop 被阻塞超過門檻的片段，並記錄當時的 stack。
+"""
+import asyncio
+import base64
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+PROFILE_FORMATS = ("collapsed", "pstats")
+MAX_PROFILE_SECONDS = 60.0
+HEARTBEAT_INTERVAL = 0.01
+
+PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+
+# 同一時間只允許一個 profile
+_profile_lock = asyncio.Lock()
+
+
+class ProfilerBusyError(RuntimeError):
+    """已經有 profile 正在執行"""
+
+
+def _frame_label(code) -> str:
+    """frame 的顯示名稱：函式 (檔案:行號)"""
+    filename = code.co_filename
+    if filename.startswith(PROJECT_ROOT):
+        filename = os.path.relpath(filename, PROJECT_ROOT)
+    else:
+        filename = "/".join(Path(filename).parts[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    """把 frame 轉成 root;...;leaf 的字串"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class _Sampler(threading.Thread):
+    """取樣執行緒：收集 stack，並偵測 event loop 阻塞"""
+
+    def __init__(
+        self,
+        loop_thread_id: int,
+        interval: float,
+        block_threshold: float,
+        sample_stacks: bool
+    ):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.sample_stacks = sample_stacks
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.blocking_episodes: list[dict] = []
+        self.last_heartbeat = time.monotonic()
+        self._stop_event = threading.Event()
+        self._blocked_since: Optional[float] = None
+        self._blocked_stack: Optional[str] = None
+
+    def heartbeat(self):
+        self.last_heartbeat = time.monotonic()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._finish_episode(time.monotonic())
+
+    def run(self):
+        thread_names = {}
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            if self.sample_stacks:
+                for thread in threading.enumerate():
+                    thread_names[thread.ident] = thread.name
+                for thread_id, frame in frames.items():
+                    if thread_id == self.ident:
+                        continue
+                    name = thread_names.get(thread_id, str(thread_id))
+                    self.stacks[f"{name};{_collapse(frame)}"] += 1
+                self.samples += 1
+            self._check_event_loop(frames.get(self.loop_thread_id))
+
+    def _check_event_loop(self, loop_frame):
+        now = time.monotonic()
+        if now - self.last_heartbeat >= self.block_threshold:
+            if self._blocked_since is None:
+                self._blocked_since = self.last_heartbeat
+                # 阻塞期間記錄第一次偵測到的 stack（通常就是卡住的地方）
+                self._blocked_stack = _collapse(loop_frame) if loop_frame is not None else None
+        else:
+            self._finish_episode(now)
+
+    def _finish_episode(self, now: float):
+        if self._blocked_since is None:
+            return
+        self.blocking_episodes.append({
+            "duration_ms": round((min(now, self.last_heartbeat) - self._blocked_since) * 1000, 1),
+            "stack": self._blocked_stack,
+        })
+        self._blocked_since = None
+        self._blocked_stack = None
+
+
+async def _heartbeat(sampler: _Sampler):
+    while True:
+        sampler.heartbeat()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+def _dump_pstats(profile: cProfile.Profile) -> bytes:
+    """取得與 pstats.Stats.dump_stats() 相同格式的內容"""
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
+
+
+async def run_profile(
+    seconds: float,
+    profile_format: str = "collapsed",
+    interval_ms: float = 5.0,
+    block_threshold_ms: float = 100.0
+) -> dict:
+    """對目前行程取樣 seconds 秒，回傳 profile 結果與 event loop 阻塞片段"""
+    if profile_format not in PROFILE_FORMATS:
+        raise ValueError(f"format 必須是 {PROFILE_FORMATS} 之一")
+    # interval_ms 為 0 時取樣執行緒會不停地執行（not > 0 也排除 NaN）
+    if not interval_ms > 0:
+        raise ValueError("interval_ms 必須大於 0")
+    if not block_threshold_ms > 0:
+        raise ValueError("block_threshold_ms 必須大於 0")
+    seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+    if _profile_lock.locked():
+        raise ProfilerBusyError("已經有 profile 正在執行")
+
+    async with _profile_lock:
+        sampler = _Sampler(
+            loop_thread_id=threading.get_ident(),
+            interval=interval_ms / 1000,
+            block_threshold=block_threshold_ms / 1000,
+            sample_stacks=profile_format == "collapsed",
+        )
+        profile = cProfile.Profile() if profile_format == "pstats" else None
+        heartbeat_task = asyncio.create_task(_heartbeat(sampler))
+        sampler.start()
+        if profile is not None:
+            profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            if profile is not None:
+                profile.disable()
+            heartbeat_task.cancel()
+            sampler.stop()
+
+    if profile is not None:
+        content = base64.b64encode(_dump_pstats(profile)).decode("ascii")
+    else:
+        content = "\n".join(f"{stack} {count}" for stack, count in sampler.stacks.most_common())
+
+    return {
+        "format": profile_format,
+        "duration_s": seconds,
+        "samples": sampler.samples,
+        "profile": content,
+        "blocking_episodes": sampler.blocking_episodes,
+    }
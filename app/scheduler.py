@@ -0,0 +1,118 @@
+"""
+事件優先順序與 load shedding
+
+選單、SHOW_TOPIC、TOGGLE_LLM 這類事件只需要幾毫秒，LLM 查詢卻要數秒到數十秒；兩者在同一個 worker 上競爭時，
+大量的 LLM 查詢（每個都有同步的 DB 讀取、載入動畫與回覆）會拖慢所有人的導覽操作。
+
+事件分成兩個 lane：
+
+- interactive：選單、主題、設定等便宜的事件，不排隊、不設上限，永遠先於 LLM 工作執行
+- llm：同時進行的 LLM 查詢最多 LLM_LANE_CONCURRENCY 個，其餘依到達順序排隊；
+  排在最前面的請求已等待超過 LLM_SHED_QUEUE_WAIT 秒時，新的 LLM 查詢直接回覆「忙碌中」，
+  而不是讓每個使用者的等待時間一起變長
+
+上限是每個 worker 各自計算。
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Deque, Tuple
+from app.config import settings
+from app.metrics import LLM_QUEUE_WAIT_SECONDS
+from app.tracing import set_span_attribute
+
+
+class LaneScheduler:
+    """LLM lane 的並行上限、排隊與 load shedding"""
+
+    def __init__(self, llm_concurrency: int, shed_queue_wait: float):
+        self.llm_concurrency = llm_concurrency
+        self.shed_queue_wait = shed_queue_wait
+        self._llm_inflight = 0
+        # (開始排隊的時間, 取得 slot 時完成的 future)，依到達順序
+        self._waiters: Deque[Tuple[float, asyncio.Future]] = deque()
+
+    @property
+    def llm_inflight(self) -> int:
+        return self._llm_inflight
+
+    @property
+    def llm_queued(self) -> int:
+        return len(self._waiters)
+
+    def queue_wait(self, now: float = None) -> float:
+        """排在最前面的 LLM 查詢已等待的秒數（沒有排隊時為 0）"""
+        if not self._waiters:
+            return 0.0
+        return (now or time.monotonic()) - self._waiters[0][0]
+
+    def should_shed(self, now: float = None) -> bool:
+        """LLM lane 的排隊時間是否已超過門檻"""
+        return self.shed_queue_wait > 0 and self.queue_wait(now) > self.shed_queue_wait
+
+    def has_spare_capacity(self, reserved: int = 0) -> bool:
+        """
+        LLM lane 是否還有空閒的 slot（預先產生等投機性工作在開始前檢查）
+
+        reserved 是已在 lane 之外進行中的投機性查詢數，一併計入上限；有請求排隊時一律為 False。
+        """
+        if self.llm_concurrency <= 0:
+            return True
+        return not self._waiters and self._llm_inflight + reserved < self.llm_concurrency
+
+    def _release(self):
+        # slot 直接交給下一個仍在等待的請求，沒有人等待時才減少並行數
+        while self._waiters:
+            _, future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._llm_inflight -= 1
+
+    async def _acquire(self, start: float):
+        if self._llm_inflight < self.llm_concurrency and not self._waiters:
+            self._llm_inflight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (start, future)
+        self._waiters.append(entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已經拿到 slot 才被取消，交給下一個
+                self._release()
+            else:
+                self._waiters.remove(entry)
+            raise
+
+    @asynccontextmanager
+    async def llm_lane(self) -> AsyncIterator[bool]:
+        """
+        取得 LLM lane 的 slot，yield 是否獲准執行
+
+        False 表示排隊時間已超過門檻（應回覆忙碌訊息）；LLM_LANE_CONCURRENCY 為 0 時不限制。
+        """
+        if self.llm_concurrency <= 0:
+            yield True
+            return
+        start = time.monotonic()
+        if self.should_shed(start):
+            yield False
+            return
+        await self._acquire(start)
+        waited = time.monotonic() - start
+        LLM_QUEUE_WAIT_SECONDS.observe(waited)
+        set_span_attribute("llm_queue_ms", round(waited * 1000, 1))
+        try:
+            yield True
+        finally:
+            self._release()
+
+
+@lru_cache(maxsize=None)
+def get_scheduler() -> LaneScheduler:
+    """取得全域的事件排程器"""
+    return LaneScheduler(settings.llm_lane_concurrency, settings.llm_shed_queue_wait)
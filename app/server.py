@@ -0,0 +1,178 @@
+"""
+正式環境啟動入口
+
+以 gunicorn 管理多個 uvicorn worker（uvloop + httptools），設定都來自 Settings（WEB_* 環境變數）：
+
+    python -m app.server
+
+- WEB_WORKERS 個 worker 行程，master 會自動重啟異常結束的 worker
+- WEB_PRELOAD：master 先 import app 再 fork，worker 啟動更快、共用唯讀記憶體
+- SIGTERM 時停止接受新連線，等待處理中的 webhook（含其中的事件）完成後才結束，
+  lifespan 的收尾（寫入對話歷史與 token 用量、flush log）也會執行；超過 WEB_GRACEFUL_TIMEOUT 秒才強制結束
+- WEB_MAX_REQUESTS：每個 worker 處理指定數量的請求後重啟（加上 WEB_MAX_REQUESTS_JITTER 的隨機量，
+  避免所有 worker 同時重啟），可限制長時間執行造成的記憶體成長
+
+多個 worker 時以 prometheus_client 的 multiprocess 模式彙總 metrics：PROMETHEUS_MULTIPROC_DIR
+（未設定時建立暫存目錄）在啟動時清空，/metrics 輸出所有 worker（含已重啟的 worker）的加總。
+
+多個 worker 時共享狀態必須使用 database：SHARED_STATE_BACKEND 未設定時自動改用，明確設定為 memory 時拒絕啟動。
+
+資料庫 migrations 與 Rich Menu 同步只在 master 執行一次（RUN_MIGRATIONS_ON_STARTUP / RICH_MENU_SYNC），
+worker 不再各自處理（各自上傳再刪除其他選單時，可能刪掉另一個 worker 剛設為預設的選單）。
+開發時仍可使用 `python -m app.main`（單一 worker）。
+"""
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from gunicorn.app.base import BaseApplication
+from loguru import logger
+from uvicorn.workers import UvicornWorker
+
+from app.config import settings
+
+# SIGTERM 後保留給 lifespan 收尾的秒數（uvicorn 等待處理中請求的時間 = graceful timeout - 此值）
+SHUTDOWN_RESERVE_SECONDS = 5
+
+
+class LineBotWorker(UvicornWorker):
+    """依 Settings 設定 event loop 與 HTTP parser 的 uvicorn worker"""
+    CONFIG_KWARGS = {
+        "loop": settings.web_loop,
+        "http": settings.web_http,
+        "lifespan": "on",
+        "timeout_graceful_shutdown": max(1, settings.web_graceful_timeout - SHUTDOWN_RESERVE_SECONDS),
+    }
+
+
+class LineBotServer(BaseApplication):
+    """以程式設定 gunicorn（不讀取 gunicorn.conf.py 或命令列參數）"""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app.main import app
+        return app
+
+
+def build_options() -> dict:
+    """由 Settings 產生 gunicorn 設定"""
+    return {
+        "bind": f"{settings.host}:{settings.port}",
+        "workers": settings.web_workers,
+        "worker_class": f"{LineBotWorker.__module__}.{LineBotWorker.__name__}",
+        "preload_app": settings.web_preload,
+        "graceful_timeout": settings.web_graceful_timeout,
+        "timeout": settings.web_worker_timeout,
+        "keepalive": settings.web_keepalive,
+        "max_requests": settings.web_max_requests,
+        "max_requests_jitter": settings.web_max_requests_jitter,
+        "loglevel": settings.log_level.lower(),
+        "accesslog": None,
+    }
+
+
+def prepare_metrics_dir() -> bool:
+    """
+    多個 worker 時設定 PROMETHEUS_MULTIPROC_DIR 並清空上次執行留下的檔案，回傳是否建立了暫存目錄
+
+    prometheus_client 在 import 時決定是否使用 multiprocess 模式，必須在 import app 的其他模組之前呼叫。
+    """
+    if settings.web_workers <= 1:
+        return False
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    created = not directory
+    if created:
+        directory = tempfile.mkdtemp(prefix="linebot-metrics-")
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    for stale in path.glob("*.db"):
+        stale.unlink()
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = str(path)
+    return created
+
+
+def choose_shared_state_backend() -> bool:
+    """
+    多個 worker 時使用 database 共享狀態，回傳是否可以啟動
+
+    未設定 SHARED_STATE_BACKEND 時改用 database；明確設定為 memory 時拒絕啟動
+    （每個 worker 各自去重事件、各自搶到清理對話歷史的間隔、read-your-writes 只在同一個 worker 內有效）。
+    """
+    if settings.web_workers <= 1:
+        return True
+    if not settings.shared_state_backend:
+        settings.shared_state_backend = "database"
+        logger.info("{} 個 worker：共享狀態使用 database（SHARED_STATE_BACKEND 未設定）", settings.web_workers)
+    elif settings.shared_state_backend == "memory":
+        logger.error(
+            "SHARED_STATE_BACKEND=memory 無法在 {} 個 worker 之間共享狀態，請改為 database 或設定 WEB_WORKERS=1",
+            settings.web_workers,
+        )
+        return False
+    return True
+
+
+def migrate_once():
+    """在 fork worker 之前執行 migrations，並關閉 master 的連線（子行程不能共用連線）"""
+    if not settings.run_migrations_on_startup:
+        return
+    from app.db.session import get_engine, run_migrations
+    run_migrations()
+    get_engine().dispose()
+    # worker 繼承這個 settings 物件，lifespan 中不會再執行一次
+    settings.run_migrations_on_startup = False
+
+
+def sync_rich_menu_once():
+    """在 fork worker 之前同步 Rich Menu，並關閉 master 的 LINE API 連線與資料庫連線"""
+    if not settings.rich_menu_sync_enabled:
+        return
+    from app.db.session import get_engine
+    from app.line.client import reset_api_clients
+    from app.line.richmenu import get_blob_api, get_messaging_api, setup_rich_menu
+    try:
+        setup_rich_menu()
+    except Exception as e:
+        # 同步失敗不影響服務啟動（例如 LINE API 暫時無法連線），下次部署時再同步
+        logger.opt(exception=True).error("Rich Menu 同步失敗：{}", e)
+    get_messaging_api.cache_clear()
+    get_blob_api.cache_clear()
+    reset_api_clients()
+    if settings.shared_state_backend == "database":
+        get_engine().dispose()
+    # worker 繼承這個 settings 物件，lifespan 中不會再同步一次
+    settings.rich_menu_sync_enabled = False
+
+
+def main():
+    if not choose_shared_state_backend():
+        sys.exit(2)
+    # worker 繼承這個 settings 物件，依實際的行程數調整行程內的快取
+    settings.worker_processes = settings.web_workers
+    temporary_metrics_dir = prepare_metrics_dir()
+    try:
+        migrate_once()
+        sync_rich_menu_once()
+        options = build_options()
+        logger.info(
+            "啟動 {} 個 worker（loop={}，http={}，preload={}，max_requests={}）",
+            settings.web_workers, settings.web_loop, settings.web_http,
+            settings.web_preload, settings.web_max_requests,
+        )
+        LineBotServer(options).run()
+    finally:
+        if temporary_metrics_dir:
+            shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
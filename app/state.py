@@ -0,0 +1,259 @@
+"""
+跨 worker 共享狀態
+
+快取、事件去重、節流等狀態如果只存在行程記憶體中，開多個 uvicorn worker 或多個副本時就會失準。
+這裡提供一個小介面（字串值、原子遞增、TTL、互斥鎖），依 SHARED_STATE_BACKEND 選擇實作：
+
+- memory：行程內 dict（單一 worker / 開發用；未設定 SHARED_STATE_BACKEND 時的預設，
+  python -m app.server 啟動多個 worker 時除外）
+- database：存在 DATABASE_URL 的 shared_state 表（migration 003；PostgreSQL 上為 UNLOGGED table，
+  不寫 WAL，重啟後可能清空，適合這類可重建的狀態），鎖使用 PostgreSQL advisory lock
+
+TTL 以秒為單位；過期的 key 視為不存在，並定期批次清除。
+"""
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from app.config import settings
+
+SHARED_STATE_BACKENDS = ("memory", "database")
+
+# 每隔多久（秒）順便清除一次過期的 key
+PURGE_INTERVAL = 60.0
+
+
+class LockTimeoutError(TimeoutError):
+    """在時限內無法取得共享鎖"""
+
+
+class SharedState(ABC):
+    """共享狀態介面"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """取得值（不存在或已過期時為 None）"""
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        """設定值（覆蓋既有的值與 TTL）"""
+
+    @abstractmethod
+    def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """key 不存在（或已過期）時才設定，回傳是否設定成功（可用於去重）"""
+
+    @abstractmethod
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """
+        原子遞增並回傳新值
+
+        ttl 只在 key 建立（或過期後重新建立）時生效，適合固定時間窗的計數 / 節流。
+        """
+
+    @abstractmethod
+    def delete(self, key: str):
+        """刪除 key"""
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 10.0, lease: float = 30.0) -> Iterator[None]:
+        """
+        跨 worker 互斥鎖
+
+        預設以 set_if_absent 實作（lease 秒後自動失效，避免持有者當掉後永遠鎖住）。
+        """
+        key = f"lock:{name}"
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        while not self.set_if_absent(key, "1", ttl=lease):
+            if time.monotonic() >= deadline:
+                raise LockTimeoutError(f"無法取得共享鎖 {name}")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            yield
+        finally:
+            self.delete(key)
+
+
+class MemoryState(SharedState):
+    """行程內的共享狀態（只在單一 worker 內有效）"""
+
+    def __init__(self):
+        # key -> [value, counter, expires_at]
+        self._data: Dict[str, list] = {}
+        self._mutex = threading.Lock()
+        self._next_purge = time.time() + PURGE_INTERVAL
+
+    def _live(self, key: str, now: float) -> Optional[list]:
+        entry = self._data.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def _maybe_purge(self, now: float):
+        if now >= self._next_purge:
+            self._next_purge = now + PURGE_INTERVAL
+            expired = [key for key, entry in self._data.items() if entry[2] is not None and entry[2] <= now]
+            for key in expired:
+                del self._data[key]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._mutex:
+            entry = self._live(key, time.time())
+            if entry is None:
+                return None
+            return entry[0] if entry[0] is not None else str(entry[1])
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        now = time.time()
+        with self._mutex:
+            self._data[key] = [value, 0, now + ttl if ttl else None]
+            self._maybe_purge(now)
+
+    def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        now = time.time()
+        with self._mutex:
+            if self._live(key, now) is not None:
+                return False
+            self._data[key] = [value, 0, now + ttl if ttl else None]
+            self._maybe_purge(now)
+            return True
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        with self._mutex:
+            entry = self._live(key, now)
+            if entry is None:
+                entry = self._data[key] = [None, 0, now + ttl if ttl else None]
+                self._maybe_purge(now)
+            entry[1] += amount
+            return entry[1]
+
+    def delete(self, key: str):
+        with self._mutex:
+            self._data.pop(key, None)
+
+
+# 過期條件（expires_at 為 epoch 秒，NULL 表示不過期）
+_EXPIRED = "shared_state.expires_at IS NOT NULL AND shared_state.expires_at <= :now"
+
+
+class DatabaseState(SharedState):
+    """存在資料庫 shared_state 表的共享狀態（PostgreSQL；SQLite 也可用於開發與測試）"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.is_postgres = engine.dialect.name == "postgresql"
+        self._next_purge = time.time() + PURGE_INTERVAL
+
+    def _execute(self, sql: str, **params) -> List[tuple]:
+        with self.engine.begin() as conn:
+            result = conn.execute(text(sql), params)
+            return result.fetchall() if result.returns_rows else []
+
+    def _maybe_purge(self, now: float):
+        if now >= self._next_purge:
+            self._next_purge = now + PURGE_INTERVAL
+            self.purge_expired(now)
+
+    def purge_expired(self, now: Optional[float] = None):
+        """批次刪除已過期的 key"""
+        self._execute(f"DELETE FROM shared_state WHERE {_EXPIRED}", now=now or time.time())
+
+    def get(self, key: str) -> Optional[str]:
+        rows = self._execute(
+            "SELECT value, counter FROM shared_state "
+            f"WHERE key = :key AND NOT ({_EXPIRED})",
+            key=key, now=time.time(),
+        )
+        if not rows:
+            return None
+        value, counter = rows[0]
+        return value if value is not None else str(counter)
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        now = time.time()
+        self._execute(
+            "INSERT INTO shared_state (key, value, counter, expires_at) VALUES (:key, :value, 0, :expires_at) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, counter = 0, expires_at = excluded.expires_at",
+            key=key, value=value, expires_at=now + ttl if ttl else None,
+        )
+        self._maybe_purge(now)
+
+    def set_if_absent(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        now = time.time()
+        # 衝突時只有在既有的 key 已過期才覆蓋；沒有覆蓋時 RETURNING 不會回傳任何列
+        rows = self._execute(
+            "INSERT INTO shared_state (key, value, counter, expires_at) VALUES (:key, :value, 0, :expires_at) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, counter = 0, expires_at = excluded.expires_at "
+            f"WHERE {_EXPIRED} "
+            "RETURNING key",
+            key=key, value=value, expires_at=now + ttl if ttl else None, now=now,
+        )
+        self._maybe_purge(now)
+        return bool(rows)
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        # 單一 upsert 在資料庫端完成讀取與寫入，多個 worker 同時遞增也不會遺失
+        rows = self._execute(
+            "INSERT INTO shared_state (key, value, counter, expires_at) VALUES (:key, NULL, :amount, :expires_at) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            f"counter = CASE WHEN {_EXPIRED} THEN :amount ELSE shared_state.counter + :amount END, "
+            f"expires_at = CASE WHEN {_EXPIRED} THEN excluded.expires_at ELSE shared_state.expires_at END, "
+            "value = NULL "
+            "RETURNING counter",
+            key=key, amount=amount, expires_at=now + ttl if ttl else None, now=now,
+        )
+        self._maybe_purge(now)
+        return rows[0][0]
+
+    def delete(self, key: str):
+        self._execute("DELETE FROM shared_state WHERE key = :key", key=key)
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 10.0, lease: float = 30.0) -> Iterator[None]:
+        """PostgreSQL 使用 session advisory lock（持有期間佔用一條連線）；其他資料庫沿用預設實作"""
+        if not self.is_postgres:
+            with super().lock(name, timeout=timeout, lease=lease):
+                yield
+            return
+
+        lock_key = zlib.crc32(f"shared_state:{name}".encode("utf-8"))
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        with self.engine.connect() as conn:
+            while not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": lock_key}).scalar():
+                conn.rollback()
+                if time.monotonic() >= deadline:
+                    raise LockTimeoutError(f"無法取得共享鎖 {name}")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+            conn.commit()
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": lock_key})
+                conn.commit()
+
+
+def create_shared_state(backend: str) -> SharedState:
+    """依名稱建立共享狀態實作"""
+    if backend == "memory":
+        return MemoryState()
+    if backend == "database":
+        from app.db.session import get_engine
+        return DatabaseState(get_engine())
+    raise ValueError(f"SHARED_STATE_BACKEND 必須是 {', '.join(SHARED_STATE_BACKENDS)} 其中之一，目前為 {backend!r}")
+
+
+@lru_cache(maxsize=None)
+def get_shared_state() -> SharedState:
+    """取得全域共享狀態（依 SHARED_STATE_BACKEND）"""
+    return create_shared_state(settings.shared_state_backend or "memory")
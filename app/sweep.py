@@ -0,0 +1,44 @@
+"""
+對話歷史清理獨立執行入口
+
+web workers 會在背景定期清理（CHAT_HISTORY_SWEEP_INTERVAL）；這裡可以在部署或排程（cron）時手動執行：
+    python -m app.sweep                  # 從上次清理的時間點清理一次
+    python -m app.sweep --full           # 檢查所有使用者
+    # PostgreSQL：把 chat_history 轉為以月份分割（只需執行一次，離峰時間執行）
+    python -m app.sweep --convert-partitions
+"""
+import argparse
+import sys
+from loguru import logger
+
+from app.db.partitions import convert_chat_history
+from app.db.retention import get_chat_history_sweeper
+from app.db.session import get_engine
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="清理 chat_history 的舊對話")
+    parser.add_argument("--full", action="store_true", help="檢查所有使用者（預設只檢查上次清理後有新對話的）")
+    parser.add_argument("--convert-partitions", action="store_true", help="把 chat_history 轉為以月份分割（PostgreSQL）")
+    args = parser.parse_args()
+
+    if args.convert_partitions:
+        try:
+            converted = convert_chat_history(get_engine())
+        except ValueError as e:
+            logger.error(str(e))
+            return 2
+        if not converted:
+            logger.info("chat_history 已經是以月份分割")
+        return 0
+
+    report = get_chat_history_sweeper().run_once(full=args.full)
+    logger.info(
+        "超出保留則數 {} 筆、過期 {} 筆、partition {}、封存 {} 筆（{:.1f} 秒）",
+        report.keep_last, report.expired, report.partitions or "無", report.archived, report.elapsed
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+輕量 tracing
+
+webhook 收到請求時建立一個 trace，之後 handlers / crud / LLMClient / LINEClient 透過 span()
+記錄各階段耗時。trace 與目前的 span 放在 contextvars 中，不需要在函式之間傳遞參數；
+沒有 trace 時 span() 幾乎沒有成本。
+
+每個事件結束時輸出一行結構化的摘要 log（db / llm / line 各花多少時間）；
+設定 TRACE_EXPORT_PATH 時，另外把整個 trace 以 OTLP JSON 格式逐行寫入檔案
+（可用 OpenTelemetry Collector 的 filelog / otlpjsonfile receiver 讀取）。
+"""
+import json
+import queue
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+from loguru import logger
+from app.config import settings
+from app.logging_config import sampled_logger
+
+# 摘要中統計的類別（span 名稱的前綴）
+SUMMARY_CATEGORIES = ("db", "llm", "line")
+
+
+class Span:
+    """一段有名稱與耗時的工作"""
+    __slots__ = ("name", "span_id", "parent", "start_ns", "end_ns", "attributes")
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent = parent
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+
+    @property
+    def category(self) -> str:
+        return self.name.split(".", 1)[0]
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1_000_000
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+
+class Trace:
+    """一次 webhook 請求的所有 span"""
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: list[Span] = []
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class _SpanContext:
+    """span() 回傳的 context manager"""
+    __slots__ = ("_name", "_attributes", "_span", "_token")
+
+    def __init__(self, name: str, attributes: dict):
+        self._name = name
+        self._attributes = attributes
+        self._span = None
+        self._token = None
+
+    def __enter__(self) -> Optional[Span]:
+        if _current_trace.get() is None:
+            return None
+        self._span = Span(self._name, _current_span.get(), self._attributes)
+        self._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return False
+        self._span.end_ns = time.time_ns()
+        if exc_type is not None:
+            self._span.attributes["error"] = exc_type.__name__
+        _current_span.reset(self._token)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append(self._span)
+        return False
+
+
+def span(name: str, **attributes) -> _SpanContext:
+    """記錄一個 span（名稱建議以 db. / llm. / line. 開頭以便統計）"""
+    return _SpanContext(name, attributes)
+
+
+def set_span_attribute(key: str, value):
+    """在目前的 span 加上屬性（沒有 trace 時忽略）"""
+    current = _current_span.get()
+    if current is not None:
+        current.set_attribute(key, value)
+
+
+def detach_trace():
+    """讓目前的 task 不再記錄到所屬請求的 trace（請求結束後仍在執行的背景 task 使用）"""
+    _current_trace.set(None)
+    _current_span.set(None)
+
+
+def current_trace_id() -> Optional[str]:
+    """目前的 trace ID（沒有 trace 時為 None）"""
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+class _TraceContext:
+    """start_trace() 回傳的 context manager：建立 trace 與根 span，結束時匯出"""
+
+    def __init__(self, name: str, attributes: dict):
+        self._trace = Trace()
+        self._span_context = _SpanContext(name, attributes)
+        self._token = None
+
+    def __enter__(self) -> Trace:
+        self._token = _current_trace.set(self._trace)
+        self._span_context.__enter__()
+        return self._trace
+
+    def __exit__(self, exc_type, exc, tb):
+        self._span_context.__exit__(exc_type, exc, tb)
+        _current_trace.reset(self._token)
+        if settings.trace_export_path:
+            get_exporter().export(self._trace)
+        return False
+
+
+def start_trace(name: str, **attributes) -> _TraceContext:
+    """建立新的 trace（webhook 每個請求呼叫一次）"""
+    return _TraceContext(name, attributes)
+
+
+def _is_descendant(item: Span, ancestor: Span) -> bool:
+    """item 是否為 ancestor 底下的 span"""
+    parent = item.parent
+    while parent is not None:
+        if parent is ancestor:
+            return True
+        parent = parent.parent
+    return False
+
+
+def _has_same_category_ancestor(item: Span, root: Span) -> bool:
+    """item 與 root 之間是否有同類別的 span（例如 crud 內呼叫另一個 crud）"""
+    parent = item.parent
+    while parent is not None and parent is not root:
+        if parent.category == item.category:
+            return True
+        parent = parent.parent
+    return False
+
+
+def summarize(root: Span, spans: list[Span]) -> dict:
+    """統計 root 底下各類別花費的時間（巢狀的同類別 span 不重複計算）"""
+    totals = {category: 0.0 for category in SUMMARY_CATEGORIES}
+    for item in spans:
+        if item.category in totals and _is_descendant(item, root) \
+                and not _has_same_category_ancestor(item, root):
+            totals[item.category] += item.duration_ms
+    return totals
+
+
+def log_event_summary(event_span: Optional[Span], **fields):
+    """事件處理完成後輸出一行結構化摘要（依 LOG_SAMPLE_RATES 取樣，低於 LOG_LEVEL 時不組摘要）"""
+    trace = _current_trace.get()
+    if event_span is None or trace is None:
+        return
+    sampled_logger.opt(lazy=True).info("trace summary {}", lambda: _event_summary(trace, event_span, fields))
+
+
+def _event_summary(trace: "Trace", event_span: Span, fields: dict) -> str:
+    totals = summarize(event_span, trace.spans)
+    # 呼叫 LLM 的事件附上使用的 tier，方便依 tier 比較延遲
+    tier = next(
+        (item.attributes["tier"] for item in trace.spans
+         if "tier" in item.attributes and _is_descendant(item, event_span)),
+        None,
+    )
+    if tier is not None:
+        fields["llm_tier"] = tier
+    summary = {
+        "trace_id": trace.trace_id,
+        **fields,
+        "total_ms": round(event_span.duration_ms, 1),
+        **{f"{category}_ms": round(value, 1) for category, value in totals.items()},
+        "spans": [
+            [item.name, round(item.duration_ms, 1)]
+            for item in trace.spans
+            if _is_descendant(item, event_span)
+        ],
+    }
+    return json.dumps(summary, ensure_ascii=False)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp_json(trace: Trace) -> dict:
+    """轉成 OTLP/JSON 的 ExportTraceServiceRequest 格式"""
+    spans = []
+    for item in trace.spans:
+        otlp_span = {
+            "traceId": trace.trace_id,
+            "spanId": item.span_id,
+            "name": item.name,
+            "kind": 1,
+            "startTimeUnixNano": str(item.start_ns),
+            "endTimeUnixNano": str(item.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()
+            ],
+        }
+        if item.parent is not None:
+            otlp_span["parentSpanId"] = item.parent.span_id
+        spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {
+                "attributes": [{"key": "service.name", "value": {"stringValue": settings.trace_service_name}}]
+            },
+            "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class FileTraceExporter:
+    """在背景執行緒把 trace 以 OTLP JSON lines 寫入本機檔案"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, trace: Trace):
+        self._queue.put(trace)
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(to_otlp_json(trace), ensure_ascii=False) + "\n")
+            except Exception as e:
+                logger.warning(f"寫入 trace 檔案失敗: {e}")
+
+
+_exporter: Optional[FileTraceExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> FileTraceExporter:
+    """取得檔案 exporter（第一次匯出時才建立背景執行緒）"""
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = FileTraceExporter(settings.trace_export_path)
+    return _exporter
@@ -0,0 +1,97 @@
+"""
+上游連線預熱
+
+第一個使用者請求不應該替 TCP + TLS 握手付費：lifespan 啟動時先對 LLM API 與 LINE API 各建立
+UPSTREAM_WARM_CONNECTIONS 條 keep-alive 連線，之後每 UPSTREAM_KEEPWARM_INTERVAL 秒再 ping 一次，
+讓閒置的連線不會被上游或本機的 keepalive_expiry 關掉（被關掉的連線也會在 ping 時重新建立）。
+
+預熱失敗只記錄 log，不影響啟動；請求時仍會照常建立新連線。
+"""
+import asyncio
+import time
+from functools import lru_cache
+from typing import Dict, Optional
+from loguru import logger
+from app.config import settings
+from app.metrics import UPSTREAM_WARM_SECONDS, record_error
+
+
+class UpstreamWarmer:
+    """預先建立並定期保持上游 keep-alive 連線"""
+
+    def __init__(self, connections: int, interval: float, timeout: float):
+        self.connections = connections
+        self.interval = interval
+        self.timeout = timeout
+        self._task: Optional[asyncio.Task] = None
+
+    async def _warm_llm(self) -> int:
+        from app.llm.client import get_llm_client
+        start = time.perf_counter()
+        try:
+            return await get_llm_client().warm(self.connections, self.timeout)
+        finally:
+            UPSTREAM_WARM_SECONDS.labels("llm").observe(time.perf_counter() - start)
+
+    async def _warm_line(self) -> int:
+        from app.line.channels import get_channels
+        from app.line.client import get_line_client
+        start = time.perf_counter()
+        try:
+            # 每個頻道有自己的 SDK 連線池
+            results = await asyncio.gather(*(
+                asyncio.to_thread(get_line_client(channel).warm, self.connections, self.timeout)
+                for channel in get_channels()
+            ))
+            return sum(results)
+        finally:
+            UPSTREAM_WARM_SECONDS.labels("line").observe(time.perf_counter() - start)
+
+    async def warm(self) -> Dict[str, int]:
+        """同時預熱 LLM 與 LINE 的連線，回傳各上游成功的請求數"""
+        if self.connections <= 0:
+            return {}
+        results = await asyncio.gather(self._warm_llm(), self._warm_line(), return_exceptions=True)
+        warmed = {}
+        for upstream, result in zip(("llm", "line"), results):
+            if isinstance(result, Exception):
+                logger.warning("{} 連線預熱失敗: {}", upstream, result)
+                record_error("upstream_warm", type(result).__name__)
+                result = 0
+            warmed[upstream] = result
+        return warmed
+
+    async def _run(self):
+        """背景定期 ping"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                warmed = await self.warm()
+                logger.debug("上游連線 keep-warm: {}", warmed)
+            except Exception as e:
+                logger.error("上游連線 keep-warm 失敗: {}", e)
+
+    def start(self):
+        """啟動背景 keep-warm task（在 lifespan 中呼叫）"""
+        if self._task is None and self.connections > 0 and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止背景 task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+@lru_cache(maxsize=None)
+def get_upstream_warmer() -> UpstreamWarmer:
+    """取得全域上游連線預熱器"""
+    return UpstreamWarmer(
+        settings.upstream_warm_connections,
+        settings.upstream_keepwarm_interval,
+        settings.upstream_warm_timeout,
+    )
@@ -0,0 +1,165 @@
+"""
+第一個請求的延遲：冷啟動 vs 預熱連線
+
+在本機啟動以自簽憑證提供 HTTPS 的假 LLM API，前面加一層模擬網路往返時間（RTT）的 TCP proxy，
+每一輪都建立新的 LLMClient，比較：
+
+- cold：直接送出第一個請求（需要 TCP + TLS 握手）
+- warm：先呼叫 LLMClient.warm()（與 lifespan 預熱相同），再送出第一個請求
+
+分別量測單一請求，以及同時送出 --connections 個請求（尖峰時第一批請求）的情況。
+假 LLM 不加任何處理延遲，差距就是連線建立的成本。
+
+使用方式（在專案根目錄執行，需要 openssl 指令）：
+    python -m scripts.benchmark_first_request --rtt-ms 40 --connections 4 --trials 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from app.config import settings
+from scripts.loadtest.fake_servers import FakeBehavior, ServerThread, create_fake_llm_app
+
+PAYLOAD = {"model": "bench", "messages": [{"role": "user", "content": "RSI 是什麼？"}]}
+
+
+def create_self_signed_cert(directory: Path) -> tuple:
+    """以 openssl 產生 127.0.0.1 的自簽憑證，回傳 (cert, key) 路徑"""
+    cert, key = directory / "cert.pem", directory / "key.pem"
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-keyout", str(key), "-out", str(cert),
+            "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_latency_proxy(target_port: int, rtt_ms: float) -> asyncio.AbstractServer:
+    """
+    轉送到 target_port 的 TCP proxy，每個方向的資料延遲 RTT/2
+
+    新連線先等待一個 RTT（模擬 TCP 三向交握），之後每次轉送各加上半個 RTT。
+    """
+    one_way = rtt_ms / 2000
+
+    async def handle(client_reader, client_writer):
+        try:
+            await asyncio.sleep(one_way * 2)
+            upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", target_port)
+            await asyncio.gather(
+                _pipe(client_reader, upstream_writer, one_way),
+                _pipe(upstream_reader, client_writer, one_way),
+            )
+        except asyncio.CancelledError:
+            # 結束 benchmark 時仍開著的連線
+            client_writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+async def measure(burst: int, warm: bool, connections: int) -> float:
+    """建立新的 LLMClient，回傳第一批 burst 個請求全部完成的秒數"""
+    from app.llm.client import LLMClient
+    client = LLMClient()
+    try:
+        if warm:
+            warmed = await client.warm(connections, timeout=10.0)
+            if warmed == 0:
+                raise RuntimeError("預熱失敗，請確認假服務與憑證設定")
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *(client.client.post("/chat/completions", json=PAYLOAD) for _ in range(burst))
+        )
+        elapsed = time.perf_counter() - start
+        for response in responses:
+            response.raise_for_status()
+        return elapsed
+    finally:
+        await client.close()
+
+
+async def run(args, proxy_port: int) -> dict:
+    settings.llm_api_base = f"https://127.0.0.1:{proxy_port}"
+    settings.llm_api_key = "bench"
+    settings.llm_http2 = args.http2
+    scenarios = {
+        "single cold": (1, False),
+        "single warm": (1, True),
+        f"burst x{args.connections} cold": (args.connections, False),
+        f"burst x{args.connections} warm": (args.connections, True),
+    }
+    results = {name: [] for name in scenarios}
+    for _ in range(args.trials):
+        for name, (burst, warm) in scenarios.items():
+            results[name].append(await measure(burst, warm, args.connections))
+    return results
+
+
+async def main_async(args, llm_port: int):
+    proxy = await start_latency_proxy(llm_port, args.rtt_ms)
+    try:
+        proxy_port = proxy.sockets[0].getsockname()[1]
+        return await run(args, proxy_port)
+    finally:
+        proxy.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="第一個請求的延遲：冷啟動 vs 預熱連線")
+    parser.add_argument("--rtt-ms", type=float, default=40.0, help="模擬的網路往返時間")
+    parser.add_argument("--connections", type=int, default=4, help="預熱連線數，也是 burst 的並行請求數")
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--llm-port", type=int, default=9112)
+    parser.add_argument("--http2", action="store_true", help="LLM client 使用 HTTP/2（假服務只支援 HTTP/1.1，會協商回 1.1）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cert, key = create_self_signed_cert(Path(temp_dir))
+        # httpx 會讀取 SSL_CERT_FILE 作為信任的 CA
+        os.environ["SSL_CERT_FILE"] = str(cert)
+        server = ServerThread(
+            create_fake_llm_app(FakeBehavior()), args.llm_port,
+            ssl_certfile=str(cert), ssl_keyfile=str(key),
+        )
+        server.start()
+        try:
+            results = asyncio.run(main_async(args, args.llm_port))
+        finally:
+            server.stop()
+
+    print(f"\nRTT {args.rtt_ms:.0f} ms（模擬），每種情境 {args.trials} 輪，每輪都是新的 client")
+    print(f"{'scenario':<20}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for name, values in results.items():
+        print(
+            f"{name:<20}{statistics.median(values) * 1000:>12.1f}"
+            f"{min(values) * 1000:>10.1f}{max(values) * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
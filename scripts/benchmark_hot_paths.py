@@ -0,0 +1,184 @@
+"""
+每則訊息熱路徑上的 micro-benchmark
+
+涵蓋 signature 驗證、guardrails regex、prompt 組裝、LLM tier 判斷、題庫查詢、Quick Reply 建立，
+每個 crud 函式與對話歷史 buffer 的讀取（使用暫存 SQLite）。結果存成 JSON，並可與基準結果比較，
+任何項目變慢超過門檻時以 exit code 1 結束，方便在部署前攔下效能退化。
+
+使用方式（在專案根目錄執行）：
+    # 建立基準
+    python -m scripts.benchmark_hot_paths --output bench_baseline.json
+    # 修改後比較
+    python -m scripts.benchmark_hot_paths --output bench_current.json --baseline bench_baseline.json --max-regression 0.2
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime, timedelta
+from itertools import count
+from pathlib import Path
+from types import SimpleNamespace
+
+from loguru import logger
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.config import settings
+from app.db import crud
+from app.db.history_buffer import ChatHistoryBuffer
+from app.db.session import Base
+from app.line.client import LINEClient, get_question_manager
+from app.line.handlers import compute_signature, verify_signature
+from app.llm.output_checker import check_output_safety, is_trading_question
+from app.llm.prompts import build_user_message
+from app.llm.tiers import get_tier_classifier
+
+SAMPLE_ANSWER = (
+    "RSI（相對強弱指標）是衡量一段期間內價格上漲與下跌力道的動能指標，數值介於 0 到 100。"
+    "常見的誤解是把 70 視為一定會下跌、30 視為一定會上漲，但在強勢趨勢中 RSI 可以長時間停留在高檔。"
+) * 3
+
+
+def measure(func, repeat: int) -> dict:
+    """回傳每次呼叫的最佳耗時（微秒）"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {"us_per_call": round(best * 1_000_000, 3), "calls": number}
+
+
+def pure_benchmarks() -> dict:
+    """不需要資料庫的函式"""
+    settings.line_channel_secret = "benchmark-secret"
+    body = json.dumps({"events": [{"type": "message", "message": {"type": "text", "text": "RSI 是什麼？"}}]})
+    signature = compute_signature(body, settings.line_channel_secret)
+
+    question_manager = get_question_manager()
+    tier_classifier = get_tier_classifier()
+    line_client = LINEClient(api_client=object(), question_manager=question_manager)
+    history = [
+        SimpleNamespace(role="user", text="RSI 是什麼？"),
+        SimpleNamespace(role="assistant", text=SAMPLE_ANSWER),
+    ] * 2
+
+    return {
+        "verify_signature": lambda: verify_signature(body, signature, settings.line_channel_secret),
+        "is_trading_question": lambda: is_trading_question("RSI 顯示超買或超賣時，為什麼常常不準？"),
+        "check_output_safety": lambda: check_output_safety(SAMPLE_ANSWER),
+        "build_user_message": lambda: build_user_message("CVD 是什麼？", history),
+        "tier_classify": lambda: tier_classifier.classify("CVD 跟 OI 的 差別是什麼？", has_history=True),
+        "get_topic_info": lambda: question_manager.get_topic_info("RSI"),
+        "create_menu_quick_reply": line_client.create_menu_quick_reply,
+        "create_topic_quick_reply": lambda: line_client.create_topic_quick_reply("RSI"),
+    }
+
+
+def crud_benchmarks(database_path: Path):
+    """每個 crud 函式與對話歷史 buffer 的讀取（暫存 SQLite），回傳 (benchmarks, session)"""
+    engine = create_engine(f"sqlite:///{database_path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+    user_id = "Ubenchmark"
+    crud.get_or_create_user(db, user_id)
+    crud.get_or_create_user_setting(db, user_id)
+    # created_at 需遞增，保留最近幾則的排序才會與實際相同
+    start = datetime.utcnow()
+    sequence = count()
+
+    def turn(question: str) -> list:
+        """一輪對話（user + assistant），與 write-behind buffer 寫入的 row 相同"""
+        return [
+            {"line_user_id": user_id, "role": role, "text": text, "created_at": start + timedelta(microseconds=next(sequence))}
+            for role, text in (("user", question), ("assistant", SAMPLE_ANSWER))
+        ]
+
+    crud.bulk_add_chat_history(db, turn("RSI 是什麼？") + turn("CVD 是什麼？"))
+
+    def write_and_trim():
+        crud.bulk_add_chat_history(db, turn("RSI 是什麼？"))
+        crud.trim_chat_history(db, [user_id], keep_last=4)
+
+    # 最近對話快取命中（單一 worker）與未啟用快取（多個 worker 的預設）
+    cached_buffer = ChatHistoryBuffer(200, 200, cache_ttl=600, cache_max_chars=5_000_000)
+    uncached_buffer = ChatHistoryBuffer(200, 200)
+
+    benchmarks = {
+        "crud.get_or_create_user": lambda: crud.get_or_create_user(db, user_id),
+        "crud.get_or_create_user_setting": lambda: crud.get_or_create_user_setting(db, user_id),
+        "crud.update_llm_enabled": lambda: crud.update_llm_enabled(db, user_id, True),
+        "crud.get_recent_chat_history": lambda: crud.get_recent_chat_history(db, user_id, limit=4),
+        "crud.bulk_add_chat_history+trim_chat_history": write_and_trim,
+        "history_buffer.get_recent(cached)": lambda: cached_buffer.get_recent(db, user_id, limit=4),
+        "history_buffer.get_recent(uncached)": lambda: uncached_buffer.get_recent(db, user_id, limit=4),
+    }
+    return benchmarks, db
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> bool:
+    """印出與基準的差異，回傳是否全部在門檻內"""
+    ok = True
+    print(f"\n{'benchmark':<46}{'baseline µs':>14}{'current µs':>14}{'change':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<46}{'-':>14}{result['us_per_call']:>14.2f}{'new':>10}")
+            continue
+        change = result["us_per_call"] / base["us_per_call"] - 1
+        flag = ""
+        if change > max_regression:
+            ok = False
+            flag = "  ← 退化"
+        print(f"{name:<46}{base['us_per_call']:>14.2f}{result['us_per_call']:>14.2f}{change:>+10.1%}{flag}")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="熱路徑 micro-benchmark")
+    parser.add_argument("--output", default="bench_current.json", help="結果 JSON 路徑")
+    parser.add_argument("--baseline", default="", help="比較用的基準 JSON")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允許的變慢比例（0.2 = 20%%）")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="只執行名稱包含此字串的項目")
+    args = parser.parse_args()
+
+    # 避免 log I/O 影響量測
+    logger.remove()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        benchmarks = pure_benchmarks()
+        db_benchmarks, db = crud_benchmarks(Path(temp_dir) / "benchmark.db")
+        benchmarks.update(db_benchmarks)
+
+        results = {}
+        for name, func in benchmarks.items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(func, args.repeat)
+            print(f"{name:<46}{results[name]['us_per_call']:>12.2f} µs")
+        db.close()
+
+    output = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\n結果已寫入 {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))["results"]
+        if not compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Metrics 量測成本
+
+模擬一個 LLM 事件在熱路徑上的所有 metrics 呼叫（signature、JSON 解析、crud、LLM、LINE reply），
+量測每個事件的平均額外耗時，超過預算時以 exit code 1 結束。
+
+使用方式（在專案根目錄執行）：
+    python -m scripts.benchmark_metrics_overhead --events 20000 --budget-us 100
+"""
+import argparse
+import sys
+import time
+
+from app import metrics
+from app.metrics import (
+    DB_QUERY_SECONDS,
+    EVENTS_TOTAL,
+    LINE_REPLY_SECONDS,
+    LLM_REQUEST_SECONDS,
+    LLM_TOKENS_TOTAL,
+    SIGNATURE_VERIFY_SECONDS,
+    WEBHOOK_PARSE_SECONDS,
+    child,
+    event_labels,
+    set_action_label,
+    set_event_labels,
+    timed,
+)
+
+# 一個 FREE_TEXT 事件會經過的 crud 呼叫；對話歷史由 write-behind buffer 批次寫入，
+# 這裡以每個事件各一次寫入與清理計算（最差情況：每批只有一個事件、未啟用 retention sweeper）
+CRUD_CALLS = (
+    "get_or_create_user",
+    "get_or_create_user_setting",
+    "get_recent_chat_history",
+    "bulk_add_chat_history",
+    "trim_chat_history",
+)
+
+
+def instrument_one_event():
+    """一個事件的所有 metrics 呼叫（不含實際工作）"""
+    with timed(SIGNATURE_VERIFY_SECONDS):
+        pass
+    with timed(WEBHOOK_PARSE_SECONDS):
+        pass
+    set_event_labels("message")
+    set_action_label("FREE_TEXT")
+    for operation in CRUD_CALLS:
+        with timed(DB_QUERY_SECONDS, operation, *event_labels()):
+            pass
+    labels = event_labels()
+    child(LLM_REQUEST_SECONDS, *labels, "reasoning", "200").observe(1.0)
+    child(LLM_TOKENS_TOTAL, *labels, "prompt").inc(500)
+    child(LLM_TOKENS_TOTAL, *labels, "completion").inc(300)
+    with timed(LINE_REPLY_SECONDS, *labels):
+        pass
+    child(EVENTS_TOTAL, "default", *labels).inc()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="量測 metrics 在熱路徑上的成本")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--budget-us", type=float, default=100.0, help="每個事件允許的額外耗時（微秒）")
+    args = parser.parse_args()
+
+    # 暖身：建立所有 label 組合
+    for _ in range(100):
+        instrument_one_event()
+
+    start = time.perf_counter()
+    for _ in range(args.events):
+        instrument_one_event()
+    per_event_us = (time.perf_counter() - start) / args.events * 1_000_000
+
+    render_start = time.perf_counter()
+    metrics.render_metrics()
+    render_ms = (time.perf_counter() - render_start) * 1000
+
+    print(f"每個事件的 metrics 成本：{per_event_us:.1f} µs（預算 {args.budget_us:.1f} µs）")
+    print(f"/metrics 輸出耗時：{render_ms:.2f} ms")
+    return 0 if per_event_us <= args.budget_us else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+公告推播對本機假 LINE API 的吞吐量與當機後繼續的正確性
+
+在暫存的 SQLite（或 --database-url）建立 --users 位使用者，啟動假 LINE API（可設定延遲與 429 比例），然後：
+
+- full：完整推播一次，回報每秒送出人數、批次數與重試次數
+- crash + resume：送出 --crash-after 個 multicast 後模擬當機，再以同一個工作 ID 繼續；
+  確認每位使用者剛好收到一次（當機前已送出但未記錄進度的批次，重送時由 X-Line-Retry-Key 擋下）
+
+使用方式（在專案根目錄執行）：
+    python -m scripts.benchmark_push --users 50000 --latency-ms 80 --429-rate 0.02
+"""
+import argparse
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+import app.db.models  # noqa: F401  註冊所有 model
+from app.config import settings
+from app.db.models import User
+from app.db.session import Base, build_engine
+from app.line.client import LINEClient
+from app.line.push import AnnouncementPusher, create_push_job
+from scripts.loadtest.fake_servers import FakeBehavior, ServerThread, create_fake_line_app
+
+MESSAGE = "📢 新主題上線：布林通道！輸入「選單」看看吧。"
+
+
+class SimulatedCrash(BaseException):
+    """模擬行程當機（不是 Exception，不會被推播的重試邏輯攔下）"""
+
+
+class CrashingLINEClient(LINEClient):
+    """
+    第 crash_after + 1 個 multicast 當機
+
+    之後已經送出的並行請求仍會成功，這些批次排在當機的批次後面，不會記錄進度。
+    """
+
+    def __init__(self, crash_after: int):
+        super().__init__()
+        self.remaining = crash_after
+        self.lock = threading.Lock()
+
+    def multicast_text(self, user_ids, text, retry_key=None):
+        with self.lock:
+            self.remaining -= 1
+            crashed = self.remaining == -1
+        if crashed:
+            raise SimulatedCrash()
+        super().multicast_text(user_ids, text, retry_key=retry_key)
+
+
+def seed_users(factory: sessionmaker, count: int, prefix: str):
+    now = datetime.utcnow()
+    with factory() as db:
+        for start in range(0, count, 5000):
+            rows = [{"line_user_id": f"{prefix}{i:08d}", "created_at": now} for i in range(start, min(count, start + 5000))]
+            db.execute(User.__table__.insert().values(rows))
+        db.commit()
+
+
+def cleanup(factory: sessionmaker, prefix: str, job_ids: list):
+    with factory() as db:
+        db.execute(text("DELETE FROM users WHERE line_user_id LIKE :prefix"), {"prefix": f"{prefix}%"})
+        for job_id in job_ids:
+            db.execute(text("DELETE FROM push_jobs WHERE id = :id"), {"id": job_id})
+        db.commit()
+
+
+def check_delivery(behavior: FakeBehavior, prefix: str, users: int) -> str:
+    received = {user_id: n for user_id, n in behavior.recipients.items() if user_id.startswith(prefix)}
+    duplicated = sum(1 for n in received.values() if n > 1)
+    missing = users - len(received)
+    return "OK" if not duplicated and not missing else f"缺少 {missing} 人、重複 {duplicated} 人"
+
+
+def run(args, factory: sessionmaker, behavior: FakeBehavior):
+    job_ids = []
+    pusher_options = dict(session_factory=factory, batch_size=args.batch_size, concurrency=args.concurrency, rate=args.rate)
+
+    prefix = f"Upush{uuid.uuid4().hex[:6]}-"
+    seed_users(factory, args.users, prefix)
+    try:
+        job_id = create_push_job(MESSAGE, factory)
+        job_ids.append(job_id)
+        report = AnnouncementPusher(**pusher_options).run(job_id)
+        print(
+            f"\n[full] 送出 {report.recipients_sent} 人、失敗 {report.recipients_failed} 人、{report.batches} 批、"
+            f"重試 {report.retries} 次，耗時 {report.elapsed:.2f} 秒："
+            f"{report.recipients_per_second:.0f} 人/秒（{report.batches_per_second:.1f} 批/秒）"
+        )
+        print(f"[full] 投遞檢查：{check_delivery(behavior, prefix, args.users)}")
+    finally:
+        cleanup(factory, prefix, [])
+
+    prefix = f"Upush{uuid.uuid4().hex[:6]}-"
+    seed_users(factory, args.users, prefix)
+    try:
+        job_id = create_push_job(MESSAGE, factory)
+        job_ids.append(job_id)
+        try:
+            AnnouncementPusher(line_client=CrashingLINEClient(args.crash_after), **pusher_options).run(job_id)
+            print("\n[crash] 推播在模擬當機前就已完成，請調低 --crash-after")
+        except SimulatedCrash:
+            with factory() as db:
+                cursor, sent = db.execute(
+                    text("SELECT cursor, recipients_sent FROM push_jobs WHERE id = :id"), {"id": job_id}
+                ).one()
+            print(f"\n[crash] 送出 {args.crash_after} 個 multicast 後當機，已記錄進度：{sent} 人（cursor={cursor}）")
+        conflicts_before = behavior.requests["multicast:409"]
+        report = AnnouncementPusher(**pusher_options).run(job_id)
+        print(
+            f"[resume] 從 {report.resumed} 人之後繼續：送出 {report.recipients_sent} 人、{report.batches} 批，"
+            f"其中 {behavior.requests['multicast:409'] - conflicts_before} 批已在當機前送出（409）"
+        )
+        print(f"[resume] 投遞檢查：{check_delivery(behavior, prefix, args.users)}")
+    finally:
+        cleanup(factory, prefix, job_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="公告推播的吞吐量與當機後繼續")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=150.0, help="每秒最多幾個 multicast 請求")
+    parser.add_argument("--crash-after", type=int, default=10, help="crash 情境送出幾個 multicast 後當機")
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="假 LINE API 的延遲")
+    parser.add_argument("--429-rate", dest="error_429_rate", type=float, default=0.02)
+    parser.add_argument("--line-port", type=int, default=9121)
+    parser.add_argument("--database-url", default="", help="預設使用暫存的 SQLite")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(lambda message: print(message, end=""), level="WARNING")
+
+    behavior = FakeBehavior(latency_ms=args.latency_ms, jitter_ms=args.latency_ms / 4, error_429_rate=args.error_429_rate)
+    server = ServerThread(create_fake_line_app(behavior), args.line_port)
+    server.start()
+    settings.line_api_base = f"http://127.0.0.1:{args.line_port}"
+    settings.line_channel_access_token = "bench"
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            engine = build_engine(args.database_url or f"sqlite:///{Path(temp_dir) / 'push.db'}", pool_name="bench-push")
+            Base.metadata.create_all(engine)
+            try:
+                run(args, sessionmaker(autocommit=False, autoflush=False, bind=engine), behavior)
+            finally:
+                engine.dispose()
+    finally:
+        server.stop()
+    print(f"\n假 LINE API：{dict(behavior.requests)}")
+
+
+if __name__ == "__main__":
+    main()
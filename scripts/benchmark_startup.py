@@ -0,0 +1,106 @@
+"""
+啟動時間量測
+
+分別量測各模組的冷啟動 import 時間（每次都在新的 Python 行程中執行），
+以及 lifespan 內各元件第一次初始化所花的時間。
+
+使用方式（在專案根目錄執行）：
+    python -m scripts.benchmark_startup --repeat 5
+"""
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+IMPORT_TARGETS = [
+    "app.config",
+    "app.db.session",
+    "app.db.crud",
+    "app.llm.client",
+    "app.line.client",
+    "app.line.handlers",
+    "app.main",
+]
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def measure_import(module: str, repeat: int) -> float:
+    """在新的行程中 import 模組，回傳多次量測的中位數（秒）"""
+    samples = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+            cwd=PROJECT_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def timed(label: str, func, results: list):
+    """執行 func 並記錄耗時"""
+    start = time.perf_counter()
+    value = func()
+    results.append((label, time.perf_counter() - start))
+    return value
+
+
+def measure_components() -> list:
+    """量測各元件第一次初始化的時間（同一個行程內）"""
+    sys.path.insert(0, str(PROJECT_ROOT))
+    from app.db.session import get_engine, run_migrations
+    from app.line.client import get_api_client, get_line_client, get_question_manager
+    from app.llm.client import get_llm_client
+
+    results = []
+    timed("question_manager", get_question_manager, results)
+    timed("line_api_client", get_api_client, results)
+    timed("line_client", get_line_client, results)
+    timed("llm_client", get_llm_client, results)
+    engine = timed("db_engine", get_engine, results)
+    timed("db_first_connect", lambda: engine.connect().close(), results)
+    timed("run_migrations", run_migrations, results)
+    return results
+
+
+async def measure_lifespan() -> float:
+    """量測完整 lifespan 啟動（到 yield 為止）的時間"""
+    from app.main import app
+
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="量測 LINE Bot 啟動時間")
+    parser.add_argument("--repeat", type=int, default=5, help="每個模組 import 的量測次數")
+    args = parser.parse_args()
+
+    print(f"{'import':<24}{'median (ms)':>14}")
+    for module in IMPORT_TARGETS:
+        print(f"{module:<24}{measure_import(module, args.repeat) * 1000:>14.1f}")
+
+    print()
+    print(f"{'component':<24}{'first init (ms)':>14}")
+    for label, elapsed in measure_components():
+        print(f"{label:<24}{elapsed * 1000:>14.1f}")
+
+    print()
+    print(f"{'lifespan startup':<24}{asyncio.run(measure_lifespan()) * 1000:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Read replica 路由與 read-your-writes 的正確性檢查
+
+預設建立兩個暫存的 SQLite 檔案當作 primary 與 replica，以 sqlite3 backup API 手動「複寫」，
+因此可以任意控制複寫延遲（不呼叫 replicate 就等於 replica 落後）。確認：
+
+- 新使用者：replica 上還沒有資料時，get_or_create_* 會到 primary 再查一次，不會重複建立（IntegrityError）
+- read-your-writes：關閉 LLM 後，在 DB_READ_STICKY_SECONDS 內讀到的是 primary 上的新設定
+- 路由：超過這段時間後，讀取改送到 replica（replica 尚未複寫時會讀到舊值，複寫後讀到新值）
+
+使用方式（在專案根目錄執行）：
+    python -m scripts.check_read_replica --sticky-seconds 1
+    # 檢查兩個實際的資料庫（需先對 primary 執行 python -m app.migrate；複寫由資料庫負責）
+    python -m scripts.check_read_replica --primary-url postgresql://... --replica-url postgresql://... --replication-wait 2
+"""
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from prometheus_client import REGISTRY
+from sqlalchemy import make_url, text
+
+import app.db.models  # noqa: F401  註冊所有 model
+from app.config import settings
+from app.db import crud
+from app.db.session import Base, create_session, get_engine, get_read_engine
+
+
+def sample(name: str, labels: dict) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class Replicator:
+    """把 primary 的內容複寫到 replica（實際的資料庫則等待 replication_wait 秒）"""
+
+    def __init__(self, primary_url: str, replica_url: str, replication_wait: float):
+        self.sqlite = make_url(primary_url).get_backend_name() == "sqlite"
+        self.primary_path = make_url(primary_url).database
+        self.replica_path = make_url(replica_url).database
+        self.replication_wait = replication_wait
+
+    def replicate(self):
+        if not self.sqlite:
+            time.sleep(self.replication_wait)
+            return
+        source = sqlite3.connect(self.primary_path)
+        target = sqlite3.connect(self.replica_path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        # 舊連線的 page cache 可能還留著複寫前的內容
+        get_read_engine().dispose()
+
+
+def read_llm_enabled(line_user_id: str) -> bool:
+    with create_session() as db:
+        return crud.get_or_create_user_setting(db, line_user_id).llm_enabled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read replica 路由與 read-your-writes 的正確性檢查")
+    parser.add_argument("--primary-url", default="", help="預設使用暫存的 SQLite 檔案")
+    parser.add_argument("--replica-url", default="", help="預設使用暫存的 SQLite 檔案")
+    parser.add_argument("--replication-wait", type=float, default=1.0, help="實際的資料庫：等待複寫完成的秒數")
+    parser.add_argument("--sticky-seconds", type=float, default=1.0)
+    args = parser.parse_args()
+    if bool(args.primary_url) != bool(args.replica_url):
+        parser.error("--primary-url 與 --replica-url 需同時設定")
+
+    temp_dir = Path(tempfile.mkdtemp())
+    settings.database_url = args.primary_url or f"sqlite:///{temp_dir / 'primary.db'}"
+    settings.database_read_url = args.replica_url or f"sqlite:///{temp_dir / 'replica.db'}"
+    settings.shared_state_backend = "memory"
+    replicator = Replicator(settings.database_url, settings.database_read_url, args.replication_wait)
+    if not args.primary_url:
+        Base.metadata.create_all(get_engine())
+    replicator.replicate()
+
+    results = {}
+    line_user_id = f"Ureplica{uuid.uuid4().hex[:10]}"
+
+    # 新使用者：停用 sticky，讓查詢一定先到（尚未複寫的）replica
+    settings.db_read_sticky_seconds = 0
+    try:
+        first = read_llm_enabled(line_user_id)
+        second = read_llm_enabled(line_user_id)
+        results["新使用者不重複建立"] = first is True and second is True
+    except Exception as e:
+        print(f"新使用者：{type(e).__name__}: {e}")
+        results["新使用者不重複建立"] = False
+    replicator.replicate()
+
+    # read-your-writes：寫入後尚未複寫，sticky 期間仍讀 primary
+    settings.db_read_sticky_seconds = args.sticky_seconds
+    with create_session() as db:
+        crud.update_llm_enabled(db, line_user_id, False)
+    primary_reads = sample("linebot_db_read_routing_total", {"target": "primary"})
+    results["寫入後讀到新設定"] = read_llm_enabled(line_user_id) is False
+    results["寫入後讀取送到 primary"] = sample("linebot_db_read_routing_total", {"target": "primary"}) > primary_reads
+
+    # sticky 期間結束：讀取改送到 replica
+    time.sleep(args.sticky_seconds + 0.1)
+    replica_statements = sample("linebot_db_statements_total", {"pool": "replica"})
+    stale = read_llm_enabled(line_user_id)
+    results["之後的讀取送到 replica"] = sample("linebot_db_statements_total", {"pool": "replica"}) > replica_statements
+    if replicator.sqlite:
+        results["replica 落後時讀到舊值（預期行為）"] = stale is True
+    replicator.replicate()
+    results["複寫後讀到新設定"] = read_llm_enabled(line_user_id) is False
+
+    with create_session() as db:
+        for table in ("user_settings", "users"):
+            db.execute(text(f"DELETE FROM {table} WHERE line_user_id = :id"), {"id": line_user_id})
+        db.commit()
+
+    failed = False
+    for name, ok in results.items():
+        failed |= not ok
+        print(f"{'OK ' if ok else 'FAIL'} {name}")
+    routed = {target: sample("linebot_db_read_routing_total", {"target": target}) for target in ("primary", "replica")}
+    print(f"讀取路由：{routed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+共享狀態的多行程正確性檢查
+
+同時啟動多個行程（memory backend 改用多個執行緒）對同一組 key 操作，確認：
+原子遞增不會遺失、set_if_absent 每個 key 只有一個行程成功、共享鎖內的讀改寫不會互相覆蓋、TTL 到期後重新計數。
+
+使用方式（在專案根目錄執行）：
+    # 預設使用暫存的 SQLite 檔案
+    python -m scripts.check_shared_state --processes 4 --iterations 200
+    # 檢查 PostgreSQL（需先執行 python -m app.migrate）
+    python -m scripts.check_shared_state --database-url postgresql://... --processes 8
+"""
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from app.db.session import Base, build_engine
+from app.state import DatabaseState, MemoryState, SharedState
+
+_state = None
+
+
+def get_state(backend: str, database_url: str) -> SharedState:
+    """每個行程建立一次（執行緒之間共用）"""
+    global _state
+    if _state is None:
+        if backend == "memory":
+            _state = MemoryState()
+        else:
+            _state = DatabaseState(build_engine(database_url, pool_name="state-check"))
+    return _state
+
+
+def worker(backend: str, database_url: str, prefix: str, iterations: int, lock_iterations: int) -> dict:
+    state = get_state(backend, database_url)
+    for _ in range(iterations):
+        state.incr(f"{prefix}:counter")
+    wins = sum(state.set_if_absent(f"{prefix}:once:{i}", "1", ttl=600) for i in range(iterations))
+    for _ in range(lock_iterations):
+        with state.lock(f"{prefix}:lock", timeout=60):
+            value = int(state.get(f"{prefix}:locked") or 0)
+            state.set(f"{prefix}:locked", str(value + 1))
+    return {"wins": wins}
+
+
+def check_ttl(state: SharedState, prefix: str) -> bool:
+    key = f"{prefix}:ttl"
+    first = state.incr(key, ttl=0.5)
+    second = state.incr(key, ttl=0.5)
+    time.sleep(0.7)
+    return (first, second, state.incr(key, ttl=0.5), state.get(f"{key}:missing")) == (1, 2, 1, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="共享狀態的多行程正確性檢查")
+    parser.add_argument("--backend", choices=["memory", "database"], default="database")
+    parser.add_argument("--database-url", default="", help="預設使用暫存的 SQLite 檔案")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--lock-iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if args.backend == "database" and not database_url:
+        path = Path(tempfile.mkdtemp()) / "shared_state.db"
+        database_url = f"sqlite:///{path}"
+        import app.db.models  # noqa: F401  註冊所有 model
+        Base.metadata.create_all(create_engine(database_url))
+
+    prefix = f"check:{uuid.uuid4().hex[:8]}"
+    executor: Executor
+    if args.backend == "memory":
+        # 行程內 dict 無法跨行程共享，改用執行緒檢查原子性
+        executor = ThreadPoolExecutor(args.processes)
+    else:
+        executor = ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("spawn"))
+
+    start = time.perf_counter()
+    with executor:
+        futures = [
+            executor.submit(worker, args.backend, database_url, prefix, args.iterations, args.lock_iterations)
+            for _ in range(args.processes)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    state = get_state(args.backend, database_url)
+    counter = int(state.get(f"{prefix}:counter") or 0)
+    locked = int(state.get(f"{prefix}:locked") or 0)
+    wins = sum(result["wins"] for result in results)
+    checks = {
+        "incr": (counter, args.processes * args.iterations),
+        "set_if_absent": (wins, args.iterations),
+        "lock": (locked, args.processes * args.lock_iterations),
+    }
+
+    print(f"backend={args.backend} processes={args.processes} iterations={args.iterations} 耗時 {elapsed:.2f} 秒")
+    failed = False
+    for name, (actual, expected) in checks.items():
+        ok = actual == expected
+        failed |= not ok
+        print(f"{name:14s} {'OK ' if ok else 'FAIL'} 實際 {actual}，預期 {expected}")
+    ttl_ok = check_ttl(state, prefix)
+    failed |= not ttl_ok
+    print(f"{'ttl':14s} {'OK ' if ttl_ok else 'FAIL'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+比較單一 worker 與正式環境啟動方式的吞吐量
+
+依序啟動兩種 bot（都指向同一組假 LINE / LLM 服務），各以固定數量的並行連線（closed-loop，
+收到回應才送下一個）持續送出 webhook，回報每秒請求數與延遲：
+
+- uvicorn：目前 `python -m app.main` 的單一 worker
+- production：`python -m app.server`（WEB_WORKERS 個 worker、uvloop、httptools、preload）
+
+使用方式（在專案根目錄執行）：
+    python -m scripts.loadtest.compare_servers --workers 4 --concurrency 64 --duration 20
+
+多個 worker 時 /metrics 只反映回應該請求的 worker，因此這裡不統計 DB 查詢數。
+預設每輪使用新的暫存 SQLite 檔案；多 worker 同時寫入 SQLite 會互相等待，接近正式環境的數字請用 --database-url 指向 PostgreSQL。
+"""
+import argparse
+import asyncio
+import copy
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from scripts.loadtest.fake_servers import add_behavior_arguments, start_fake_servers
+from scripts.loadtest.run import (
+    DEFAULT_MIX,
+    TEST_CHANNEL_SECRET,
+    build_request,
+    parse_mix,
+    percentile,
+    start_bot,
+    wait_until_ready,
+)
+
+
+async def run_closed_loop(args, client: httpx.AsyncClient) -> dict:
+    """以 concurrency 條連線持續送出請求，回傳 RPS 與延遲"""
+    weights = parse_mix(args.mix)
+    kinds, kind_weights = list(weights), list(weights.values())
+    users = [f"Ubench{i:06d}" for i in range(args.users)]
+    latencies: list = []
+    statuses: dict[str, int] = {}
+    deadline = 0.0
+
+    async def client_loop():
+        while time.perf_counter() < deadline:
+            kind = random.choices(kinds, kind_weights)[0]
+            body, signature = build_request(kind, random.choice(users), TEST_CHANNEL_SECRET)
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    "/webhook/line",
+                    content=body.encode("utf-8"),
+                    headers={"X-Line-Signature": signature, "Content-Type": "application/json"},
+                )
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    # 暖機（載入題庫、建立連線），不列入統計
+    deadline = time.perf_counter() + args.warmup
+    await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+    latencies.clear()
+    statuses.clear()
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "statuses": statuses,
+    }
+
+
+async def bench_server(args, server: str, workers: int) -> dict:
+    bot_args = copy.copy(args)
+    bot_args.server, bot_args.workers = server, workers
+    temp_dir = tempfile.TemporaryDirectory()
+    database_url = args.database_url or f"sqlite:///{Path(temp_dir.name) / 'bench.db'}"
+    bot = start_bot(bot_args, database_url)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{args.bot_port}", timeout=args.timeout, limits=limits
+        ) as client:
+            await wait_until_ready(client)
+            return await run_closed_loop(args, client)
+    finally:
+        bot.terminate()
+        bot.wait(timeout=args.timeout)
+        temp_dir.cleanup()
+
+
+async def main_async(args):
+    _, _, servers = start_fake_servers(args)
+    try:
+        results = {
+            "uvicorn x1": await bench_server(args, "uvicorn", 1),
+            f"production x{args.workers}": await bench_server(args, "production", args.workers),
+        }
+    finally:
+        for server in servers:
+            server.stop()
+
+    print()
+    print(f"並行連線 {args.concurrency}，每輪 {args.duration:.0f} 秒")
+    print(f"{'server':<18}{'requests':>10}{'RPS':>10}{'p50 ms':>10}{'p99 ms':>10}  statuses")
+    for name, result in results.items():
+        print(
+            f"{name:<18}{result['requests']:>10}{result['rps']:>10.1f}"
+            f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}  {result['statuses']}"
+        )
+    baseline, production = results.values()
+    if baseline["rps"]:
+        print(f"\nRPS 提升：{production['rps'] / baseline['rps']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較單一 worker 與 python -m app.server 的吞吐量")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=64, help="並行連線數")
+    parser.add_argument("--duration", type=float, default=20.0, help="每種設定的測試秒數")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--bot-port", type=int, default=9100)
+    parser.add_argument("--database-url", default="", help="預設每輪使用新的暫存 SQLite 檔案")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--quiet-bot", action="store_true", help="不顯示 bot 的 log")
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
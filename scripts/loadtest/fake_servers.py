@@ -0,0 +1,188 @@
+"""
+壓力測試用的本機假服務
+
+- 假 LINE Messaging API：reply / push / multicast / loading 動畫
+- 假 OpenAI 相容 API：POST /chat/completions
+
+延遲、抖動與 429 比例都可設定，並統計每個端點收到的請求數。
+可單獨啟動（搭配手動啟動的 bot）：
+    python -m scripts.loadtest.fake_servers --line-port 9101 --llm-port 9102 --llm-latency-ms 800
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FAKE_ANSWER = "這是壓力測試用的假回答：RSI 是衡量價格漲跌力道的動能指標，常見誤解是把 70/30 當成買賣訊號。"
+
+
+@dataclass
+class FakeBehavior:
+    """假服務的回應行為"""
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_429_rate: float = 0.0
+    requests: Counter = field(default_factory=Counter)
+    # multicast 每位使用者收到的次數，以及已接受的 X-Line-Retry-Key（重送時回傳 409）
+    recipients: Counter = field(default_factory=Counter)
+    retry_keys: set = field(default_factory=set)
+
+    async def delay(self):
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    def should_throttle(self) -> bool:
+        return self.error_429_rate > 0 and random.random() < self.error_429_rate
+
+
+def _throttled() -> JSONResponse:
+    return JSONResponse(status_code=429, content={"message": "The API rate limit has been exceeded."})
+
+
+def create_fake_line_app(behavior: FakeBehavior) -> FastAPI:
+    """假 LINE Messaging API"""
+    app = FastAPI()
+
+    async def handle(name: str, content: dict):
+        behavior.requests[name] += 1
+        await behavior.delay()
+        if behavior.should_throttle():
+            behavior.requests[f"{name}:429"] += 1
+            return _throttled()
+        return JSONResponse(content=content)
+
+    @app.post("/v2/bot/message/reply")
+    async def reply(request: Request):
+        await request.body()
+        return await handle("reply", {"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+    @app.post("/v2/bot/message/push")
+    async def push(request: Request):
+        await request.body()
+        return await handle("push", {"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+    @app.post("/v2/bot/message/multicast")
+    async def multicast(request: Request):
+        payload = await request.json()
+        to = payload.get("to", [])
+        if not 1 <= len(to) <= 500:
+            return JSONResponse(status_code=400, content={"message": "The property, 'to', in the request body is invalid"})
+        retry_key = request.headers.get("X-Line-Retry-Key")
+        if retry_key and retry_key in behavior.retry_keys:
+            behavior.requests["multicast:409"] += 1
+            return JSONResponse(status_code=409, content={"message": "The retry key is already accepted"})
+        response = await handle("multicast", {})
+        if response.status_code == 200:
+            if retry_key:
+                behavior.retry_keys.add(retry_key)
+            behavior.recipients.update(to)
+        return response
+
+    @app.post("/v2/bot/chat/loading/start")
+    async def loading(request: Request):
+        await request.body()
+        return await handle("loading", {})
+
+    return app
+
+
+def create_fake_llm_app(behavior: FakeBehavior) -> FastAPI:
+    """假 OpenAI 相容 /chat/completions"""
+    app = FastAPI()
+
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        behavior.requests["chat_completions"] += 1
+        await behavior.delay()
+        if behavior.should_throttle():
+            behavior.requests["chat_completions:429"] += 1
+            return _throttled()
+        prompt_chars = sum(len(message.get("content", "")) for message in payload.get("messages", []))
+        return JSONResponse(content={
+            "id": f"fake-{time.time_ns()}",
+            "model": payload.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": FAKE_ANSWER}}],
+            "usage": {
+                "prompt_tokens": prompt_chars // 2,
+                "completion_tokens": len(FAKE_ANSWER) // 2,
+                "total_tokens": prompt_chars // 2 + len(FAKE_ANSWER) // 2,
+            },
+        })
+
+    return app
+
+
+class ServerThread:
+    """在背景執行緒執行 uvicorn server"""
+
+    def __init__(self, app: FastAPI, port: int, host: str = "127.0.0.1", **config_kwargs):
+        config = uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False, **config_kwargs)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout: float = 10.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("假服務啟動逾時")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+
+def add_behavior_arguments(parser: argparse.ArgumentParser):
+    """假服務行為的共用參數"""
+    parser.add_argument("--line-port", type=int, default=9101)
+    parser.add_argument("--llm-port", type=int, default=9102)
+    parser.add_argument("--line-latency-ms", type=float, default=50.0)
+    parser.add_argument("--line-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--line-429-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=1500.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=500.0)
+    parser.add_argument("--llm-429-rate", type=float, default=0.0)
+
+
+def start_fake_servers(args) -> tuple[FakeBehavior, FakeBehavior, list[ServerThread]]:
+    """依參數啟動假 LINE 與假 LLM 服務"""
+    line_behavior = FakeBehavior(args.line_latency_ms, args.line_jitter_ms, args.line_429_rate)
+    llm_behavior = FakeBehavior(args.llm_latency_ms, args.llm_jitter_ms, args.llm_429_rate)
+    servers = [
+        ServerThread(create_fake_line_app(line_behavior), args.line_port),
+        ServerThread(create_fake_llm_app(llm_behavior), args.llm_port),
+    ]
+    for server in servers:
+        server.start()
+    return line_behavior, llm_behavior, servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="啟動假 LINE / LLM 服務")
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+
+    line_behavior, llm_behavior, servers = start_fake_servers(args)
+    print(f"假 LINE API：http://127.0.0.1:{args.line_port}")
+    print(f"假 LLM API：http://127.0.0.1:{args.llm_port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"LINE: {dict(line_behavior.requests)}  LLM: {dict(llm_behavior.requests)}")
+    except KeyboardInterrupt:
+        for server in servers:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+端對端壓力測試
+
+啟動假 LINE / LLM 服務與一個指向它們的 bot 行程，以固定速率（open-loop）送出簽章正確的
+webhook 請求，最後回報實際 RPS、端對端延遲百分位數，以及從 bot 的 /metrics 取得的 DB 查詢數。
+
+使用方式（在專案根目錄執行）：
+    python -m scripts.loadtest.run --rate 20 --duration 30 --llm-latency-ms 1500 --llm-429-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from app.line.handlers import compute_signature
+from app.line.client import get_question_manager
+from scripts.loadtest.fake_servers import add_behavior_arguments, start_fake_servers
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
+TEST_CHANNEL_SECRET = "loadtest-channel-secret"
+
+# 事件種類與預設比例
+DEFAULT_MIX = "menu=0.2,show_topic=0.3,ask_question=0.3,free_text=0.15,toggle=0.05"
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def build_event(kind: str, user_id: str) -> dict:
+    """產生一個 LINE webhook 事件"""
+    base = {
+        "replyToken": f"rt-{time.time_ns()}-{random.randrange(1_000_000)}",
+        "webhookEventId": f"ev-{time.time_ns()}-{random.randrange(1_000_000)}",
+        "deliveryContext": {"isRedelivery": False},
+        "source": {"type": "user", "userId": user_id},
+        "timestamp": int(time.time() * 1000),
+        "mode": "active",
+    }
+    question_manager = get_question_manager()
+    topic = random.choice(question_manager.get_menu_topics())["key"]
+
+    if kind == "menu":
+        return {**base, "type": "message", "message": {"type": "text", "id": "1", "text": "選單"}}
+    if kind == "free_text":
+        return {**base, "type": "message", "message": {"type": "text", "id": "1", "text": f"{topic} 是什麼？"}}
+    if kind == "show_topic":
+        data = f"action_type=SHOW_TOPIC&topic={topic}"
+    elif kind == "ask_question":
+        question = random.choice(question_manager.get_topic_info(topic).questions)
+        data = f"action_type=ASK_QUESTION&topic={topic}&question_text={question}"
+    elif kind == "toggle":
+        data = "action_type=TOGGLE_LLM&enabled=true"
+    else:
+        raise ValueError(f"未知的事件種類：{kind}")
+    return {**base, "type": "postback", "postback": {"data": data}}
+
+
+def build_request(kind: str, user_id: str, channel_secret: str) -> tuple[str, str]:
+    """產生 (body, X-Line-Signature)"""
+    body = json.dumps({"destination": "Uloadtest", "events": [build_event(kind, user_id)]}, ensure_ascii=False)
+    return body, compute_signature(body, channel_secret)
+
+
+def parse_metric_sum(text: str, name: str) -> float:
+    """加總 /metrics 中某個 metric（所有 label）的值"""
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(name) and (line[len(name)] in "{ "):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def bot_command(args) -> list:
+    """bot 的啟動指令（uvicorn：與 python -m app.main 相同的單一 worker；production：python -m app.server）"""
+    if args.server == "production":
+        return [sys.executable, "-m", "app.server"]
+    return [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+            "--port", str(args.bot_port), "--log-level", "warning"]
+
+
+def start_bot(args, database_url: str) -> subprocess.Popen:
+    """啟動指向假服務的 bot 行程"""
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "LINE_CHANNEL_SECRET": TEST_CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "loadtest-access-token",
+        "LINE_API_BASE": f"http://127.0.0.1:{args.line_port}",
+        "LLM_API_BASE": f"http://127.0.0.1:{args.llm_port}",
+        "LLM_API_KEY": "loadtest",
+        "RICH_MENU_SYNC": "false",
+        "HOST": "127.0.0.1",
+        "PORT": str(args.bot_port),
+        "WEB_WORKERS": str(args.workers),
+    }
+    return subprocess.Popen(
+        bot_command(args),
+        cwd=PROJECT_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL if args.quiet_bot else None,
+        stderr=subprocess.DEVNULL if args.quiet_bot else None,
+    )
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("bot 啟動逾時")
+
+
+async def run_load(args, client: httpx.AsyncClient, channel_secret: str) -> dict:
+    """以固定速率送出請求（不等待前一個請求完成）"""
+    weights = parse_mix(args.mix)
+    kinds, kind_weights = list(weights), list(weights.values())
+    users = [f"Uloadtest{i:06d}" for i in range(args.users)]
+    latencies: dict[str, list] = {kind: [] for kind in kinds}
+    statuses: dict[str, int] = {}
+
+    async def send(kind: str):
+        body, signature = build_request(kind, random.choice(users), channel_secret)
+        start = time.perf_counter()
+        try:
+            response = await client.post(
+                args.webhook_path,
+                content=body.encode("utf-8"),
+                headers={"X-Line-Signature": signature, "Content-Type": "application/json"},
+            )
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        latencies[kind].append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    total = int(args.rate * args.duration)
+    tasks = []
+    started = time.perf_counter()
+    for i in range(total):
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(random.choices(kinds, kind_weights)[0])))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    return {"elapsed": elapsed, "total": total, "latencies": latencies, "statuses": statuses}
+
+
+def print_report(result: dict, db_before: dict, db_after: dict, line_behavior, llm_behavior):
+    all_latencies = sorted(value for values in result["latencies"].values() for value in values)
+    print()
+    print(f"送出請求：{result['total']}，耗時 {result['elapsed']:.1f} 秒，實際 RPS：{result['total'] / result['elapsed']:.1f}")
+    print(f"HTTP 狀態：{result['statuses']}")
+    print()
+    print(f"{'kind':<14}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, values in list(result["latencies"].items()) + [("ALL", all_latencies)]:
+        values = sorted(values)
+        if not values:
+            continue
+        print(
+            f"{kind:<14}{len(values):>7}"
+            f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 90) * 1000:>10.1f}"
+            f"{percentile(values, 99) * 1000:>10.1f}{values[-1] * 1000:>10.1f}"
+        )
+    print()
+    statements = db_after["statements"] - db_before["statements"]
+    crud_calls = db_after["crud_calls"] - db_before["crud_calls"]
+    events = max(result["total"], 1)
+    print(f"DB：{statements:.0f} 個 SQL（每個事件 {statements / events:.1f}），crud 呼叫 {crud_calls:.0f} 次（每個事件 {crud_calls / events:.1f}）")
+    print(f"假 LINE API：{dict(line_behavior.requests)}")
+    print(f"假 LLM API：{dict(llm_behavior.requests)}")
+
+
+async def fetch_db_counts(client: httpx.AsyncClient) -> dict:
+    text = (await client.get("/metrics")).text
+    return {
+        "statements": parse_metric_sum(text, "linebot_db_statements_total"),
+        "crud_calls": parse_metric_sum(text, "linebot_db_query_seconds_count"),
+    }
+
+
+async def main_async(args):
+    line_behavior, llm_behavior, servers = start_fake_servers(args)
+    temp_dir = tempfile.TemporaryDirectory()
+    database_url = args.database_url or f"sqlite:///{Path(temp_dir.name) / 'loadtest.db'}"
+
+    bot = None if args.bot_url else start_bot(args, database_url)
+    base_url = args.bot_url or f"http://127.0.0.1:{args.bot_port}"
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            await wait_until_ready(client)
+            db_before = await fetch_db_counts(client)
+            result = await run_load(args, client, args.channel_secret)
+            db_after = await fetch_db_counts(client)
+        print_report(result, db_before, db_after, line_behavior, llm_behavior)
+    finally:
+        if bot is not None:
+            bot.terminate()
+            bot.wait(timeout=10)
+        for server in servers:
+            server.stop()
+        temp_dir.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LINE Bot 端對端壓力測試")
+    parser.add_argument("--rate", type=float, default=10.0, help="每秒送出的 webhook 數")
+    parser.add_argument("--duration", type=float, default=30.0, help="測試秒數")
+    parser.add_argument("--users", type=int, default=200, help="模擬的使用者數")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="事件比例，例如 menu=0.2,free_text=0.8")
+    parser.add_argument("--bot-port", type=int, default=9100)
+    parser.add_argument("--server", choices=["uvicorn", "production"], default="uvicorn",
+                        help="uvicorn：單一 worker；production：python -m app.server")
+    parser.add_argument("--workers", type=int, default=2, help="--server production 的 worker 數")
+    parser.add_argument("--bot-url", default="", help="改測已在執行的 bot（需自行指向假服務並使用 --channel-secret）")
+    parser.add_argument("--webhook-path", default="/webhook/line")
+    parser.add_argument("--channel-secret", default=TEST_CHANNEL_SECRET)
+    parser.add_argument("--database-url", default="", help="預設使用暫存的 SQLite 檔案")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--quiet-bot", action="store_true", help="不顯示 bot 的 log")
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+重播擷取的 webhook 流量
+
+讀取 WEBHOOK_CAPTURE_DIR 產生的 gzip JSONL 檔，以測試用的 channel secret 重新簽章後，
+依原始時間間隔（1x / Nx）或以最快速度送到本機的 bot，回報延遲與錯誤，並與擷取當時
+（正式環境）的數據或前一次重播報告比較。
+
+default 以外頻道的紀錄會送到 {url}/{channel}（bot 的這些頻道也需使用相同的測試 secret）。
+每次重播都會改寫事件的 webhookEventId（加上這次重播的後綴），EVENT_DEDUP_TTL 內再次重播
+同一批擷取檔時，事件才不會被當成重送而略過；擷取檔內原本重複的事件仍會重複。
+
+使用方式（在專案根目錄執行，bot 需以相同的 LINE_CHANNEL_SECRET 啟動）：
+    python -m scripts.replay_webhooks captures/ --secret test-secret --speed 1
+    python -m scripts.replay_webhooks captures/ --secret test-secret --speed 10 --output replay.json
+    python -m scripts.replay_webhooks captures/ --secret test-secret --speed max --concurrency 50 --compare replay.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+
+from app.line.handlers import compute_signature
+
+
+def load_records(paths: list[str], limit: int = 0) -> list[dict]:
+    """讀取擷取檔（可給檔案或目錄），依時間排序"""
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob("webhook-*.jsonl.gz")) if path.is_dir() else [path])
+
+    records = []
+    for file in files:
+        try:
+            with gzip.open(file, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+        except (EOFError, OSError) as e:
+            # 行程中斷時最後一個檔案可能沒有正常結尾，保留已讀到的紀錄
+            print(f"警告：{file} 未完整讀取（{e}）", file=sys.stderr)
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+
+def rewrite_event_ids(body: str, run_id: str) -> str:
+    """替 webhook body 中每個事件的 webhookEventId 加上這次重播的後綴"""
+    payload = json.loads(body)
+    events = payload.get("events", [])
+    for event in events:
+        if "webhookEventId" in event:
+            event["webhookEventId"] = f"{event['webhookEventId']}-replay-{run_id}"
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")) if events else body
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+
+    def pick(pct):
+        return round(values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))], 1)
+
+    return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "max": round(values[-1], 1)}
+
+
+def summarize(latencies: list, statuses: list) -> dict:
+    errors = sum(1 for status in statuses if str(status) != "200")
+    return {
+        "count": len(statuses),
+        "error_rate": round(errors / len(statuses), 4) if statuses else 0.0,
+        "latency_ms": percentiles(latencies),
+    }
+
+
+async def replay(records: list[dict], args) -> dict:
+    """送出所有紀錄，回傳重播結果摘要"""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, statuses = [], []
+    speed = None if args.speed == "max" else float(args.speed)
+    # 事前改寫 body，不影響送出的時間間隔
+    run_id = uuid.uuid4().hex[:8]
+    bodies = [rewrite_event_ids(record["body"], run_id) for record in records]
+
+    async def send(client: httpx.AsyncClient, record: dict, body: str):
+        headers = {
+            "X-Line-Signature": compute_signature(body, args.secret),
+            "Content-Type": "application/json",
+        }
+        channel = record.get("channel", "default")
+        url = args.url if channel == "default" else f"{args.url.rstrip('/')}/{channel}"
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, content=body.encode("utf-8"), headers=headers)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses.append(status)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        tasks = []
+        first_ts = records[0]["ts"]
+        started = time.perf_counter()
+        for record, body in zip(records, bodies):
+            if speed is not None:
+                delay = started + (record["ts"] - first_ts) / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(client, record, body)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    summary = summarize(latencies, statuses)
+    summary["elapsed_s"] = round(elapsed, 2)
+    summary["rps"] = round(len(records) / elapsed, 2) if elapsed else 0.0
+    summary["statuses"] = {str(status): statuses.count(status) for status in set(statuses)}
+    return summary
+
+
+def print_comparison(title: str, before: dict, after: dict):
+    print(f"\n{title}")
+    print(f"{'':<12}{'before':>12}{'after':>12}{'delta':>12}")
+    for key in ("p50", "p90", "p99", "max"):
+        old, new = before["latency_ms"][key], after["latency_ms"][key]
+        print(f"{key + ' ms':<12}{old:>12.1f}{new:>12.1f}{new - old:>+12.1f}")
+    old, new = before["error_rate"], after["error_rate"]
+    print(f"{'error rate':<12}{old:>12.2%}{new:>12.2%}{new - old:>+12.2%}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="重播擷取的 webhook 流量")
+    parser.add_argument("paths", nargs="+", help="擷取檔或擷取目錄")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/webhook/line")
+    parser.add_argument("--secret", required=True, help="bot 使用的測試 LINE_CHANNEL_SECRET")
+    parser.add_argument("--speed", default="1", help="重播速度倍數（1、10 ...）或 max")
+    parser.add_argument("--concurrency", type=int, default=100, help="同時進行中的請求上限")
+    parser.add_argument("--limit", type=int, default=0, help="只重播前 N 筆")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", default="", help="把重播報告寫成 JSON")
+    parser.add_argument("--compare", default="", help="與先前的重播報告比較")
+    args = parser.parse_args()
+
+    records = load_records(args.paths, args.limit)
+    if not records:
+        print("沒有可重播的紀錄", file=sys.stderr)
+        return 1
+    print(f"重播 {len(records)} 筆請求（原始時間跨度 {records[-1]['ts'] - records[0]['ts']:.1f} 秒，速度 {args.speed}）")
+
+    captured = summarize(
+        [record.get("latency_ms", 0.0) for record in records],
+        [record.get("status", 200) for record in records],
+    )
+    result = asyncio.run(replay(records, args))
+    result["captured"] = captured
+
+    print(f"\n實際 RPS：{result['rps']}，耗時 {result['elapsed_s']} 秒，HTTP 狀態：{result['statuses']}")
+    print_comparison("擷取當時（before） vs 重播（after）", captured, result)
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        print_comparison(f"{args.compare}（before） vs 本次重播（after）", previous, result)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"\n報告已寫入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())